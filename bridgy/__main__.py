@@ -7,16 +7,18 @@ by tmux.
 
 Usage:
   bridgy init
-  bridgy ssh (-t | --tmux) [-adsuvw] [-l LAYOUT] [-i SOURCE] <host>...
-  bridgy ssh [-duv] [-i SOURCE] <host>
-  bridgy exec (-t | --tmux) [-adsuvw] [-l LAYOUT] [-i SOURCE] <container>...
-  bridgy exec [-duv] [-i SOURCE] <container>
+  bridgy ssh (-t | --tmux) [-adsuvw] [-l LAYOUT] [-n LIMIT] [-i SOURCE] <host>...
+  bridgy ssh [-duv] [-n LIMIT] [-i SOURCE] <host>
+  bridgy exec (-t | --tmux) [-adsuvw] [-l LAYOUT] [-n LIMIT] [-i SOURCE] <container>...
+  bridgy exec [-duv] [-n LIMIT] [-i SOURCE] <container>
   bridgy list-inventory [-i SOURCE]
   bridgy list-mounts
-  bridgy mount [-duv] [-i SOURCE] <host>:<remotedir>
+  bridgy connections [-dv] [--close] [<host>...]
+  bridgy mount [-duv] [-n LIMIT] [-i SOURCE] <host>:<remotedir>
   bridgy unmount [-dv] [-i SOURCE] (-a | <host>...)
   bridgy run <task>
   bridgy update [-v] [-i SOURCE] 
+  bridgy daemon [-v]
   bridgy (-h | --help)
   bridgy --version
 
@@ -27,14 +29,18 @@ Sub-commands:
   mount         use sshfs to mount a remote directory to an empty local directory
   unmount       unmount one or more host sshfs mounts
   list-mounts   show all sshfs mounts
+  connections   show (or close) the multiplexed ssh master connections
   run           execute the given ansible task defined as playbook yml in ~/.bridgy/config.yml
   update        pull the latest inventory from your cloud provider
+  daemon        keep the inventory loaded in memory to speed up searches
 
 Options:
   -a        --all            Automatically use all matched hosts.
+  --close                    Close the matched ssh master connections.
   -d        --dry-run        Show all commands that you would have run, but don't run them (implies --verbose).
   -i SOURCE --source SOURCE  Search a subset of inventories by name (comma separated for multiple values)
   -l LAYOUT --layout LAYOUT  Use a configured tmux layout for each host.
+  -n LIMIT --limit LIMIT     Only consider the LIMIT best matches.
   -s        --sync-panes     Synchronize input on all visible panes (tmux :setw synchronize-panes on).
   -t        --tmux           Open all ssh connections in a tmux session.
   -u        --update         pull the latest instance inventory from aws then run the specified command.
@@ -54,18 +60,16 @@ import logging
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
 import os
-import inquirer
-from inquirer.themes import Theme
-import coloredlogs
 import collections
-from tabulate import tabulate
 from docopt import docopt
 
 from bridgy.version import __version__
 from bridgy.command import Ssh, Sshfs, RunAnsiblePlaybook
+from bridgy.command.ssh import DEFAULT_CONNECT_WORKERS, DEFAULT_CONNECT_TIMEOUT, control_path, needs_interaction
 from bridgy.inventory import InstanceType
 import bridgy.inventory as inventory
 import bridgy.config as cfg
+import bridgy.daemon as daemon
 import bridgy.tmux as tmux
 import bridgy.utils as utils
 
@@ -73,35 +77,41 @@ logger = logging.getLogger()
 
 
 
-class CustomTheme(Theme):
+# inquirer, tabulate and coloredlogs are slow to import, they are only
+# imported by the handlers that use them
+@utils.memoize
+def theme():
+    from inquirer.themes import Theme
 
-    def __init__(self):
-        super(CustomTheme, self).__init__()
+    class CustomTheme(Theme):
 
-        selection_color = utils.term.bold_bright_cyan
-        selected_color  = utils.term.bold_bright_yellow
+        def __init__(self):
+            super(CustomTheme, self).__init__()
 
-        self.Question.mark_color = utils.term.bold_bright_cyan
-        self.Question.brackets_color = utils.term.bold_bright_cyan
-        self.Question.default_color = utils.term.yellow
-        self.Checkbox.selection_color = selection_color
-        self.Checkbox.selection_icon = '‣'# ❯
-        self.Checkbox.selected_icon = '◉ ' #✔⬢◉
-        self.Checkbox.selected_color = selected_color
-        self.Checkbox.unselected_color = utils.term.normal
-        self.Checkbox.unselected_icon = '○ ' #▢ ○ ⬡ 🞅 ⭘ 🔿 🔾
-        self.List.selection_color = selection_color
-        self.List.selection_cursor = '‣' # ❯
-        self.List.unselected_color = utils.term.normal
+            selection_color = utils.term.bold_bright_cyan
+            selected_color  = utils.term.bold_bright_yellow
 
-THEMER = CustomTheme()
+            self.Question.mark_color = utils.term.bold_bright_cyan
+            self.Question.brackets_color = utils.term.bold_bright_cyan
+            self.Question.default_color = utils.term.yellow
+            self.Checkbox.selection_color = selection_color
+            self.Checkbox.selection_icon = '‣'# ❯
+            self.Checkbox.selected_icon = '◉ ' #✔⬢◉
+            self.Checkbox.selected_color = selected_color
+            self.Checkbox.unselected_color = utils.term.normal
+            self.Checkbox.unselected_icon = '○ ' #▢ ○ ⬡ 🞅 ⭘ 🔿 🔾
+            self.List.selection_color = selection_color
+            self.List.selection_cursor = '‣' # ❯
+            self.List.unselected_color = utils.term.normal
 
-def prompt_targets(question, targets=None, instances=None, multiple=True, config=None, type=InstanceType.ALL, filter_sources=tuple()):
+    return CustomTheme()
+
+def prompt_targets(question, targets=None, instances=None, multiple=True, config=None, type=InstanceType.ALL, filter_sources=tuple(), limit=None):
     if targets == None and instances == None or targets != None and instances != None:
         raise RuntimeError("Provide exactly one of either 'targets' or 'instances'")
 
     if targets:
-        instances = inventory.search(config, targets, filter_sources=filter_sources, type=type)
+        instances = inventory.search(config, targets, filter_sources=filter_sources, type=type, limit=limit)
 
     if len(instances) == 0:
         return []
@@ -112,10 +122,13 @@ def prompt_targets(question, targets=None, instances=None, multiple=True, config
     display_instances = collections.OrderedDict()
     # TODO: fix cap'd length... it's pretty arbitraty
     maxLen = min(max([len(instance.name) for instance in instances]), 55)
-    for instance in sorted(instances):
+    # best matches first
+    for instance in instances:
         display = str("%-" + str(maxLen+3) + "s (%s)") % (instance.name, instance.address)
         display_instances[display] = instance
 
+    import inquirer
+
     questions = []
 
     if multiple:
@@ -133,7 +146,7 @@ def prompt_targets(question, targets=None, instances=None, multiple=True, config
 
     answers = None
     try:
-        answers = inquirer.prompt(questions, theme=THEMER, raise_keyboard_interrupt=True)
+        answers = inquirer.prompt(questions, theme=theme(), raise_keyboard_interrupt=True)
     except KeyboardInterrupt:
         logger.error("Cancelled by user")
         sys.exit(1)
@@ -150,17 +163,65 @@ def prompt_targets(question, targets=None, instances=None, multiple=True, config
     return selected_hosts
 
 
+def preconnect(args, config, ssh_objs):
+    """
+    Opens the master connections of all of the selected hosts at once (when
+    multiplexing) so that tmux panes attach to connections that are already
+    authenticated. Hosts that could not be connected to are reported, and
+    only left out when they are unreachable and drop_unreachable is set.
+    """
+    if not config.dig('ssh', 'multiplex') or config.dig('ssh', 'preconnect') == False:
+        return ssh_objs
+
+    Ssh.open_bastions(config, [ssh_obj.instance for ssh_obj in ssh_objs], dry_run=args['-d'])
+
+    results = Ssh.connect_all(ssh_objs,
+                              workers=config.dig('ssh', 'preconnect_workers') or DEFAULT_CONNECT_WORKERS,
+                              timeout=config.dig('ssh', 'preconnect_timeout') or DEFAULT_CONNECT_TIMEOUT,
+                              dry_run=args['-d'])
+
+    failed = [result for result in results if not result.ok]
+    if len(failed) == 0:
+        return ssh_objs
+
+    from tabulate import tabulate
+
+    summary = [(result.instance.name, result.instance.address, '%.1fs' % result.elapsed, result.error) for result in failed]
+    logger.error(tabulate(summary, headers=['Name', 'Address/Dns', 'Time', 'Error']))
+
+    # hosts asking for a password, a second factor or a host key are prompted in their pane
+    unreachable = [result for result in failed if not needs_interaction(result)]
+    if len(unreachable) < len(failed):
+        logger.warn("%d of %d instances need to be logged into from their session" % (len(failed) - len(unreachable), len(results)))
+
+    if len(unreachable) == 0:
+        return ssh_objs
+
+    if not config.dig('ssh', 'drop_unreachable'):
+        logger.warn("Unable to connect to %d of %d instances" % (len(unreachable), len(results)))
+        return ssh_objs
+
+    logger.warn("Unable to connect to %d of %d instances, leaving them out" % (len(unreachable), len(results)))
+    reachable = [ssh_obj for ssh_obj, result in zip(ssh_objs, results) if result.ok or needs_interaction(result)]
+    if len(reachable) == 0:
+        logger.error("No reachable instances")
+        sys.exit(1)
+    return reachable
+
+
 @utils.SupportedPlatforms('linux', 'windows', 'osx')
 def exec_handler(args, config):
     if config.dig('inventory', 'update_at_start') or args['-u']:
         update_handler(args, config)
+    else:
+        refresh_inventory(args, config)
 
     if args ['--tmux'] or config.dig('ssh', 'tmux'):
         question = "What containers would you like to exec into?"
-        targets = prompt_targets(question, targets=args['<container>'], config=config, type=InstanceType.ECS, filter_sources=args['--source'])
+        targets = prompt_targets(question, targets=args['<container>'], config=config, type=InstanceType.ECS, filter_sources=args['--source'], limit=args['--limit'])
     else:
         question = "What containers would you like to exec into?"
-        targets = prompt_targets(question, targets=args['<container>'], config=config, type=InstanceType.ECS, filter_sources=args['--source'], multiple=False)
+        targets = prompt_targets(question, targets=args['<container>'], config=config, type=InstanceType.ECS, filter_sources=args['--source'], limit=args['--limit'], multiple=False)
 
     if len(targets) == 0:
         logger.info("No matching instances found")
@@ -171,10 +232,15 @@ def exec_handler(args, config):
             logger.info("Could not find container id for instance: %s" % instance)
             sys.exit(1)
 
+    ssh_objs = [Ssh(config, instance, command="sudo -i docker exec -ti %s bash" % instance.container_id) for instance in targets]
+
+    if args['--tmux'] or config.dig('ssh', 'tmux'):
+        ssh_objs = preconnect(args, config, ssh_objs)
+
     commands = collections.OrderedDict()
-    for idx, instance in enumerate(targets):
-        name = '{}-{}'.format(instance.name, idx)
-        commands[name] = Ssh(config, instance, command="sudo -i docker exec -ti %s bash" % instance.container_id).command
+    for idx, ssh_obj in enumerate(ssh_objs):
+        name = '{}-{}'.format(ssh_obj.instance.name, idx)
+        commands[name] = ssh_obj.command
 
     layout = None
     if args['--layout']:
@@ -193,22 +259,29 @@ def exec_handler(args, config):
 def ssh_handler(args, config):
     if config.dig('inventory', 'update_at_start') or args['-u']:
         update_handler(args, config)
+    else:
+        refresh_inventory(args, config)
 
     if args ['--tmux'] or config.dig('ssh', 'tmux'):
         question = "What instances would you like to ssh into?"
-        targets = prompt_targets(question, targets=args['<host>'], config=config, type=InstanceType.VM, filter_sources=args['--source'])
+        targets = prompt_targets(question, targets=args['<host>'], config=config, type=InstanceType.VM, filter_sources=args['--source'], limit=args['--limit'])
     else:
         question = "What instance would you like to ssh into?"
-        targets = prompt_targets(question, targets=args['<host>'], config=config, type=InstanceType.VM, filter_sources=args['--source'], multiple=False)
+        targets = prompt_targets(question, targets=args['<host>'], config=config, type=InstanceType.VM, filter_sources=args['--source'], limit=args['--limit'], multiple=False)
 
     if len(targets) == 0:
         logger.info("No matching instances found")
         sys.exit(1)
 
+    ssh_objs = [Ssh(config, instance) for instance in targets]
+
+    if args['--tmux'] or config.dig('ssh', 'tmux'):
+        ssh_objs = preconnect(args, config, ssh_objs)
+
     commands = collections.OrderedDict()
-    for idx, instance in enumerate(targets):
-        name = '{}-{}'.format(instance.name, idx)
-        commands[name] = Ssh(config, instance).command
+    for idx, ssh_obj in enumerate(ssh_objs):
+        name = '{}-{}'.format(ssh_obj.instance.name, idx)
+        commands[name] = ssh_obj.command
 
     layout = None
     if args['--layout']:
@@ -230,6 +303,8 @@ def mount_handler(args, config):
 
     if config.dig('inventory', 'update_at_start') or args['-u']:
         update_handler(args, config)
+    else:
+        refresh_inventory(args, config)
 
     fields = args['<host>:<remotedir>'].split(':')
 
@@ -238,7 +313,7 @@ def mount_handler(args, config):
         sys.exit(1)
 
     desired_target, remotedir = fields
-    instances = inventory.search(config, [desired_target], filter_sources=args['--source'])
+    instances = inventory.search(config, [desired_target], filter_sources=args['--source'], limit=args['--limit'])
     sshfs_objs = [Sshfs(config, instance, remotedir, dry_run=args['-d']) for instance in instances]
     unmounted_targets = [obj.instance for obj in sshfs_objs if not obj.is_mounted]
 
@@ -268,6 +343,50 @@ def list_mounts_handler(args, config):
         logger.info(mountpoint)
 
 
+@utils.SupportedPlatforms('linux', 'osx')
+def connections_handler(args, config):
+    # stale sockets are only cleaned up when actions are taken
+    connections = Ssh.connections(config.socket_dir, remove_stale=not args['-d'])
+    if args['<host>']:
+        connections = [connection for connection in connections if connection_matches(config, connection, args['<host>'])]
+
+    if not args['--close']:
+        from tabulate import tabulate
+
+        logger.info(tabulate([(connection.name, connection.pid) for connection in connections], headers=['Connection', 'Pid']))
+        return
+
+    if len(connections) == 0:
+        logger.error("No matching connections found")
+        sys.exit(1)
+
+    for connection in connections:
+        if args['-d']:
+            logger.debug("ssh -O exit -S %s" % connection.path)
+        elif Ssh.close_connection(connection.path):
+            logger.info("Closed %s" % connection.name)
+
+
+def connection_matches(config, connection, hosts):
+    if any(host in connection.name for host in hosts):
+        return True
+    # socket names may be truncated, match them against the hosts they connect to
+    return connection.path in host_control_paths(config, tuple(hosts))
+
+
+@utils.memoize
+def host_control_paths(config, hosts):
+    paths = set()
+    for instance in inventory.search(config, list(hosts)):
+        ssh_obj = Ssh(config, instance)
+        paths.add(ssh_obj.control_path)
+
+        bastion = inventory.get_bastion(config, instance)
+        if bastion != None:
+            paths.add(control_path(config, bastion.destination, bastion.options))
+    return paths
+
+
 @utils.SupportedPlatforms('linux', 'osx')
 def unmount_handler(args, config):
     Sshfs.ensure_sshfs_installed()
@@ -302,6 +421,8 @@ def unmount_handler(args, config):
 
 @utils.SupportedPlatforms('linux', 'windows', 'osx')
 def list_inventory_handler(args, config):
+    from tabulate import tabulate
+
     instances = []
     for instance in sorted(inventory.instances(config, filter_sources=args['--source'])):
         if instance.aliases:
@@ -317,8 +438,40 @@ def update_handler(args, config):
         return
 
     logger.warn("Updating inventory...")
-    inventory_obj = inventory.inventory(config, filter_sources=args['--source'])
-    inventory_obj.update(filter_sources=args['--source'])
+    report_update(inventory.update(config, filter_sources=args['--source']))
+
+
+def refresh_inventory(args, config):
+    if args['-d']:
+        return
+
+    results = inventory.refresh(config, filter_sources=args['--source'])
+    if len(results) > 0:
+        report_update(results)
+
+
+def report_update(results):
+    from tabulate import tabulate
+
+    summary = []
+    for result in results:
+        summary.append( (result.source, result.status, '%.1fs' % result.elapsed, result.error or '') )
+    logger.info(tabulate(summary, headers=['Source', 'Status', 'Time', 'Error']))
+
+    failed = [result.source for result in results if result.status not in (inventory.UpdateStatus.OK, inventory.UpdateStatus.SHARED)]
+    if len(failed) > 0:
+        logger.error("Unable to update: %s (using the previous inventory)" % ", ".join(failed))
+
+
+@utils.SupportedPlatforms('linux', 'osx')
+def daemon_handler(args, config):
+    try:
+        daemon.InventoryDaemon().serve_forever()
+    except daemon.DaemonError as ex:
+        logger.error(ex)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
 
 
 @utils.SupportedPlatforms('linux', 'windows', 'osx')
@@ -361,6 +514,8 @@ def init_handler(args, config):
         logger.error("Config already exists at %s" % config.path)
 
 def main():
+    import coloredlogs
+
     coloredlogs.install(fmt='%(message)s')
 
     if os.geteuid() == 0:
@@ -377,10 +532,12 @@ def main():
         'exec': exec_handler,
         'mount': mount_handler,
         'list-mounts': list_mounts_handler,
+        'connections': connections_handler,
         'list-inventory': list_inventory_handler,
         'unmount': unmount_handler,
         'update': update_handler,
         'run': run_handler,
+        'daemon': daemon_handler,
     }
 
     if 'init' in args and args['init']:
@@ -414,11 +571,27 @@ def main():
             logger.info(version)
             sys.exit(0)
 
+        # searches are answered by the daemon when it is running
+        if not args['daemon']:
+            client = daemon.connect(config=config.path)
+            if client != None:
+                logger.debug("Using the inventory daemon (pid %s)" % client.pid)
+                inventory.use_daemon(client)
+
         if args['--source'] is None:
             args['--source'] = tuple()
         else:
             args['--source'] = tuple(args['--source'].split(','))
 
+        if args['--limit'] is not None:
+            try:
+                args['--limit'] = int(args['--limit'])
+            except ValueError:
+                args['--limit'] = 0
+            if args['--limit'] < 1:
+                logger.error("--limit must be a positive number")
+                sys.exit(1)
+
         for opt, handler in list(opts.items()):
             if args[opt]:
                 try:
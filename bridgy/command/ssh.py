@@ -1,9 +1,91 @@
+import os
+import re
+import time
+import stat
+import shlex
+import hashlib
+import logging
+import tempfile
+import subprocess
+import collections
+
+from multiprocessing.pool import ThreadPool
+
 from bridgy.error import *
 from bridgy.inventory import get_bastion, get_ssh_options, get_ssh_user
 
+logger = logging.getLogger(__name__)
+
+# how long an idle master connection is kept open
+CONTROL_PERSIST = '10m'
+
+# sun_path is 104 bytes on osx and ssh binds a temporary name with a 17 byte suffix first
+MAX_CONTROL_PATH = 104 - 17 - 1
+# hex digits of the connection identity in a control socket name
+CONTROL_DIGEST_SIZE = 12
+
+# opening master connections to the selected hosts before their panes attach
+DEFAULT_CONNECT_WORKERS = 16
+DEFAULT_CONNECT_TIMEOUT = 15
+CONNECT_POLL_INTERVAL = 0.05
+# masters are opened without prompting (BatchMode), these failures only mean the
+# host wants a password, a passphrase, a second factor or a host key confirmed
+INTERACTIVE_ERRORS = re.compile(r'Permission denied|Host key verification failed|REMOTE HOST IDENTIFICATION HAS CHANGED|'
+                                r'keyboard-interactive|Too many authentication failures|No more authentication methods|'
+                                r'passphrase|verification code', re.IGNORECASE)
+
+Connection = collections.namedtuple('Connection', 'name path pid')
+ConnectResult = collections.namedtuple('ConnectResult', 'instance ok elapsed error')
+
+
+def control_path(config, destination, options=''):
+    """
+    The control socket of the master connection to destination. Connections
+    with other options (a port, a bastion...) get a master of their own, the
+    socket name is the destination (as far as it fits) and a digest of both.
+    """
+    identity = '\0'.join([destination] + options.split())
+    digest = hashlib.sha1(identity.encode('utf-8')).hexdigest()[:CONTROL_DIGEST_SIZE]
+
+    room = MAX_CONTROL_PATH - len(os.path.join(config.socket_dir, '')) - len(digest) - 1
+    if room <= 0:
+        return os.path.join(config.socket_dir, digest)
+    return os.path.join(config.socket_dir, '{}-{}'.format(destination[:room], digest))
+
+
+def needs_interaction(result):
+    """
+    Whether a failed (batch mode) connection reached the host and only needs
+    someone to answer a prompt, the ssh session itself can still connect.
+    """
+    return not result.ok and result.error != None and INTERACTIVE_ERRORS.search(result.error) != None
+
+
+def multiplex_options(config, destination, options=''):
+    if not config.dig('ssh', 'multiplex'):
+        return ''
+
+    # double quoted, this may end up within a single quoted ProxyCommand
+    template = '-o ControlMaster=auto -o ControlPath="{path}" -o ControlPersist={persist}'
+    return template.format(path=control_path(config, destination, options),
+                           persist=config.dig('ssh', 'control_persist') or CONTROL_PERSIST)
+
+
+def proxy_options(config, bastion):
+    # when multiplexing, every hop through the bastion is a channel of its one master connection
+    options = bastion.options
+    multiplex = multiplex_options(config, bastion.destination, bastion.options)
+    if multiplex:
+        options = '{} {}'.format(options, multiplex)
+
+    template = "-o ProxyCommand='ssh {options} -W %h:%p {destination}'"
+    return template.format(options=options,
+                           destination=bastion.destination)
+
+
 class Ssh(object):
 
-    def __init__(self, config, instance):
+    def __init__(self, config, instance, command=None):
         if not hasattr(config, '__getitem__'):
             raise BadConfigError
         if not isinstance(instance, tuple):
@@ -11,7 +93,7 @@ class Ssh(object):
 
         self.config = config
         self.instance = instance
-        self.custom_command = self.config.dig('ssh', 'command')
+        self.custom_command = command or self.config.dig('ssh', 'command')
 
     @property
     def destination(self):
@@ -25,21 +107,38 @@ class Ssh(object):
 
     @property
     def options(self):
+        return '{} -t'.format(self.connection_options)
+
+    @property
+    def target_options(self):
+        # everything but multiplexing, these identify the master connection
         bastion = ''
         options = ''
 
         bastionObj = get_bastion(self.config, self.instance)
 
         if bastionObj != None:
-            template = "-o ProxyCommand='ssh {options} -W %h:%p {destination}'"
-            bastion = template.format(options=bastionObj.options,
-                                      destination=bastionObj.destination)
+            bastion = proxy_options(self.config, bastionObj)
 
         options = get_ssh_options(self.config, self.instance)
 
         # options = self.config.dig('ssh', 'options') or ''
 
-        return '{} {} -t'.format(bastion, options)
+        return '{} {}'.format(bastion, options)
+
+    @property
+    def connection_options(self):
+        options = self.target_options
+
+        multiplex = multiplex_options(self.config, self.destination, options)
+        if multiplex:
+            options = '{} {}'.format(options, multiplex)
+
+        return options
+
+    @property
+    def control_path(self):
+        return control_path(self.config, self.destination, self.target_options)
 
 
     @property
@@ -47,4 +146,143 @@ class Ssh(object):
         cmd = 'ssh {options} {destination} {command}'
         return cmd.format(destination=self.destination,
                           options=self.options,
-                          command=self.custom_command)
+                          command=self.custom_command or '')
+
+    def connect(self, timeout=DEFAULT_CONNECT_TIMEOUT, dry_run=False):
+        """
+        Opens the master connection that the ssh command will attach to,
+        without prompting (several hosts are connected to at once).
+        """
+        started = time.time()
+        path = self.control_path
+        if not dry_run and Ssh.check_connection(path) != None:
+            return ConnectResult(self.instance, True, 0.0, None)
+
+        cmd = 'ssh -fNM {options} -o BatchMode=yes -o ConnectTimeout={timeout} {destination}'
+        cmd = cmd.format(options=self.connection_options,
+                         timeout=int(timeout),
+                         destination=self.destination)
+        logger.debug(cmd)
+        if dry_run:
+            return ConnectResult(self.instance, True, 0.0, None)
+
+        # ssh forks into the background once authenticated, the master keeps its
+        # stdio: errors go to a file rather than a pipe that would close under it
+        with open(os.devnull, 'r+b') as devnull, tempfile.TemporaryFile() as errors:
+            proc = subprocess.Popen(shlex.split(cmd), stdin=devnull, stdout=devnull, stderr=errors)
+            while proc.poll() == None:
+                if time.time() - started > timeout:
+                    proc.kill()
+                    proc.wait()
+                    return ConnectResult(self.instance, False, time.time() - started, "No response after %ss" % timeout)
+                time.sleep(CONNECT_POLL_INTERVAL)
+
+            if proc.returncode != 0:
+                errors.seek(0)
+                error = errors.read().decode('utf-8', 'replace').strip().replace('\n', ', ')
+                return ConnectResult(self.instance, False, time.time() - started, error or "rc:%d" % proc.returncode)
+
+        return ConnectResult(self.instance, True, time.time() - started, None)
+
+    @classmethod
+    def connect_all(cls, ssh_objs, workers=DEFAULT_CONNECT_WORKERS, timeout=DEFAULT_CONNECT_TIMEOUT, dry_run=False):
+        """
+        Connects to all of the hosts at once, returns a ConnectResult for each
+        (in order).
+        """
+        if len(ssh_objs) == 0:
+            return []
+
+        pool = ThreadPool(processes=max(1, min(workers, len(ssh_objs))))
+        try:
+            return pool.map(lambda ssh_obj: ssh_obj.connect(timeout, dry_run=dry_run), ssh_objs)
+        finally:
+            pool.close()
+
+    @classmethod
+    def open_master(cls, config, destination, options='', dry_run=False):
+        """
+        Opens a background master connection to destination unless one is
+        already running, returns False if the connection failed.
+        """
+        path = control_path(config, destination, options)
+        if not dry_run and cls.check_connection(path) != None:
+            return True
+
+        cmd = 'ssh -fNM -o ControlPath="{path}" -o ControlPersist={persist} {options} {destination}'
+        cmd = cmd.format(path=path,
+                         persist=config.dig('ssh', 'control_persist') or CONTROL_PERSIST,
+                         options=options,
+                         destination=destination)
+        logger.debug(cmd)
+        if dry_run:
+            return True
+
+        # ssh forks once authenticated, any prompt is answered on this terminal
+        return subprocess.call(shlex.split(cmd)) == 0
+
+    @classmethod
+    def open_bastions(cls, config, instances, dry_run=False):
+        """
+        Opens one master connection to each bastion used by instances, so
+        that all hops share it instead of each opening their own connection.
+        """
+        if not config.dig('ssh', 'multiplex'):
+            return
+
+        bastions = collections.OrderedDict()
+        for instance in instances:
+            bastion = get_bastion(config, instance)
+            if bastion != None:
+                bastions[bastion.destination] = bastion
+
+        for bastion in bastions.values():
+            if not cls.open_master(config, bastion.destination, bastion.options, dry_run=dry_run):
+                logger.warn("Unable to open a shared connection to bastion %s" % bastion.destination)
+
+    @classmethod
+    def connections(cls, socket_dir, remove_stale=True):
+        """
+        Returns the master connections with a control socket in socket_dir,
+        sockets left behind by masters that are no longer running are removed.
+        """
+        connections = []
+        for name in sorted(os.listdir(socket_dir)):
+            path = os.path.join(socket_dir, name)
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                continue
+
+            pid = cls.check_connection(path)
+            if pid == None:
+                if remove_stale:
+                    logger.debug("Removing stale control socket %s" % path)
+                    os.remove(path)
+                continue
+
+            connections.append(Connection(name=name, path=path, pid=pid))
+        return connections
+
+    @staticmethod
+    def control(path, operation):
+        # the destination is required but unused, the control socket identifies the master
+        cmd = ['ssh', '-O', operation, '-S', path, 'bridgy']
+        logger.debug(' '.join(cmd))
+        pipes = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        std_out, std_err = pipes.communicate()
+        return pipes.returncode, std_err.decode('utf-8').strip()
+
+    @classmethod
+    def check_connection(cls, path):
+        rc, message = cls.control(path, 'check')
+        match = re.search(r'pid=(\d+)', message)
+        if rc != 0 or not match:
+            return None
+        return int(match.group(1))
+
+    @classmethod
+    def close_connection(cls, path):
+        rc, message = cls.control(path, 'exit')
+        if rc != 0:
+            logger.error("Unable to close %s: %s" % (path, message))
+            return False
+        return True
@@ -3,7 +3,8 @@ import sys
 import logging
 from bridgy.error import *
 from bridgy.inventory import get_bastion
-from bridgy.utils import platform, UnsupportedPlatform
+from bridgy.command.ssh import multiplex_options, proxy_options
+from bridgy.utils import platform, which, UnsupportedPlatform
 
 logger = logging.getLogger(__name__)
 
@@ -26,7 +27,7 @@ class Sshfs(object):
 
     @staticmethod
     def ensure_sshfs_installed():
-        if run('which sshfs >/dev/null 2>&1') != 0:
+        if which('sshfs') == None:
             logger.error("SSHFS is not installed")
             sys.exit(1)
 
@@ -46,13 +47,17 @@ class Sshfs(object):
         bastionObj = get_bastion(self.config, self.instance)
 
         if bastionObj != None:
-            template = "-o ProxyCommand='ssh {options} -W %h:%p {destination}'"
-            bastion = template.format(options=bastionObj.options,
-                                      destination=bastionObj.destination)
+            bastion = proxy_options(self.config, bastionObj)
 
         options = self.config.dig('sshfs', 'options') or ''
 
-        return '{} {}'.format(bastion, options)
+        options = '{} {}'.format(bastion, options)
+
+        multiplex = multiplex_options(self.config, self.destination, options)
+        if multiplex:
+            options = '{} {}'.format(options, multiplex)
+
+        return options
 
     @property
     def command(self):
@@ -19,6 +19,7 @@ class ConfigBase(object):
     path = "~/.bridgy/config.yml"
     inventory = "~/.bridgy/inventory"
     mount = "~/.bridgy/mounts"
+    sockets = "~/.bridgy/sockets"
     conf = None
 
     def __init__(self, initial_data=None):
@@ -69,7 +70,7 @@ class ConfigBase(object):
                              Representer.represent_str)
         try:
             with open(os.path.expanduser(self.path), 'r') as fh:
-                self.conf = yaml.load(fh)
+                self.conf = yaml.safe_load(fh)
         except Exception as ex:
             logger.error("Unable to read config (%s): %s" % (self.path, ex))
             sys.exit(1)
@@ -104,6 +105,10 @@ class ConfigBase(object):
         mount_path = os.path.expanduser(self.mount)
         if not os.path.exists(mount_path):
             os.mkdir(mount_path)
+
+        socket_path = os.path.expanduser(self.sockets)
+        if not os.path.exists(socket_path):
+            os.mkdir(socket_path, 0o700)
         
         return created
 
@@ -116,6 +121,14 @@ class ConfigBase(object):
     def mount_root_dir(self):
         return os.path.expanduser(self.mount)
 
+    @property
+    def socket_dir(self):
+        # ssh control sockets, only the user may connect to them
+        socket_path = os.path.expanduser(self.sockets)
+        if not os.path.exists(socket_path):
+            os.makedirs(socket_path, 0o700)
+        return socket_path
+
     def __iter__(self):
         return iter(self.conf)
 
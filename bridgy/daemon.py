@@ -0,0 +1,282 @@
+import os
+import json
+import socket
+import logging
+import threading
+import collections
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+import bridgy.config as cfg
+import bridgy.inventory as inventory
+from bridgy.config.base import ConfigBase
+from bridgy.error import DaemonError
+from bridgy.inventory import Bastion, Instance, InstanceType
+from bridgy.version import __version__
+
+logger = logging.getLogger()
+
+SOCKET_PATH = "~/.bridgy/daemon.sock"
+CLIENT_TIMEOUT = 2.0
+
+SshSettings = collections.namedtuple("SshSettings", "bastion options user")
+
+
+def socket_path():
+    return os.path.expanduser(SOCKET_PATH)
+
+
+def _decode_instance(fields):
+    name, address, aliases, source, container_id, type = fields
+    if aliases != None:
+        aliases = tuple(aliases)
+    return Instance(name, address, aliases, source, container_id, type)
+
+
+def config_path():
+    return os.path.abspath(os.path.expanduser(ConfigBase.path))
+
+
+def load_config():
+    config = cfg.Config()
+    config.read()
+    config.verify()
+    return config
+
+
+class InventoryState(object):
+    """
+    The config and inventory served by the daemon. Everything is reloaded
+    when config.yml or the cache generation (or file) backing any of the
+    configured sources changes.
+    """
+
+    def __init__(self, load_config=load_config):
+        self.load_config = load_config
+        self.config = None
+        self.fingerprint = None
+
+    def current_fingerprint(self):
+        fingerprint = []
+        try:
+            stat = os.stat(config_path())
+            fingerprint.append((stat.st_size, stat.st_mtime))
+        except OSError:
+            fingerprint.append(None)
+
+        if self.config == None:
+            return fingerprint
+
+        # only the 'current' pointer of each source (and the csv files) is
+        # read, the inventory directory itself is never walked
+        for source in inventory.inventory(self.config).inventories:
+            try:
+                fingerprint.append((source.name, source.cache_fingerprint()))
+            except (IOError, OSError):
+                fingerprint.append((source.name, None))
+        return fingerprint
+
+    def current(self):
+        fingerprint = self.current_fingerprint()
+        if fingerprint != self.fingerprint:
+            self.reload(fingerprint)
+        return self.config
+
+    def reload(self, fingerprint):
+        try:
+            config = self.load_config()
+        except SystemExit:
+            if self.config == None:
+                raise DaemonError("Unable to read config")
+            logger.error("Unable to reload config, still serving the previous inventory")
+            self.fingerprint = fingerprint
+            return
+
+        inventory.reset()
+        self.config = config
+
+        # load every cache and search index up front so the next query is fast
+        for source in inventory.inventory(config).inventories:
+            try:
+                source.searchable()
+            except (Exception, SystemExit) as ex:
+                logger.error("Unable to load inventory %s: %s" % (source.name, ex))
+
+        # the sources of the new config are only known now
+        self.fingerprint = self.current_fingerprint()
+        logger.info("Loaded inventory")
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        try:
+            request = json.loads(line.decode('utf-8'))
+            response = {'result': self.server.daemon.handle(request)}
+        except (Exception, SystemExit) as ex:
+            logger.error("Unable to answer request %s: %s" % (line.strip(), ex))
+            response = {'error': str(ex) or repr(ex)}
+
+        self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class InventoryDaemon(object):
+    """
+    Keeps the inventory and search indexes in memory and answers queries
+    from the CLI over a unix socket, one JSON request/response per connection.
+    """
+
+    def __init__(self, path=None, state=None):
+        self.path = path or socket_path()
+        self.state = state or InventoryState()
+        self.server = None
+        self._lock = threading.Lock()
+
+    def handle(self, request):
+        op = request.get('op')
+
+        if op == 'ping':
+            return {'version': __version__, 'pid': os.getpid(), 'config': config_path()}
+
+        # the daemon only knows the config it was started with
+        if request.get('config') != None and request['config'] != config_path():
+            raise ValueError("The daemon serves %s, not %s" % (config_path(), request['config']))
+
+        with self._lock:
+            config = self.state.current()
+
+            if op == 'search':
+                instances = inventory.search(config, request['targets'],
+                                             filter_sources=tuple(request.get('filter_sources') or ()),
+                                             type=request.get('type') or InstanceType.ALL,
+                                             limit=request.get('limit'))
+                return [list(instance) for instance in instances]
+
+            if op == 'instances':
+                instances = inventory.instances(config, filter_sources=tuple(request.get('filter_sources') or ()))
+                return [list(instance) for instance in instances]
+
+            if op == 'ssh':
+                instance = _decode_instance(request['instance'])
+                bastion = inventory.get_bastion(config, instance)
+                return {'bastion': list(bastion) if bastion != None else None,
+                        'options': inventory.get_ssh_options(config, instance),
+                        'user': inventory.get_ssh_user(config, instance)}
+
+        raise ValueError("Unknown request: %s" % repr(op))
+
+    def start(self):
+        if os.path.exists(self.path):
+            if connect(self.path) != None:
+                raise DaemonError("A daemon is already listening on %s" % self.path)
+            # left behind by a daemon that did not shut down cleanly
+            os.remove(self.path)
+
+        with self._lock:
+            self.state.current()
+
+        # the socket must never be reachable by other users, not even briefly
+        umask = os.umask(0o077)
+        try:
+            self.server = _Server(self.path, _RequestHandler)
+        finally:
+            os.umask(umask)
+        self.server.daemon = self
+        os.chmod(self.path, 0o600)
+        return self
+
+    def serve_forever(self):
+        if self.server == None:
+            self.start()
+
+        logger.info("Listening on %s" % self.path)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.close()
+
+    def shutdown(self):
+        self.server.shutdown()
+
+    def close(self):
+        self.server.server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class DaemonClient(object):
+
+    def __init__(self, path=None, timeout=CLIENT_TIMEOUT, config=None):
+        self.path = path or socket_path()
+        self.timeout = timeout
+        self.config = config
+        self.pid = None
+        self._ssh_settings = {}
+
+    def request(self, op, **params):
+        params['op'] = op
+        if self.config != None:
+            params['config'] = self.config
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.settimeout(self.timeout)
+        try:
+            conn.connect(self.path)
+            conn.sendall((json.dumps(params) + '\n').encode('utf-8'))
+            response = json.loads(conn.makefile('rb').readline().decode('utf-8'))
+        except (socket.error, ValueError) as ex:
+            raise DaemonError(str(ex) or repr(ex))
+        finally:
+            conn.close()
+
+        if 'error' in response:
+            raise DaemonError(response['error'])
+        return response['result']
+
+    def search(self, targets, filter_sources=tuple(), type=InstanceType.ALL, limit=None):
+        results = self.request('search', targets=list(targets), filter_sources=list(filter_sources), type=type,
+                               limit=limit)
+        return [_decode_instance(fields) for fields in results]
+
+    def instances(self, filter_sources=tuple()):
+        results = self.request('instances', filter_sources=list(filter_sources))
+        return [_decode_instance(fields) for fields in results]
+
+    def ssh_settings(self, instance):
+        if instance not in self._ssh_settings:
+            result = self.request('ssh', instance=list(instance))
+            bastion = Bastion(*result['bastion']) if result['bastion'] != None else None
+            self._ssh_settings[instance] = SshSettings(bastion, result['options'], result['user'])
+        return self._ssh_settings[instance]
+
+
+def connect(path=None, config=None):
+    """
+    Returns a client for a daemon running the same version of bridgy (and
+    serving the given config file), or None when there is none.
+    """
+    if config != None:
+        config = os.path.abspath(os.path.expanduser(config))
+    client = DaemonClient(path, config=config)
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(client.path):
+        return None
+
+    try:
+        info = client.request('ping')
+    except DaemonError:
+        return None
+
+    if info.get('version') != __version__:
+        return None
+
+    if config != None and info.get('config') != config:
+        return None
+
+    client.pid = info.get('pid')
+    return client
@@ -2,3 +2,5 @@ class MissingBastionHost(Exception): pass
 class BadInstanceError(Exception): pass
 class BadConfigError(Exception): pass
 class BadRemoteDir(Exception): pass
+class DaemonError(Exception): pass
+class UpdateCancelled(Exception): pass
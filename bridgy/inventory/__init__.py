@@ -1,32 +1,62 @@
 import os
-import re
 import sys
+import time
 import logging
-from functools import partial
+import importlib
+import subprocess
 
 from bridgy.utils import memoize
-from bridgy.error import MissingBastionHost
-from bridgy.inventory.source import Bastion, Instance, InventorySet, InstanceType
-from bridgy.inventory.aws import AwsInventory
-from bridgy.inventory.flatfile import CsvInventory
-from bridgy.inventory.newrelic import NewRelicInventory
-# from gcp import GcpInventory
+from bridgy.error import MissingBastionHost, DaemonError
+from bridgy.inventory.source import Bastion, Instance, InventorySet, InstanceType, InstanceFilter, UpdateStatus, \
+                                    CacheState, DEFAULT_UPDATE_WORKERS, DEFAULT_UPDATE_TIMEOUT
 
 logger = logging.getLogger()
 
+# sources are only imported once they are configured, their dependencies
+# (boto3, requests...) are slow to import
 SOURCES = {
-    'aws': AwsInventory,
-    # 'gcp': GcpInventory,
-    'csv': CsvInventory,
-    'newrelic': NewRelicInventory,
+    'aws': 'bridgy.inventory.aws.AwsInventory',
+    # 'gcp': 'bridgy.inventory.gcp.GcpInventory',
+    'csv': 'bridgy.inventory.flatfile.CsvInventory',
+    'newrelic': 'bridgy.inventory.newrelic.NewRelicInventory',
 }
 
+# background update logs past this size are rotated (only one older log is kept)
+UPDATE_LOG_SIZE = 256 * 1024
+
+# a client for a running 'bridgy daemon', see use_daemon()
+_daemon = None
+
+def use_daemon(client):
+    """
+    Answer searches, instance listings and ssh settings from a running daemon
+    instead of loading the inventory in-process.
+    """
+    global _daemon
+    _daemon = client
+
+def _daemon_failed(ex):
+    global _daemon
+    logger.debug("Inventory daemon unavailable, loading the inventory in-process: %s" % ex)
+    _daemon = None
+
+def reset():
+    # forget everything loaded for previous configs
+    for func in (inventory, config_filter, instances, get_bastion, get_ssh_options, get_ssh_user):
+        func.cache.clear()
+
+def source_class(source):
+    module_name, class_name = SOURCES[source].rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
 @memoize
 def inventory(config, filter_sources=tuple()):
     inventorySet = InventorySet()
 
     for source, srcCfg in config.sources():
         if source == 'aws':
+            AwsInventory = source_class(source)
+
             # the cache directory for the original v1 config did not separate
             # out multiple aws profiles into subdirectories
             if config.version == 1:
@@ -37,19 +67,16 @@ def inventory(config, filter_sources=tuple()):
             if not os.path.exists(cache_dir):
                 os.mkdir(cache_dir)
 
-            from botocore.exceptions import ProfileNotFound
-            try:
-                inv = AwsInventory(cache_dir, **srcCfg)
-                inventorySet.add(inv)
-            except ProfileNotFound:
-                logger.error("Unconfigured AWS profile configured.")
-                sys.exit(1)
+            inv = AwsInventory(cache_dir, **srcCfg)
+            inventorySet.add(inv)
 
         elif source == 'csv':
+            CsvInventory = source_class(source)
             inv = CsvInventory(path=config.inventoryDir(source, srcCfg['file']), **srcCfg)
             inventorySet.add(inv)
 
         elif source == 'newrelic':
+            NewRelicInventory = source_class(source)
 
             proxies = {}
 
@@ -73,41 +100,54 @@ def inventory(config, filter_sources=tuple()):
 
             inventorySet.add(inv)
 
+    # inventory wide cache lifetimes for sources that do not set their own,
+    # sources apply the inventory wide patterns when building their cache
+    for inv in inventorySet.inventories:
+        inv.inventory_filter = config_filter(config)
+        if inv.cache_ttl == None:
+            inv.cache_ttl = config.dig('inventory', 'cache_ttl')
+        if inv.cache_max_age == None:
+            inv.cache_max_age = config.dig('inventory', 'cache_max_age')
+
     return inventorySet
 
-def instance_filter(instance, include_re=None, exclude_re=None):
-    comparables = [instance.name, instance.address]
+@memoize
+def config_filter(config):
+    return InstanceFilter([(config.dig('inventory', 'include_pattern'), config.dig('inventory', 'exclude_pattern'))])
 
-    if instance.aliases:
-        comparables.extend(list(instance.aliases))
+def _config_filter_applied(config, inventorySet):
+    # sources from inventory() are already filtered by the inventory wide patterns
+    instance_filter = config_filter(config)
+    return not instance_filter or all(inv.inventory_filter is instance_filter for inv in inventorySet.inventories)
 
-    if include_re:
-        for name in comparables:
-            if include_re.search(name):
-                return True
-        return False
-    elif exclude_re:
-        for name in comparables:
-            if exclude_re.search(name):
-                return False
-        return True
-    else:
-        return True
+def _config_filtered(config, inventorySet, instances):
+    if _config_filter_applied(config, inventorySet):
+        return instances
+    return config_filter(config).apply(instances)
 
 @memoize
 def instances(config, filter_sources=tuple()):
-    include_re, exclude_re = None, None
-    if config.dig('inventory', 'include_pattern'):
-        include_re = re.compile(config.dig('inventory', 'include_pattern'))
-    if config.dig('inventory', 'exclude_pattern'):
-        exclude_re = re.compile(config.dig('inventory', 'exclude_pattern'))
+    if _daemon != None:
+        try:
+            return _daemon.instances(filter_sources)
+        except DaemonError as ex:
+            _daemon_failed(ex)
 
-    all_instances = inventory(config).instances(filter_sources=filter_sources)
-    config_instance_filter = partial(instance_filter, include_re=include_re, exclude_re=exclude_re)
-    return list(filter(config_instance_filter, all_instances))
+    return list(iter_instances(config, filter_sources))
+
+def iter_instances(config, filter_sources=tuple()):
+    inventorySet = inventory(config)
+    all_instances = inventorySet.iter_instances(filter_sources=filter_sources)
+    return _config_filtered(config, inventorySet, all_instances)
 
 @memoize
 def get_bastion(config, instance):
+    if _daemon != None:
+        try:
+            return _daemon.ssh_settings(instance).bastion
+        except DaemonError as ex:
+            _daemon_failed(ex)
+
     bastion = None
 
     for inv in inventory(config).inventories:
@@ -134,6 +174,12 @@ def get_bastion(config, instance):
 
 @memoize
 def get_ssh_options(config, instance):
+    if _daemon != None:
+        try:
+            return _daemon.ssh_settings(instance).options
+        except DaemonError as ex:
+            _daemon_failed(ex)
+
     ssh_options = None
 
     for inv in inventory(config).inventories:
@@ -147,6 +193,12 @@ def get_ssh_options(config, instance):
 
 @memoize
 def get_ssh_user(config, instance):
+    if _daemon != None:
+        try:
+            return _daemon.ssh_settings(instance).user
+        except DaemonError as ex:
+            _daemon_failed(ex)
+
     ssh_user = None
 
     for inv in inventory(config).inventories:
@@ -158,24 +210,107 @@ def get_ssh_user(config, instance):
     
     return ''
 
-def search(config, targets, filter_sources=tuple(), type=InstanceType.ALL):
+def search(config, targets, filter_sources=tuple(), type=InstanceType.ALL, limit=None):
+    if _daemon != None:
+        try:
+            return _daemon.search(targets, filter_sources, type, limit)
+        except DaemonError as ex:
+            _daemon_failed(ex)
+
+    return list(iter_search(config, targets, filter_sources, type, limit))
+
+def iter_search(config, targets, filter_sources=tuple(), type=InstanceType.ALL, limit=None):
+    """
+    Yields the best matches of all sources, best first. The inventory wide
+    filter and the type are checked while ranking, so at most limit
+    instances are created per source.
+    """
     fuzzy = False
     if config.dig('inventory', 'fuzzy_search'):
         fuzzy = config.dig('inventory', 'fuzzy_search')
 
-    include_re, exclude_re = None, None
-    if config.dig('inventory', 'include_pattern'):
-        include_re = re.compile(config.dig('inventory', 'include_pattern'))
-    if config.dig('inventory', 'exclude_pattern'):
-        exclude_re = re.compile(config.dig('inventory', 'exclude_pattern'))
+    inventorySet = inventory(config)
+    predicates = []
+    if not _config_filter_applied(config, inventorySet):
+        predicates.append(config_filter(config))
+    if type != InstanceType.ALL:
+        predicates.append(lambda instance: instance.type == type)
+
+    predicate = None
+    if len(predicates) > 0:
+        predicate = lambda instance: all(check(instance) for check in predicates)
 
-    matched_instances = inventory(config).search(targets, fuzzy=fuzzy, filter_sources=filter_sources)
-    config_instance_filter = partial(instance_filter, include_re=include_re, exclude_re=exclude_re)
-    filtered_instances = list(filter(config_instance_filter, matched_instances))
-    if type == InstanceType.ALL:
-        return filtered_instances
-    else:
-        return [x for x in filtered_instances if x.type == type]
+    return inventorySet.iter_search(targets, fuzzy=fuzzy, filter_sources=filter_sources, limit=limit, predicate=predicate)
+
+def _update_settings(config):
+    workers = config.dig('inventory', 'update_workers') or DEFAULT_UPDATE_WORKERS
+    timeout = config.dig('inventory', 'update_timeout') or DEFAULT_UPDATE_TIMEOUT
+    return workers, timeout
 
 def update(config, filter_sources=tuple()):
-    inventory(config).update(filter_sources=filter_sources)
+    workers, timeout = _update_settings(config)
+    return inventory(config).update(filter_sources=filter_sources, workers=workers, timeout=timeout)
+
+def refresh(config, filter_sources=tuple()):
+    """
+    Sources with a cache past its cache_max_age are updated before returning,
+    sources with a cache past its cache_ttl are updated by a background
+    process while the current (stale) cache keeps being used.
+    """
+    workers, timeout = _update_settings(config)
+    expired, stale = [], []
+
+    for inv in inventory(config).inventories:
+        if len(filter_sources) > 0 and getattr(inv, 'source', None) not in filter_sources:
+            continue
+
+        state = inv.cache_state()
+        if state == CacheState.EXPIRED:
+            expired.append(inv)
+        elif state == CacheState.STALE and not _refresh_pending(inv, inv.update_timeout or timeout):
+            stale.append(inv)
+
+    if len(stale) > 0:
+        update_in_background(config, stale)
+
+    if len(expired) == 0:
+        return []
+
+    logger.warn("Inventory is out of date, updating %s..." % ", ".join([inv.name for inv in expired]))
+    return InventorySet(expired).update(workers=workers, timeout=timeout)
+
+def _refresh_marker(inv):
+    return inv.cache_root + '.refresh'
+
+def _refresh_pending(inv, timeout):
+    # a background update started recently is still running (or gave up)
+    try:
+        return time.time() - os.path.getmtime(_refresh_marker(inv)) < timeout
+    except OSError:
+        return False
+
+def update_in_background(config, inventories):
+    cmd = [sys.executable, '-m', 'bridgy', 'update']
+    sources = [getattr(inv, 'source', None) for inv in inventories]
+    if None not in sources:
+        cmd += ['-i', ','.join(sources)]
+
+    for inv in inventories:
+        with open(_refresh_marker(inv), 'w'):
+            pass
+
+    log_path = os.path.join(os.path.dirname(os.path.expanduser(config.path)), 'update.log')
+    logger.debug("Updating %s in the background (%s)" % (", ".join([inv.name for inv in inventories]), log_path))
+    _rotate_log(log_path)
+
+    with open(os.devnull, 'r') as devnull, open(log_path, 'a') as log_file:
+        # detached from this terminal so it outlives the current command
+        subprocess.Popen(cmd, stdin=devnull, stdout=log_file, stderr=log_file, close_fds=True,
+                         preexec_fn=getattr(os, 'setsid', None))
+
+def _rotate_log(log_path):
+    try:
+        if os.path.getsize(log_path) > UPDATE_LOG_SIZE:
+            os.rename(log_path, log_path + '.1')
+    except OSError:
+        pass
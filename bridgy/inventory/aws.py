@@ -1,113 +1,327 @@
 import os
-import boto3
-import shutil
-import placebo
+import sys
 import logging
+import threading
+from multiprocessing.pool import ThreadPool
 
 from bridgy.inventory.source import InventorySource, Instance, InstanceType
 
 logger = logging.getLogger()
 
+PAGE_SIZE = 1000
+DEFAULT_WORKERS = 16
+DEFAULT_INSTANCE_STATES = ['running']
+REGEX_SPECIAL = set('.^$*+?{}[]\\|()')
+
 class AwsInventory(InventorySource):
 
     name = 'aws'
 
-    # kwargs: access_key_id, secret_access_key, session_token, region, profile, config_path
+    # kwargs: access_key_id, secret_access_key, session_token, region, regions, assume_roles,
+    #         update_workers, origin_aliases, filters, profile, config_path
     def __init__(self, cache_dir, **kwargs):
         super(AwsInventory, self).__init__(cache_dir, **kwargs)
         self.cache_dir = cache_dir
+        self.cache_root = os.path.join(cache_dir, 'cache')
 
         # this is an override for the config location (at least useful for testing)
         if 'config_path' in kwargs:
             os.environ['AWS_CONFIG_FILE'] = os.path.join(kwargs['config_path'], "config")
             os.environ['AWS_SHARED_CREDENTIALS_FILE'] = os.path.join(kwargs['config_path'], "credentials")
 
+        # a single source can fan out over several regions and (assumed role) accounts
+        self.regions = kwargs.get('regions') or []
+        self.assume_roles = kwargs.get('assume_roles') or []
+        self.update_workers = kwargs.get('update_workers') or DEFAULT_WORKERS
+        # searchable region/account aliases are opt-in, partial searches such as
+        # 'us' or 'east' would otherwise match every instance
+        self.origin_aliases = bool(kwargs.get('origin_aliases'))
+        self._caller_account = None
+        self._caller_account_lock = threading.Lock()
+        self.region = kwargs.get('region')
+
+        filters = kwargs.get('filters') or {}
+        self.instance_states = filters.get('instance_states', DEFAULT_INSTANCE_STATES)
+        self.tag_filters = filters.get('tags') or {}
+        self.vpc_ids = filters.get('vpc_ids') or []
+        self.subnet_ids = filters.get('subnet_ids') or []
+        if self.region == None and len(self.regions) > 0:
+            self.region = self.regions[0]
+
         if 'profile' in kwargs and kwargs['profile'] != None:
-            session = boto3.Session(
-                profile_name=kwargs['profile'],
-                region_name=kwargs['region']
-            )
-        elif 'access_key_id' in kwargs and 'secret_access_key' in kwargs and 'session_token' in kwargs and 'region' in kwargs:
-            session = boto3.Session(
-                aws_access_key_id=kwargs['access_key_id'],
-                aws_secret_access_key=kwargs['secret_access_key'],
-                aws_session_token=kwargs['session_token'],
-                region_name=kwargs['region']
-            )
+            self.session_kwargs = dict(profile_name=kwargs['profile'])
+        elif 'access_key_id' in kwargs and 'secret_access_key' in kwargs and 'session_token' in kwargs and self.region:
+            self.session_kwargs = dict(aws_access_key_id=kwargs['access_key_id'],
+                                       aws_secret_access_key=kwargs['secret_access_key'],
+                                       aws_session_token=kwargs['session_token'])
         else:
             # pull from ~/.aws/* configs (or other boto search paths)
-            session = boto3.Session()
+            self.session_kwargs = {}
+
+        # boto3 is slow to import and is not needed to read the cache, the
+        # session and client are only created once they are used
+        self._session = None
+        self._pill = None
+        self._client = None
+
+    @property
+    def session(self):
+        if self._session == None:
+            import boto3
+            from botocore.exceptions import ProfileNotFound
+            try:
+                if len(self.session_kwargs) > 0:
+                    self._session = boto3.Session(region_name=self.region, **self.session_kwargs)
+                else:
+                    self._session = boto3.Session()
+            except ProfileNotFound:
+                logger.error("Unconfigured AWS profile configured.")
+                sys.exit(1)
+        return self._session
+
+    @property
+    def pill(self):
+        if self._pill == None:
+            import placebo
+            self._pill = placebo.attach(self.session, data_path=self.cache_dir)
+        return self._pill
 
-        self.pill = placebo.attach(session, data_path=cache_dir)
+    @property
+    def client(self):
+        if self._client == None:
+            # placebo has to be attached before the client is created
+            self.pill
+            self._client = self.session.client('ec2')
+        return self._client
 
-        self.client = session.client('ec2')
+    @property
+    def fan_out(self):
+        return len(self.regions) > 0 or len(self.assume_roles) > 0
+
+    def targets(self):
+        regions = self.regions or [self.region]
+        roles = self.assume_roles or [None]
+        return [(role, region) for role in roles for region in regions]
 
     def update(self):
         try:
-            self.__ec2_search(stub=False)
+            self.__ec2_update()
         except KeyboardInterrupt:
             logger.error("Cancelled by user")
 
+    def cache_fingerprint(self, generation=None):
+        fingerprint = super(AwsInventory, self).cache_fingerprint(generation)
+        if fingerprint != None:
+            return fingerprint
+
+        # the cache recorded by earlier versions of bridgy
+        paths = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith('.json')]
+        return self._file_fingerprint(paths)
+
     def instances(self):
-        data = self.__ec2_search(stub=True)
+        cached = self.read_cache()
+        if cached != None:
+            return cached
+
+        # fall back to a cache recorded by earlier versions of bridgy
+        data = self.__ec2_search()
 
         instances = []
         for reservation in data['Reservations']:
             for instance in reservation['Instances']:
-
-                # try to find the best dns/ip address to reach this box
-                address = None
-                if instance.get('PublicDnsName'):
-                    address = instance['PublicDnsName']
-                elif instance.get('PrivateIpAddress'):
-                    address = instance['PrivateIpAddress']
-
-                # try to find the best field to match a name against
-                aliases = list()
-                if 'Tags' in list(instance.keys()):
-                    for tagDict in instance['Tags']:
-                        if tagDict['Key'] == 'Name':
-                            aliases.insert(0, tagDict['Value'])
-                        else:
-                            aliases.append(tagDict['Value'])
-
-                # if instance['PublicDnsName']:
-                #     aliases.append(instance['PublicDnsName'])
-                # if instance['PrivateDnsName']:
-                #     aliases.append(instance['PrivateDnsName'])
-                if instance['InstanceId']:
-                    aliases.append(instance['InstanceId'])
-
-                aliases[:] = [x for x in aliases if x != None]
-                name = aliases.pop(0) + " " +  instance['InstanceId']
-
-                # take note of this instance
-                if name != None and address != None:
-                    if len(aliases) > 0:
-                        instances.append(Instance(name, address, tuple(aliases), self.name, None, InstanceType.VM))
-                    else:
-                        instances.append(Instance(name, address, None, self.name, None, InstanceType.VM))
+                normalized = self._normalize(instance)
+                if normalized != None:
+                    instances.append(normalized)
 
         return self.filter(instances)
 
-    def __ec2_search(self, tag=None, value=None, stub=True):
+    def _normalize(self, instance, origin=None):
+        # try to find the best dns/ip address to reach this box
+        address = None
+        if instance.get('PublicDnsName'):
+            address = instance['PublicDnsName']
+        elif instance.get('PrivateIpAddress'):
+            address = instance['PrivateIpAddress']
+
+        # try to find the best field to match a name against
+        aliases = list()
+        if 'Tags' in list(instance.keys()):
+            for tagDict in instance['Tags']:
+                if tagDict['Key'] == 'Name':
+                    aliases.insert(0, tagDict['Value'])
+                else:
+                    aliases.append(tagDict['Value'])
+
+        # if instance['PublicDnsName']:
+        #     aliases.append(instance['PublicDnsName'])
+        # if instance['PrivateDnsName']:
+        #     aliases.append(instance['PrivateDnsName'])
+        if instance['InstanceId']:
+            aliases.append(instance['InstanceId'])
+
+        # note the region and account this instance was found in
+        if origin:
+            aliases.extend(origin)
+
+        aliases[:] = [x for x in aliases if x != None]
+        name = aliases.pop(0) + " " +  instance['InstanceId']
+
+        # take note of this instance
+        if name != None and address != None:
+            if len(aliases) > 0:
+                return Instance(name, address, tuple(aliases), self.name, None, InstanceType.VM)
+            else:
+                return Instance(name, address, None, self.name, None, InstanceType.VM)
+        return None
+
+    def ec2_filters(self):
+        """
+        Filters applied by EC2 itself, so instances that would be discarded
+        anyway are never downloaded, cached or read.
+        """
         filters = []
-        if value:
-            filters.append({
-                'Name': 'tag:' + tag,
-                'Values': [value]
-            })
-
-        if stub:
-            self.pill.playback()
-            data = self.client.describe_instances(Filters=filters)
+        if self.instance_states:
+            filters.append({'Name': 'instance-state-name', 'Values': list(self.instance_states)})
+
+        for key, values in sorted(self.tag_filters.items()):
+            if not isinstance(values, (list, tuple)):
+                values = [values]
+            filters.append({'Name': 'tag:' + key, 'Values': [str(value) for value in values]})
+
+        if self.vpc_ids:
+            filters.append({'Name': 'vpc-id', 'Values': list(self.vpc_ids)})
+
+        if self.subnet_ids:
+            filters.append({'Name': 'subnet-id', 'Values': list(self.subnet_ids)})
+
+        prefix = self.include_prefix()
+        if prefix:
+            filters.append({'Name': 'tag-value', 'Values': [prefix + '*']})
+
+        return filters
+
+    def include_prefix(self):
+        """
+        The include_pattern is matched against the name, address and every alias
+        of an instance. It can only be pushed down to EC2 (as a tag value prefix)
+        when it is anchored to a literal prefix that cannot also match the
+        instance id, the address or the region/account aliases (when enabled).
+        """
+        if not self.include_pattern:
+            return None
+
+        prefix = literal_prefix(self.include_pattern)
+        if not prefix:
+            return None
+
+        if prefix[0].isdigit():
+            return None
+
+        for reserved in ['i-', 'ec2-'] + list(self.regions) + [self.region or '']:
+            if reserved and (prefix.startswith(reserved) or reserved.startswith(prefix)):
+                return None
+
+        return prefix
+
+    def __ec2_update(self):
+        with self.cache_writer() as cache:
+            if not self.fan_out:
+                self._ingest(cache, self.client)
+            else:
+                self._ingest_targets(cache)
+
+        # drop any cache recorded by earlier versions of bridgy
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('ec2.DescribeInstances_'):
+                os.remove(os.path.join(self.cache_dir, name))
+
+    def _ingest(self, cache, client, origin=None):
+        paginator = client.get_paginator('describe_instances')
+        pages = paginator.paginate(Filters=self.ec2_filters(), PaginationConfig={'PageSize': PAGE_SIZE})
+
+        # each page is normalized and written out as soon as it arrives, so only
+        # a single page of the raw response is held in memory at a time
+        for page in pages:
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    normalized = self._normalize(instance, origin)
+                    if normalized != None:
+                        cache.write(normalized)
+
+    def _ingest_targets(self, cache):
+        targets = self.targets()
+        pool = ThreadPool(processes=max(1, min(self.update_workers, len(targets))))
+
+        failed = []
+        try:
+            results = [(target, pool.apply_async(self._ingest_target, (cache,) + target)) for target in targets]
+            for (role, region), result in results:
+                try:
+                    result.get()
+                except Exception as ex:
+                    failed.append("%s in %s (%s)" % (role or 'default account', region, ex))
+        finally:
+            pool.terminate()
+
+        # a partial inventory would silently hide hosts, keep the previous one instead
+        if len(failed) > 0:
+            raise RuntimeError("Unable to query %s" % ", ".join(failed))
+
+    def _ingest_target(self, cache, role, region):
+        client, account = self._target_client(role, region)
+        self._ingest(cache, client, origin=(region, account) if self.origin_aliases else None)
+
+    def _target_client(self, role, region):
+        import boto3
+
+        # sessions are not thread safe, each target gets its own
+        session = boto3.Session(region_name=region, **self.session_kwargs)
+
+        if role:
+            credentials = session.client('sts').assume_role(RoleArn=role, RoleSessionName='bridgy')['Credentials']
+            session = boto3.Session(aws_access_key_id=credentials['AccessKeyId'],
+                                    aws_secret_access_key=credentials['SecretAccessKey'],
+                                    aws_session_token=credentials['SessionToken'],
+                                    region_name=region)
+            # arn:aws:iam::<account>:role/<name>
+            account = role.split(':')[4]
+        elif self.origin_aliases:
+            account = self._account(session)
         else:
-            # clear cache before updating
-            shutil.rmtree(self.cache_dir)
-            os.makedirs(self.cache_dir, mode=0o755)
+            account = None
+
+        return session.client('ec2'), account
+
+    def _account(self, session):
+        # the same account for every region, only looked up once
+        with self._caller_account_lock:
+            if self._caller_account == None:
+                self._caller_account = session.client('sts').get_caller_identity()['Account']
+        return self._caller_account
 
-            # update
-            self.pill.record()
-            data = self.client.describe_instances(Filters=filters)
+    def __ec2_search(self):
+        self.pill.playback()
+        try:
+            return self.client.describe_instances()
+        finally:
             self.pill.stop()
-        return data
+
+
+def literal_prefix(pattern):
+    """
+    Returns the literal text a regex must start with when it is anchored
+    (e.g. '^prod-.*' -> 'prod-'), otherwise None.
+    """
+    if not pattern.startswith('^') or '|' in pattern:
+        return None
+
+    prefix = ''
+    for char in pattern[1:]:
+        if char in REGEX_SPECIAL:
+            # a quantifier makes the preceding character optional
+            if char in '*?{':
+                prefix = prefix[:-1]
+            break
+        prefix += char
+
+    return prefix or None
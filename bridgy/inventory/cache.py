@@ -0,0 +1,265 @@
+import os
+import time
+import heapq
+import shutil
+import logging
+import tempfile
+import threading
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import fcntl
+except ImportError:
+    # no cross process locking on windows
+    fcntl = None
+
+from bridgy.error import UpdateCancelled
+from bridgy.inventory.store import write_store, InstanceStore
+
+logger = logging.getLogger()
+
+CACHE_VERSION = 2
+CACHE_FILE = 'instances.cache'
+INDEX_FILE = 'search.index'
+CURRENT = 'current'
+KEEP_GENERATIONS = 2
+# rows held in memory before a sorted chunk of them is spilled to disk
+SPILL_ROWS = 10000
+
+
+def _sort_key(row):
+    name, address, aliases, source, container_id, type = row
+    return (name or '', address or '', container_id or '')
+
+
+class InstanceCacheWriter(object):
+    """
+    Collects normalized instances and publishes them as a sorted cache file.
+    The previous cache is only replaced once every instance has been written
+    successfully. Instances rejected by the predicate are never written.
+    """
+
+    def __init__(self, path, meta=None, predicate=None, publish=None, discard=None, spill_rows=SPILL_ROWS, cancel=None):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.meta = meta or {}
+        self.predicate = predicate
+        # called once the cache has been written / when writing it failed
+        self.publish = publish
+        self.discard = discard
+        # an event set when the update is no longer wanted (it timed out)
+        self.cancel = cancel
+        self.count = 0
+        # rows are sorted in bounded chunks, spilled to disk and merged when
+        # the store is written, so memory does not grow with the inventory
+        self.spill_rows = spill_rows
+        self._rows = []
+        self._chunks = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self._close_chunks()
+            if self.discard:
+                self.discard()
+            return
+
+        header = dict(self.meta)
+        header['version'] = CACHE_VERSION
+
+        try:
+            write_store(self.tmp_path, self._sorted_rows(), header)
+            os.rename(self.tmp_path, self.path)
+            if self.publish:
+                self.publish()
+        except BaseException:
+            if os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+            if self.discard:
+                self.discard()
+            raise
+        finally:
+            self._close_chunks()
+
+    def write(self, instance):
+        # stops the source from fetching (and writing) the rest of its inventory
+        if self.cancel != None and self.cancel.is_set():
+            raise UpdateCancelled("Update of %s was cancelled" % self.path)
+
+        if self.predicate and not self.predicate(instance):
+            return
+
+        row = (instance.name, instance.address, instance.aliases, instance.source, instance.container_id, instance.type)
+        with self._lock:
+            self._rows.append(row)
+            self.count += 1
+            if len(self._rows) >= self.spill_rows:
+                self._spill()
+
+    def write_all(self, instances):
+        for instance in instances:
+            self.write(instance)
+
+    def _spill(self):
+        self._rows.sort(key=_sort_key)
+        chunk = tempfile.TemporaryFile(dir=os.path.dirname(self.path) or None)
+        for row in self._rows:
+            pickle.dump(row, chunk, pickle.HIGHEST_PROTOCOL)
+        chunk.seek(0)
+        self._chunks.append(chunk)
+        self._rows = []
+
+    def _sorted_rows(self):
+        if len(self._chunks) == 0:
+            self._rows.sort(key=_sort_key)
+            return iter(self._rows)
+
+        if len(self._rows) > 0:
+            self._spill()
+
+        # the chunk and position break ties, rows themselves may not be comparable
+        decorated = [((_sort_key(row), idx, position, row) for position, row in enumerate(_read_chunk(chunk)))
+                     for idx, chunk in enumerate(self._chunks)]
+        return (row for _, _, _, row in heapq.merge(*decorated))
+
+    def _close_chunks(self):
+        for chunk in self._chunks:
+            chunk.close()
+        self._chunks = []
+        self._rows = []
+
+
+def _read_chunk(chunk):
+    while True:
+        try:
+            yield pickle.load(chunk)
+        except EOFError:
+            return
+
+
+def _replace(src, dst):
+    # atomic on posix, os.rename refuses to replace files on windows
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        os.rename(src, dst)
+
+
+class CacheGenerations(object):
+    """
+    Every update of a source writes its cache (and search index) into a new
+    generation directory under root. A generation is published by atomically
+    replacing the 'current' pointer file, so readers only ever see complete
+    generations and keep using the previous one until the swap. The previous
+    generation is kept around for readers that were still opening it.
+    """
+
+    def __init__(self, root, keep=KEEP_GENERATIONS):
+        self.root = root
+        self.keep = keep
+
+    def current(self):
+        try:
+            with open(os.path.join(self.root, CURRENT), 'r') as pointer:
+                name = pointer.read().strip()
+        except (IOError, OSError):
+            return None
+
+        if not name:
+            return None
+        return os.path.join(self.root, name)
+
+    def path(self, name):
+        generation = self.current()
+        if generation == None:
+            return None
+        return os.path.join(generation, name)
+
+    def generations(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root) if name.startswith('gen-'))
+
+    def create(self):
+        if os.path.isfile(self.root):
+            # a single file cache written by an earlier version of bridgy
+            os.remove(self.root)
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+        # names sort in the order the generations were created
+        return tempfile.mkdtemp(prefix='gen-%015d-' % int(time.time() * 1000), dir=self.root)
+
+    def publish(self, generation):
+        previous = self.current()
+        tmp_pointer = os.path.join(self.root, '%s.%d.tmp' % (CURRENT, os.getpid()))
+        with open(tmp_pointer, 'w') as pointer:
+            pointer.write(os.path.basename(generation))
+        _replace(tmp_pointer, os.path.join(self.root, CURRENT))
+
+        self.prune(os.path.basename(generation), previous and os.path.basename(previous))
+
+    def discard(self, generation):
+        shutil.rmtree(generation, ignore_errors=True)
+
+    def prune(self, published, previous=None):
+        """
+        Removes the generations older than the published one, except for the
+        previously published generation (when keeping more than one). This
+        includes generations whose writer was interrupted before publishing.
+        Newer generations may still be written and are left alone.
+        """
+        for name in self.generations():
+            if name >= published or (name == previous and self.keep > 1):
+                continue
+            shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+
+class UpdateLock(object):
+    """
+    An exclusive lock shared by every bridgy process (flock on a file next to
+    the cache), held while a source is being updated.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self, blocking=True):
+        if fcntl == None:
+            return True
+
+        self._file = open(self.path, 'a')
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+
+        try:
+            fcntl.flock(self._file.fileno(), flags)
+        except (IOError, OSError):
+            self._file.close()
+            self._file = None
+            return False
+        return True
+
+    def release(self):
+        if self._file != None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+def open_cache(path, source=None):
+    """
+    Opens a cache file written by InstanceCacheWriter as a memory mapped
+    InstanceStore. The source name of every instance can be overridden.
+    """
+    store = InstanceStore(path, source)
+    if store.header.get('version') != CACHE_VERSION:
+        raise ValueError("Unsupported inventory cache version: %s" % repr(store.header.get('version')))
+    return store
@@ -1,12 +1,24 @@
+import io
 import os
 import csv
 import sys
+import gzip
+import hashlib
 import logging
+import collections
 
 from bridgy.inventory.source import InventorySource, Instance, InstanceType
+from bridgy.inventory.cache import open_cache
 
 logger = logging.getLogger()
 
+# files at least this large are parsed without building a dict per row
+STREAM_PARSE_SIZE = 1024 * 1024
+# block size used to digest the parsed content before only parsing what was appended
+DIGEST_BLOCK_SIZE = 1024 * 1024
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
 class CsvInventory(InventorySource):
 
     name = 'csv'
@@ -20,17 +32,198 @@ class CsvInventory(InventorySource):
         self.csv_path = path
         self.fields = [f.strip() for f in fields.split(",")]
         self.delimiter = delimiter.strip()
+        self.cache_root = os.path.join(os.path.dirname(path), '.%s.cache' % os.path.basename(path))
+
+    def update(self):
+        stat = os.stat(self.csv_path)
+        instances, offset = self._parse()
+        self._write_cache(instances, stat, offset)
 
-    def update(self): pass
+    def cache_is_current(self):
+        # the cache describes the csv (inode, size and mtime) it was parsed from
+        csv_meta = self._cached_csv_meta()
+        stat = self._stat()
+        if csv_meta == None or stat == None:
+            return False
+        return [csv_meta['inode'], csv_meta['size'], csv_meta['mtime']] == [stat.st_ino, stat.st_size, stat.st_mtime]
+
+    def cache_fingerprint(self, generation=None):
+        # the cache is only used while the csv is unchanged
+        fingerprint = super(CsvInventory, self).cache_fingerprint(generation) or []
+        return fingerprint + self._file_fingerprint([self.csv_path])
 
     def instances(self):
-        instances = set()
+        cached = self.read_cache()
+        if cached != None:
+            return cached
+
+        # the csv has been edited since the last update
         try:
-            with open(self.csv_path, 'r') as csv_file:
-                reader = csv.DictReader(csv_file, fieldnames=self.fields, delimiter=self.delimiter)
-                for row in reader:
-                    instances.add(Instance(row['name'].strip(), row['address'].strip(), None, self.name, None, InstanceType.VM))
+            return self.filter(self._load())
         except IOError as ex:
             logger.error("Unable to read inventory: %s" % ex)
             sys.exit(1)
-        return self.filter(list(instances))
+
+    def _load(self):
+        stat = self._stat()
+        if stat == None:
+            return self._parse()[0]
+
+        previous = self._appended_to(stat)
+        if previous != None:
+            store, offset = previous
+            logger.debug("Reading what was appended to %s" % self.csv_path)
+            instances = collections.OrderedDict((instance, None) for instance in store)
+            appended, offset = self._parse(offset)
+            for instance in appended:
+                instances[instance] = None
+            instances = list(instances.keys())
+        else:
+            instances, offset = self._parse()
+
+        try:
+            self._write_cache(instances, stat, offset)
+        except (IOError, OSError) as ex:
+            logger.debug("Unable to cache inventory %s: %s" % (self.name, ex))
+
+        return instances
+
+    def _write_cache(self, instances, stat, offset):
+        csv_meta = {'inode': stat.st_ino,
+                    'size': stat.st_size,
+                    'mtime': stat.st_mtime,
+                    'offset': None,
+                    'digest': None}
+
+        # only content ending with a complete line can be appended to
+        if offset != None:
+            digest, last = self._digest(offset)
+            if offset == 0 or last == b'\n':
+                csv_meta['offset'] = offset
+                csv_meta['digest'] = digest
+
+        with self.cache_writer(meta={'csv': csv_meta}) as cache:
+            cache.write_all(instances)
+
+    def _cached_csv_meta(self):
+        path = self.cache_path
+        if path == None:
+            return None
+        try:
+            return open_cache(path).header.get('csv')
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _appended_to(self, stat):
+        """
+        Returns the cached instances and the offset parsing stopped at when
+        the csv has only been appended to since it was cached, or None.
+        """
+        path = self.cache_path
+        if path == None:
+            return None
+        try:
+            store = open_cache(path, self.name)
+        except (IOError, OSError, ValueError):
+            return None
+
+        csv_meta = store.header.get('csv')
+        if csv_meta == None or csv_meta['offset'] == None:
+            return None
+        if not self.cache_filtered(store.header):
+            return None
+        if csv_meta['inode'] != stat.st_ino or stat.st_size < csv_meta['offset']:
+            return None
+        # an edit anywhere in what was parsed before means parsing it all again
+        if csv_meta.get('digest') == None or self._digest(csv_meta['offset'])[0] != csv_meta['digest']:
+            return None
+
+        return store, csv_meta['offset']
+
+    def _digest(self, offset):
+        """
+        Returns the sha1 of the first offset bytes of the csv and the last of
+        those bytes.
+        """
+        digest = hashlib.sha1()
+        block = b''
+        with open(self.csv_path, 'rb') as csv_file:
+            remaining = offset
+            while remaining > 0:
+                block = csv_file.read(min(remaining, DIGEST_BLOCK_SIZE))
+                if len(block) == 0:
+                    break
+                digest.update(block)
+                remaining -= len(block)
+        return digest.hexdigest(), block[-1:]
+
+    def _stat(self):
+        try:
+            return os.stat(self.csv_path)
+        except OSError:
+            return None
+
+    def _open(self):
+        """
+        Opens the csv as text, transparently decompressing gzip and zstd files.
+        Returns the file and whether it is compressed.
+        """
+        with open(self.csv_path, 'rb') as csv_file:
+            magic = csv_file.read(4)
+
+        if magic[:2] == GZIP_MAGIC:
+            return io.TextIOWrapper(gzip.open(self.csv_path, 'rb')), True
+
+        if magic == ZSTD_MAGIC:
+            try:
+                import zstandard
+            except ImportError:
+                raise IOError("Install the zstandard package to read %s" % self.csv_path)
+            reader = zstandard.ZstdDecompressor().stream_reader(open(self.csv_path, 'rb'), closefd=True)
+            return io.TextIOWrapper(reader), True
+
+        return open(self.csv_path, 'r'), False
+
+    def _parse(self, offset=0):
+        """
+        Parses the csv (from offset on) and returns the distinct instances and
+        the offset parsing stopped at (None for compressed files).
+        """
+        instances = collections.OrderedDict()
+        csv_file, compressed = self._open()
+        with csv_file:
+            if offset and not compressed:
+                csv_file.seek(offset)
+
+            stat = self._stat()
+            if stat != None and stat.st_size >= STREAM_PARSE_SIZE:
+                rows = self._stream_rows(csv_file)
+            else:
+                rows = ((row['name'], row['address']) for row in
+                        csv.DictReader(csv_file, fieldnames=self.fields, delimiter=self.delimiter))
+
+            skipped = 0
+            for name, address in rows:
+                if name is None or address is None:
+                    skipped += 1
+                    continue
+                instance = Instance(name.strip(), address.strip(), None, self.name, None, InstanceType.VM)
+                instances[instance] = None
+
+            end = None if compressed else csv_file.tell()
+
+        if skipped > 0:
+            logger.warn("Skipped %d rows of %s without a name and address" % (skipped, self.csv_path))
+        return list(instances.keys()), end
+
+    def _stream_rows(self, csv_file):
+        name_idx = self.fields.index('name')
+        address_idx = self.fields.index('address')
+        needed = max(name_idx, address_idx)
+
+        # short rows are yielded as (None, None), like DictReader fills in missing fields
+        for row in csv.reader(csv_file, delimiter=self.delimiter):
+            if len(row) > needed:
+                yield row[name_idx], row[address_idx]
+            elif len(row) > 0:
+                yield None, None
@@ -0,0 +1,206 @@
+import collections
+
+from bridgy.utils import memoize
+from bridgy.inventory.index import GRAM_SIZE, ngrams
+
+THRESHOLD = 85
+
+
+def _rapidfuzz_backend():
+    from rapidfuzz import fuzz, process
+
+    def extract(term, names, threshold):
+        matches = process.extract(term, names, scorer=fuzz.partial_ratio,
+                                  score_cutoff=threshold, limit=None)
+        return [(int(round(score)), idx) for _, score, idx in matches]
+
+    return extract
+
+
+def _python_backend(pruned=True, ratio=None):
+    # every backend scores like rapidfuzz' partial_ratio, so a search matches
+    # the same names no matter what is installed
+
+    def extract(term, names, threshold):
+        term_chars = collections.Counter(term).items()
+        matches = []
+
+        for idx, name in enumerate(names):
+            if pruned and not could_match(term, term_chars, name, threshold):
+                continue
+            score = partial_ratio(term, name, ratio)
+            if score >= threshold:
+                matches.append((int(round(score)), idx))
+
+        return matches
+
+    return extract
+
+
+def _levenshtein_backend():
+    # the normalized indel similarity, in C
+    from Levenshtein import ratio
+    return _python_backend(ratio=lambda needle, block, window: 100.0 * ratio(needle, window))
+
+
+def _lcs_ratio(needle, block, window):
+    # bit parallel longest common subsequence, block maps each character of
+    # the needle to the bits of the positions it is found at
+    bits = mask = (1 << len(needle)) - 1
+    for char in window:
+        matches = bits & block.get(char, 0)
+        bits = (bits + matches) | (bits - matches)
+    common = len(needle) - bin(bits & mask).count('1')
+    return 200.0 * common / (len(needle) + len(window))
+
+
+def _aligned_ratio(needle, text, ratio):
+    if needle in text:
+        return 100.0
+
+    block = {}
+    for idx, char in enumerate(needle):
+        block[char] = block.get(char, 0) | (1 << idx)
+
+    # every window of the needle's length as well as the shorter ones at
+    # either end of the text, skipping those that end (or start) with a
+    # character the needle does not have
+    length = len(needle)
+    windows = [text[:idx] for idx in range(1, length) if text[idx - 1] in block]
+    windows += [text[idx:idx + length] for idx in range(len(text) - length) if text[idx + length - 1] in block]
+    windows += [text[idx:] for idx in range(len(text) - length, len(text)) if text[idx] in block]
+
+    best = 0.0
+    for window in windows:
+        best = max(best, ratio(needle, block, window))
+    return best
+
+
+def partial_ratio(first, second, ratio=None):
+    """
+    The best ratio between the shorter string and any substring of the longer
+    string of the same length (or shorter, at either end), the same score as
+    rapidfuzz' partial_ratio.
+    """
+    ratio = ratio or _lcs_ratio
+    if not first or not second:
+        return 100.0 if first == second else 0.0
+
+    if len(first) <= len(second):
+        score = _aligned_ratio(first, second, ratio)
+    else:
+        score = _aligned_ratio(second, first, ratio)
+
+    if score < 100 and len(first) == len(second):
+        score = max(score, _aligned_ratio(second, first, ratio))
+    return score
+
+
+def could_match(term, term_chars, name, threshold):
+    """
+    Cheap upper bound on the partial ratio between two strings. The best
+    alignment of the shorter string (length m) can match at most the number
+    of characters both strings share (c), which bounds the score at
+    200 * c / (m + c).
+    """
+    if term in name:
+        return True
+
+    length = min(len(term), len(name))
+    if length == 0:
+        return False
+
+    common = 0
+    for char, count in term_chars:
+        common += min(count, name.count(char))
+    common = min(common, length)
+
+    return 200.0 * common / (length + common) >= threshold
+
+
+def min_shared_grams(term, threshold, size=GRAM_SIZE):
+    """
+    The number of distinct grams a name (at least as long as the term) has to
+    share with the term to reach the threshold. The term is aligned to a
+    window of at most its own length, the l characters they have in common
+    keep at least l - size + 1 of the term's gram positions intact, less
+    size - 1 for every character of either one that is left out.
+    """
+    length = len(term)
+    positions = length - size + 1
+    if positions <= 0:
+        return 0
+
+    intact = positions
+    for window in range(1, length + 1):
+        for common in range(1, window + 1):
+            if 200 * common < threshold * (length + window):
+                continue
+            intact = min(intact, common - size + 1 - (size - 1) * (length + window - 2 * common))
+            break
+
+    return len(ngrams(term, size)) - (positions - max(intact, 0))
+
+
+def _detect_backend():
+    try:
+        import rapidfuzz
+        return 'rapidfuzz'
+    except ImportError:
+        pass
+
+    try:
+        import Levenshtein
+        return 'levenshtein'
+    except ImportError:
+        pass
+
+    return 'python'
+
+BACKENDS = {
+    'rapidfuzz': _rapidfuzz_backend,
+    'levenshtein': _levenshtein_backend,
+    'python': _python_backend,
+}
+
+
+class FuzzyScorer(object):
+    """
+    Scores a search term against a batch of candidate names at once, returning
+    only the candidates that score above the threshold or contain the term.
+    """
+
+    def __init__(self, threshold=THRESHOLD, backend=None):
+        self.threshold = threshold
+        self.backend = backend or _detect_backend()
+
+        if self.backend not in BACKENDS:
+            raise RuntimeError("Unsupported fuzzy search backend: %s" % repr(self.backend))
+
+        self._extract = BACKENDS[self.backend]()
+
+    def extract(self, term, names):
+        if not term:
+            return []
+
+        matches = []
+        for score, idx in self._extract(term, names, self.threshold):
+            if score > self.threshold or term in names[idx]:
+                matches.append((score, idx))
+        return matches
+
+    def search(self, term, index):
+        """
+        Scores the keys of a search index. Keys that share too few grams with
+        the term to reach the threshold are never scored.
+        """
+        if not term:
+            return []
+
+        key_ids = index.sharing(term, min_shared_grams(term, self.threshold))
+        names = [index.keys[key_id] for key_id in key_ids]
+        return [(score, key_ids[idx]) for score, idx in self.extract(term, names)]
+
+@memoize
+def scorer():
+    return FuzzyScorer()
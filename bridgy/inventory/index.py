@@ -0,0 +1,281 @@
+import os
+import array
+import logging
+import collections
+
+from bridgy.inventory.store import MappedSections, write_sections
+
+logger = logging.getLogger()
+
+MAGIC = b'BRDYIDX1'
+GRAM_SIZE = 3
+INDEX_VERSION = 3
+# an exact match, no (fuzzy) match scores higher
+BEST_SCORE = 100
+# a name containing the term, fuzzy matches never score higher either
+PARTIAL_SCORE = BEST_SCORE - 1
+# posting lists this many times longer than the candidates left are not read
+SKIP_RATIO = 16
+
+
+# (section name, array typecode)
+SECTIONS = (
+    ('key_offsets', 'I'),
+    ('key_data', 'B'),
+    ('key_lengths', 'I'),
+    ('owner_offsets', 'I'),
+    ('owners', 'I'),
+    ('gram_offsets', 'I'),
+    ('gram_data', 'B'),
+    ('posting_offsets', 'I'),
+    ('postings', 'I'),
+)
+
+
+def ngrams(text, size=GRAM_SIZE):
+    return set(text[idx:idx+size] for idx in range(len(text) - size + 1))
+
+
+class _Ranges(object):
+    # values[offsets[idx]:offsets[idx + 1]], sliced out of the memory map
+
+    def __init__(self, offsets, values, typecode):
+        self.offsets = offsets
+        self.values = values
+        self.typecode = typecode
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        chunk = self.values[self.offsets[idx]:self.offsets[idx + 1]]
+        if isinstance(chunk, bytes):
+            # read without memoryview.cast
+            chunk = array.array(self.typecode, chunk)
+        return chunk
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+class _Strings(_Ranges):
+
+    def __init__(self, offsets, data):
+        super(_Strings, self).__init__(offsets, data, 'B')
+
+    def raw(self, idx):
+        return bytes(self.values[self.offsets[idx]:self.offsets[idx + 1]])
+
+    def __getitem__(self, idx):
+        return self.raw(idx).decode('utf-8')
+
+
+class _GramTable(object):
+    """
+    The sorted gram table of a persisted index. Grams are found by binary
+    search and only the posting lists that are asked for are read.
+    """
+
+    def __init__(self, grams, postings):
+        self.grams = grams
+        self.postings = postings
+
+    def __len__(self):
+        return len(self.grams)
+
+    def get(self, gram, default=None):
+        target = gram.encode('utf-8')
+        low, high = 0, len(self.grams)
+        while low < high:
+            middle = (low + high) // 2
+            if self.grams.raw(middle) < target:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < len(self.grams) and self.grams.raw(low) == target:
+            return self.postings[low]
+        return default
+
+
+def _packed(lists, typecode):
+    offsets = array.array('I', [0])
+    values = array.array(typecode)
+    for values_list in lists:
+        values.extend(values_list)
+        offsets.append(len(values))
+    return offsets, values
+
+
+class SearchIndex(object):
+    """
+    An inverted trigram index over the (lowercased) names and aliases of
+    an inventory source. Each distinct name is stored once as a 'key', keys
+    map back to the position(s) of the instances that carry it and every
+    trigram maps to the keys that contain it.
+
+    A packed (or loaded) index reads its keys, owners and posting lists in
+    place from arrays (or a memory map) rather than holding a python list
+    per key and gram.
+    """
+
+    def __init__(self, keys, owners, postings, meta=None, lengths=None):
+        self.keys = keys
+        self.owners = owners
+        self.postings = postings
+        self.meta = meta or {}
+        # in characters, keys are stored encoded
+        self.lengths = lengths if lengths != None else [len(key) for key in keys]
+        self.columns = None
+
+    @classmethod
+    def build(cls, instances, meta=None):
+        rows = ([instance.name] + list(instance.aliases or ()) for instance in instances)
+        return cls.build_from_names(rows, meta)
+
+    @classmethod
+    def build_from_names(cls, rows, meta=None):
+        """
+        Builds the index from the searchable names (name + aliases) of each
+        instance, given in instance order.
+        """
+        key_ids = {}
+        keys = []
+        owners = []
+
+        for position, names in enumerate(rows):
+            for name in names:
+                if name is None:
+                    continue
+                key = name.lower()
+                key_id = key_ids.get(key)
+                if key_id is None:
+                    key_id = key_ids[key] = len(keys)
+                    keys.append(key)
+                    owners.append([])
+                # positions only grow, so only the last entry can be a duplicate
+                if not owners[key_id] or owners[key_id][-1] != position:
+                    owners[key_id].append(position)
+
+        postings = {}
+        for key_id, key in enumerate(keys):
+            for gram in ngrams(key):
+                postings.setdefault(gram, []).append(key_id)
+
+        return cls(keys, owners, postings, meta)
+
+    @classmethod
+    def from_columns(cls, columns, meta=None):
+        index = cls(_Strings(columns['key_offsets'], columns['key_data']),
+                    _Ranges(columns['owner_offsets'], columns['owners'], 'I'),
+                    _GramTable(_Strings(columns['gram_offsets'], columns['gram_data']),
+                               _Ranges(columns['posting_offsets'], columns['postings'], 'I')),
+                    meta, columns['key_lengths'])
+        index.columns = columns
+        return index
+
+    @classmethod
+    def load(cls, path):
+        mapped = MappedSections(path, MAGIC)
+        if mapped.header.get('index_version') != INDEX_VERSION:
+            raise ValueError("Unsupported search index: %s" % path)
+
+        columns = dict((name, mapped.column(name, typecode)) for name, typecode in SECTIONS)
+        index = cls.from_columns(columns, mapped.header['meta'])
+        index._mapped = mapped
+        return index
+
+    def pack(self):
+        """
+        Returns the index with its keys, owners and posting lists packed into
+        arrays, in the layout it is saved in.
+        """
+        if self.columns != None:
+            return self
+
+        # grams are sorted by their encoded form, the order they are searched in
+        grams = sorted(self.postings, key=lambda gram: gram.encode('utf-8'))
+
+        columns = {}
+        columns['key_offsets'], columns['key_data'] = _packed((key.encode('utf-8') for key in self.keys), 'B')
+        columns['key_lengths'] = array.array('I', self.lengths)
+        columns['owner_offsets'], columns['owners'] = _packed(self.owners, 'I')
+        columns['gram_offsets'], columns['gram_data'] = _packed((gram.encode('utf-8') for gram in grams), 'B')
+        columns['posting_offsets'], columns['postings'] = _packed((self.postings[gram] for gram in grams), 'I')
+        return self.from_columns(columns, self.meta)
+
+    def save(self, path):
+        write_sections(path, MAGIC, {'index_version': INDEX_VERSION, 'meta': self.meta}, SECTIONS, self.pack().columns)
+
+    def candidates(self, term):
+        grams = ngrams(term)
+
+        # too short to make use of the index, every key is a candidate
+        if len(grams) == 0:
+            return range(len(self.keys))
+
+        # the length of a posting list is known without reading it
+        posting_lists = sorted([self.postings.get(gram, ()) for gram in grams], key=len)
+        matched = set(posting_lists[0])
+        for posting_list in posting_lists[1:]:
+            # the keys are compared to the term anyway, checking a few more is
+            # cheaper than reading a long posting list
+            if len(matched) * SKIP_RATIO < len(posting_list):
+                break
+            matched.intersection_update(posting_list)
+
+        return sorted(matched)
+
+    def sharing(self, term, count):
+        """
+        Returns the ids of the keys that share at least count (distinct) grams
+        with the term. Keys shorter than the term are always included, the
+        term may contain them instead.
+        """
+        if count <= 0:
+            return range(len(self.keys))
+
+        shared = collections.Counter()
+        for gram in ngrams(term):
+            shared.update(self.postings.get(gram, ()))
+
+        matched = set(key_id for key_id, found in shared.items() if found >= count)
+        matched.update(self._shorter(len(term)))
+        return sorted(matched)
+
+    def _shorter(self, length):
+        return [key_id for key_id, key_length in enumerate(self.lengths) if key_length < length]
+
+    def lookup(self, term, partial=True):
+        """
+        Yield (score, position) for every instance with a name or alias that
+        equals (100) or contains (99) the given lowercased term.
+        """
+        for key_id in self.candidates(term):
+            key = self.keys[key_id]
+            if term == key:
+                score = BEST_SCORE
+            elif partial and term in key:
+                score = PARTIAL_SCORE
+            else:
+                continue
+
+            for position in self.owners[key_id]:
+                yield score, position
+
+
+def load_index(path, meta):
+    if not path or not os.path.exists(path):
+        return None
+
+    try:
+        index = SearchIndex.load(path)
+    except (IOError, OSError, ValueError, KeyError) as ex:
+        logger.debug("Ignoring unreadable search index (%s): %s" % (path, ex))
+        return None
+
+    if index.meta != meta:
+        return None
+
+    return index
@@ -1,6 +1,10 @@
 import os
 import json
-import requests
+import time
+import logging
+import operator
+import collections
+from multiprocessing.pool import ThreadPool
 try:
     from urllib.parse import quote_plus
 except ImportError:
@@ -9,6 +13,28 @@ except ImportError:
 from bridgy.inventory.source import InventorySource, Instance, InstanceType
 from bridgy.utils import parseIpFromHostname
 
+logger = logging.getLogger()
+
+# queries return one (faceted) row per host or container rather than every
+# sample, insights caps facets at 5000 (LIMIT MAX). A page with that many
+# facets is split in two on its first facet (hostname or container name),
+# around the middle name it returned, and both halves are queried again.
+QUERY_LIMIT = 5000
+# seconds, the same window NRQL uses when there is no SINCE clause
+QUERY_WINDOW = 3600
+QUERY_WORKERS = 4
+QUERY_TIMEOUT = 60
+
+# lower and upper bound the first facet as (operator, name) pairs, or None
+# when unbounded. A page without a lower bound also returns unnamed facets.
+Page = collections.namedtuple("Page", "type nrql facets where since until lower upper")
+
+COMPARE = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+
+
+def _quote(value):
+    return "'%s'" % value.replace('\\', '\\\\').replace("'", "\\'")
+
 class NewRelicInventory(InventorySource):
 
     name = 'newrelic'
@@ -23,53 +49,167 @@ class NewRelicInventory(InventorySource):
         self.account_number = account_number
         self.insights_query_api_key = insights_query_api_key
         self.data_file = os.path.join(data_path, '%s.json' % str(account_number))
-        self.queryVms = quote_plus("SELECT entityName, fullHostname, hostname, ipV4Address from NetworkSample LIMIT 999")
-        self.queryContainers = quote_plus("SELECT containerName, containerId, hostname FROM ProcessSample WHERE containerName IS NOT NULL LIMIT 999")
+        self.cache_root = os.path.join(data_path, '%s.cache' % str(account_number))
+        self.queryVms = "SELECT count(*) FROM NetworkSample{where} FACET {facets} SINCE {since} UNTIL {until} LIMIT MAX"
+        self.queryContainers = "SELECT count(*) FROM ProcessSample{where} FACET {facets} SINCE {since} UNTIL {until} LIMIT MAX"
+        self.query_window = kwargs.get('query_window', QUERY_WINDOW)
+        self.query_workers = kwargs.get('query_workers', QUERY_WORKERS)
         if proxies:
             self.proxies = proxies
         else:
             self.proxies = {}
 
     def update(self):
-        headers = {'X-Query-Key': self.insights_query_api_key,
-                   'Accept': 'application/json'}
+        session = self._session()
+        pool = ThreadPool(self.query_workers)
+
+        until = int(time.time() * 1000)
+        since = until - int(self.query_window * 1000)
+        pages = [Page(InstanceType.VM, self.queryVms, ('hostname', 'ipV4Address'), (), since, until, None, None),
+                 Page(InstanceType.ECS, self.queryContainers, ('containerName', 'containerId', 'hostname'),
+                      ('containerName IS NOT NULL',), since, until, None, None)]
+
+        try:
+            with self.cache_writer() as cache:
+                cache.write_all(self._query_all(pool, session, pages))
+        finally:
+            pool.terminate()
+            session.close()
+
+        # drop the raw query results kept by earlier versions of bridgy
+        if os.path.exists(self.data_file):
+            os.remove(self.data_file)
+
+    def _session(self):
+        import requests
+
+        # keep-alive connections shared by all query workers
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.query_workers)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({'X-Query-Key': self.insights_query_api_key,
+                                'Accept': 'application/json'})
+        return session
+
+    def _query_all(self, pool, session, pages):
+        seen = set()
+        pending = collections.deque(pool.apply_async(self._query, (session, page)) for page in pages)
+
+        while len(pending) > 0:
+            page, events = pending.popleft().get()
 
-        responseVms = requests.get(NewRelicInventory.url.format(self.account_number, self.queryVms),
-                                headers=headers,
-                                proxies=self.proxies)
+            if len(events) >= QUERY_LIMIT:
+                halves = self._split(page, events)
+                if halves != None:
+                    for half in halves:
+                        pending.append(pool.apply_async(self._query, (session, half)))
+                    continue
+                logger.warn("More than %d %s instances with the same %s for %s, some instances may be missing" %
+                            (QUERY_LIMIT, page.type, page.facets[0], self.name))
 
-        responseContainers = requests.get(NewRelicInventory.url.format(self.account_number, self.queryContainers),
-                                headers=headers,
-                                proxies=self.proxies)
+            for instance in self._events_to_instances(page.type, events):
+                if instance not in seen:
+                    seen.add(instance)
+                    yield instance
 
-        with open(self.data_file, 'w') as data_file:
-            data_file.write(
-                json.dumps({
-                    InstanceType.VM: json.loads(responseVms.text),
-                    InstanceType.ECS: json.loads(responseContainers.text)
-                })
-            )
+    @staticmethod
+    def _split(page, events):
+        # a steady fleet reports every host in any time window, so the names
+        # are split rather than the window
+        names = sorted(set(event[page.facets[0]] for event in events if event[page.facets[0]] != None))
+        if len(names) > 1:
+            middle = names[len(names) // 2]
+            return page._replace(upper=('<', middle)), page._replace(lower=('>=', middle))
+
+        if len(names) == 1:
+            # set the only name apart from whatever else is in range
+            name = names[0]
+            if page.lower != ('>=', name) or page.upper != ('<=', name):
+                return (page._replace(upper=('<', name)),
+                        page._replace(lower=('>=', name), upper=('<=', name)),
+                        page._replace(lower=('>', name)))
+        return None
+
+    def _query(self, session, page):
+        key = page.facets[0]
+        where = list(page.where)
+        if page.lower != None:
+            where.append("%s %s %s" % (key, page.lower[0], _quote(page.lower[1])))
+        if page.upper != None:
+            if page.lower == None:
+                where.append("(%s %s %s OR %s IS NULL)" % (key, page.upper[0], _quote(page.upper[1]), key))
+            else:
+                where.append("%s %s %s" % (key, page.upper[0], _quote(page.upper[1])))
+
+        nrql = page.nrql.format(where=' WHERE ' + ' AND '.join(where) if where else '',
+                                facets=', '.join(page.facets), since=page.since, until=page.until)
+        response = session.get(NewRelicInventory.url.format(self.account_number, quote_plus(nrql)),
+                               proxies=self.proxies,
+                               timeout=QUERY_TIMEOUT)
+        response.raise_for_status()
+
+        # each facet carries the values of the faceted attributes, in order
+        events = []
+        for facet in json.loads(response.text).get('facets', []):
+            values = facet['name']
+            if not isinstance(values, list):
+                values = [values]
+            event = dict(zip(page.facets, values))
+            # never trust a page to stick to its range, splitting relies on it
+            if self._in_range(page, event[key]):
+                events.append(event)
+        return page, events
+
+    @staticmethod
+    def _in_range(page, name):
+        if name == None:
+            return page.lower == None
+        for bound in (page.lower, page.upper):
+            if bound != None and not COMPARE[bound[0]](name, bound[1]):
+                return False
+        return True
+
+    def cache_fingerprint(self, generation=None):
+        fingerprint = super(NewRelicInventory, self).cache_fingerprint(generation)
+        if fingerprint == None and os.path.exists(self.data_file):
+            return self._file_fingerprint([self.data_file])
+        return fingerprint
 
     def instances(self):
-        instances = set()
+        cached = self.read_cache()
+        if cached != None:
+            return cached
+
+        # fall back to the raw query results kept by earlier versions of bridgy
         with open(self.data_file, 'r') as data_file:
             data = json.load(data_file)
 
-        for results_dict in data[InstanceType.VM]['results']:
-            for event_dict in results_dict['events']:
+        return self.filter(list(self._normalize(data)))
+
+    def _normalize(self, data):
+        seen = set()
+
+        for type in (InstanceType.VM, InstanceType.ECS):
+            for results_dict in data[type]['results']:
+                for instance in self._events_to_instances(type, results_dict['events']):
+                    if instance not in seen:
+                        seen.add(instance)
+                        yield instance
+
+    def _events_to_instances(self, type, events):
+        if type == InstanceType.VM:
+            for event_dict in events:
                 hostname = event_dict['hostname']
                 address = event_dict['ipV4Address'].strip().split("/")[0]
                 if hostname is None:
                     hostname = address
-                instances.add(Instance(hostname, address, None, self.name, None, InstanceType.VM))
-
-        for results_dict in data[InstanceType.ECS]['results']:
-            for event_dict in results_dict['events']:
+                yield Instance(hostname, address, None, self.name, None, InstanceType.VM)
+        else:
+            for event_dict in events:
                 container_name = event_dict['containerName']
                 container_id = event_dict['containerId']
                 hostname = event_dict['hostname']
                 address = parseIpFromHostname(hostname)
 
-                instances.add(Instance(container_name, address, None, self.name, container_id, InstanceType.ECS))
-
-        return self.filter(list(instances))
+                yield Instance(container_name, address, None, self.name, container_id, InstanceType.ECS)
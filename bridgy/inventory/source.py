@@ -1,29 +1,92 @@
+import os
 import re
 import abc
-import warnings
+import time
+import heapq
+import logging
+import threading
+import itertools
 import collections
 from functools import partial
+from multiprocessing.pool import ThreadPool
 
-from bridgy.error import MissingBastionHost
+from bridgy.error import MissingBastionHost, UpdateCancelled
+from bridgy.inventory.index import SearchIndex, INDEX_VERSION, BEST_SCORE, PARTIAL_SCORE, load_index
+from bridgy.inventory.cache import InstanceCacheWriter, CacheGenerations, UpdateLock, open_cache, CACHE_FILE, INDEX_FILE
+from bridgy.inventory.fuzzy import scorer as fuzzy_scorer
 
-with warnings.catch_warnings():
-    # Thiw warns about using the slow implementation of SequenceMatcher
-    # instead of the python-Levenshtein module, which requires compilation.
-    # I'd prefer for users tp simply use this tool without the need to
-    # compile since the search space is probably fairly small
-    warnings.filterwarnings("ignore", category=UserWarning)
-    from fuzzywuzzy import fuzz
+logger = logging.getLogger()
+
+DEFAULT_UPDATE_WORKERS = 8
+DEFAULT_UPDATE_TIMEOUT = 120
+UPDATE_POLL_INTERVAL = 0.05
+# an update published this recently (e.g. by a process started at the same
+# time) is reused instead of updating again
+UPDATE_COALESCE_WINDOW = 5
 
 class InstanceType:
     ALL = 'ALL'
     VM = 'VM'
     ECS = 'ECS'
 
+class CacheState:
+    FRESH = 'FRESH'
+    STALE = 'STALE'
+    EXPIRED = 'EXPIRED'
+
+class UpdateStatus:
+    OK = 'OK'
+    SHARED = 'SHARED'
+    FAILED = 'FAILED'
+    TIMEOUT = 'TIMEOUT'
+
 Bastion = collections.namedtuple("Bastion", "destination options")
+UpdateResult = collections.namedtuple("UpdateResult", "source status elapsed error")
 Instance = collections.namedtuple("Instance", "name address aliases source container_id type")
 # allow there to be optional kwargs that default to None
 Instance.__new__.__defaults__ = (None,) * len(Instance._fields)
 
+class InstanceFilter(object):
+    """
+    Include/exclude pattern pairs, compiled once. An instance is kept when it
+    passes every pair: its name, address or one of its aliases matches the
+    include pattern or, for a pair without one, none of them matches the
+    exclude pattern.
+    """
+
+    def __init__(self, patterns=()):
+        self.patterns = tuple((include, exclude) for include, exclude in patterns if include or exclude)
+        self._includes = [re.compile(include).search for include, _ in self.patterns if include]
+        self._excludes = [re.compile(exclude).search for include, exclude in self.patterns if not include]
+
+    def __bool__(self):
+        return len(self.patterns) > 0
+
+    __nonzero__ = __bool__
+
+    def __call__(self, instance):
+        comparables = (instance.name, instance.address) + (instance.aliases or ())
+
+        for search in self._includes:
+            for value in comparables:
+                if value != None and search(value):
+                    break
+            else:
+                return False
+
+        for search in self._excludes:
+            for value in comparables:
+                if value != None and search(value):
+                    return False
+
+        return True
+
+    def apply(self, instances):
+        if not self.patterns:
+            return iter(instances)
+        return (instance for instance in instances if self(instance))
+
+
 class InventorySource(object):
     __metaclass__ = abc.ABCMeta
 
@@ -33,6 +96,16 @@ class InventorySource(object):
     ssh_options = None
     include_pattern = None
     exclude_pattern = None
+    cache_root = None
+    update_timeout = None
+    # set (a threading.Event) once the caller of an update stopped waiting for it
+    update_cancel = None
+    cache_ttl = None
+    cache_max_age = None
+    # the inventory wide include/exclude patterns (an InstanceFilter)
+    inventory_filter = None
+    _compiled_filter = None
+    _searchable = None
 
     def __init__(self, *args, **kwargs):
         if 'name' in kwargs:
@@ -68,35 +141,35 @@ class InventorySource(object):
             self.include_pattern = kwargs['include_pattern']
         if 'exclude_pattern' in kwargs:
             self.exclude_pattern = kwargs['exclude_pattern']
+        if 'update_timeout' in kwargs:
+            self.update_timeout = kwargs['update_timeout']
+        if 'cache_ttl' in kwargs:
+            self.cache_ttl = kwargs['cache_ttl']
+        if 'cache_max_age' in kwargs:
+            self.cache_max_age = kwargs['cache_max_age']
 
-    def instance_filter(self, instance, include_re=None, exclude_re=None):
-        comparables = [instance.name, instance.address]
-
-        if instance.aliases:
-            comparables.extend(list(instance.aliases))
-
-        if include_re:
-            for name in comparables:
-                if include_re.search(name):
-                    return True
-            return False
-        elif exclude_re:
-            for name in comparables:
-                if exclude_re.search(name):
-                    return False
-            return True
-        else:
-            return True
+    @property
+    def compiled_filter(self):
+        """
+        The source patterns merged with the inventory wide patterns, compiled
+        once (and again only when one of them changes).
+        """
+        patterns = ((self.include_pattern, self.exclude_pattern),)
+        if self.inventory_filter != None:
+            patterns += self.inventory_filter.patterns
+
+        if self._compiled_filter == None or self._compiled_filter[0] != patterns:
+            self._compiled_filter = (patterns, InstanceFilter(patterns))
+        return self._compiled_filter[1]
 
     def filter(self, all_instances):
-        include_re, exclude_re = None, None
-        if self.include_pattern:
-            include_re = re.compile(self.include_pattern)
-        if self.exclude_pattern:
-            exclude_re = re.compile(self.exclude_pattern)
+        return list(self.compiled_filter.apply(all_instances))
 
-        config_instance_filter = partial(self.instance_filter, include_re=include_re, exclude_re=exclude_re)
-        return list(filter(config_instance_filter, all_instances))
+    def cache_filtered(self, header):
+        """
+        True when a cache was built with the current filter patterns.
+        """
+        return header.get('filters') == [list(pair) for pair in self.compiled_filter.patterns]
 
     @abc.abstractmethod
     def update(self): pass
@@ -104,29 +177,285 @@ class InventorySource(object):
     @abc.abstractmethod
     def instances(self, stub=True): pass
 
-    def search(self, targets, partial=True, fuzzy=False):
-        allInstances = self.instances()
-        matchedInstances = set()
+    def shared_update(self):
+        """
+        Updates the source, unless another bridgy process is already updating
+        it (or just did). In that case this waits for it and reuses its
+        result. Returns False when the result of another process was reused.
+        """
+        if self.cache_root == None:
+            self.update()
+            return True
+
+        lock = UpdateLock(self.cache_root + '.lock')
+        before = self.cache_generation()
+
+        if not lock.acquire(blocking=False):
+            logger.debug("Waiting for another process to update %s" % self.name)
+            lock.acquire()
+            if self.cache_generation() != before:
+                lock.release()
+                return False
+            # the other update failed, try again
+
+        try:
+            age = self.cache_age()
+            if age != None and age < UPDATE_COALESCE_WINDOW:
+                return False
+            self.update()
+        finally:
+            lock.release()
+        return True
+
+    def generations(self):
+        if self.cache_root == None:
+            return None
+        return CacheGenerations(self.cache_root)
+
+    def cache_generation(self):
+        """
+        The directory of the currently published cache generation (or None).
+        """
+        if self.cache_root == None:
+            return None
+        return self.generations().current()
+
+    @property
+    def cache_path(self):
+        generation = self.cache_generation()
+        if generation == None:
+            return None
+        return os.path.join(generation, CACHE_FILE)
+
+    @property
+    def index_path(self):
+        generation = self.cache_generation()
+        if generation == None:
+            return None
+        return os.path.join(generation, INDEX_FILE)
+
+    def cache_writer(self, meta=None):
+        """
+        Instances written through the cache writer are filtered by the source
+        patterns and sorted, then published together with their search index
+        as a new cache generation.
+        """
+        generations = self.generations()
+        generation = generations.create()
+
+        def publish():
+            # an update that timed out must not replace the cache after the fact
+            if self.update_cancel != None and self.update_cancel.is_set():
+                raise UpdateCancelled("Update of %s was cancelled" % self.name)
+            self.save_index(generation)
+            generations.publish(generation)
+
+        instance_filter = self.compiled_filter
+        meta = dict(meta or {})
+        meta['filters'] = [list(pair) for pair in instance_filter.patterns]
+        return InstanceCacheWriter(os.path.join(generation, CACHE_FILE), meta, instance_filter,
+                                   publish=publish, discard=partial(generations.discard, generation),
+                                   cancel=self.update_cancel)
+
+    def has_cache(self):
+        path = self.cache_path
+        return path != None and os.path.exists(path)
+
+    def cache_is_current(self):
+        return self.has_cache()
+
+    def cache_age(self):
+        try:
+            return time.time() - os.path.getmtime(self.cache_path)
+        except (TypeError, OSError):
+            return None
+
+    def cache_state(self):
+        """
+        A cache older than cache_ttl is STALE (still usable, but should be
+        refreshed), one older than cache_max_age (or missing) is EXPIRED.
+        """
+        if self.cache_ttl == None and self.cache_max_age == None:
+            return CacheState.FRESH
+
+        age = self.cache_age()
+        if age == None or (self.cache_max_age != None and age > self.cache_max_age):
+            return CacheState.EXPIRED
+        if self.cache_ttl != None and age > self.cache_ttl:
+            return CacheState.STALE
+        return CacheState.FRESH
+
+    def cached_instances(self, generation=None):
+        """
+        Returns the cached instances (of the given or current generation) as a
+        memory mapped sequence that only creates Instance objects for the rows
+        that are accessed, or None when there is no usable cache.
+        """
+        if not self.cache_is_current():
+            return None
+
+        generation = generation or self.cache_generation()
+        if generation == None:
+            return None
+
+        path = os.path.join(generation, CACHE_FILE)
+        try:
+            store = open_cache(path, self.name)
+        except (IOError, OSError, ValueError) as ex:
+            logger.debug("Ignoring unreadable inventory cache (%s): %s" % (path, ex))
+            return None
+
+        if not self.cache_filtered(store.header):
+            logger.warn("Inventory filters for %s changed since the last update, run 'bridgy update'" % self.name)
+            return self.filter(store)
+
+        return store
+
+    def read_cache(self):
+        instances = self.cached_instances()
+        if instances == None:
+            return None
+        return list(instances)
+
+    def instance_view(self, generation=None):
+        """
+        Same as instances(), but cached instances are only materialized when
+        they are accessed (e.g. for search results).
+        """
+        instances = self.cached_instances(generation)
+        if instances == None:
+            instances = self.instances()
+        return instances
+
+    def cache_fingerprint(self, generation=None):
+        """
+        Describes the cached inventory backing instances() so a persisted
+        search index can be invalidated when it changes. Sources that cannot
+        describe their cache return None, which disables the persisted index.
+        """
+        generation = generation or self.cache_generation()
+        if generation != None:
+            return [os.path.basename(generation)]
+        return None
+
+    @staticmethod
+    def _file_fingerprint(paths):
+        fingerprint = []
+        for path in sorted(paths):
+            stat = os.stat(path)
+            fingerprint.append([os.path.basename(path), stat.st_size, stat.st_mtime])
+        return fingerprint
+
+    def index_meta(self, instances, generation=None):
+        try:
+            fingerprint = self.cache_fingerprint(generation)
+        except (IOError, OSError):
+            fingerprint = None
+
+        return {'version': INDEX_VERSION,
+                'count': len(instances),
+                'filters': [list(pair) for pair in self.compiled_filter.patterns],
+                'fingerprint': fingerprint}
+
+    def search_index(self, instances, generation=None):
+        generation = generation or self.cache_generation()
+        meta = self.index_meta(instances, generation)
+        index = None
+        if meta['fingerprint'] != None and generation != None:
+            index = load_index(os.path.join(generation, INDEX_FILE), meta)
+        if index == None:
+            index = _build_index(instances, meta)
+        return index
+
+    def save_index(self, generation):
+        instances = open_cache(os.path.join(generation, CACHE_FILE), self.name)
+        meta = self.index_meta(instances, generation)
+        if meta['fingerprint'] == None:
+            return
+
+        path = os.path.join(generation, INDEX_FILE)
+        _build_index(instances, meta).save(path + '.tmp')
+        os.rename(path + '.tmp', path)
+
+    def searchable(self):
+        """
+        Returns the instances and search index used by search(). Both are kept
+        in memory until a new cache generation is published.
+        """
+        # both have to come from the same generation, even if an update
+        # publishes a new one in the meantime
+        generation = self.cache_generation()
+        try:
+            fingerprint = self.cache_fingerprint(generation)
+        except (IOError, OSError):
+            fingerprint = None
+
+        if fingerprint != None and self._searchable != None and self._searchable[0] == fingerprint:
+            return self._searchable[1:]
+
+        instances = self.instance_view(generation)
+        index = self.search_index(instances, generation)
+        if fingerprint != None:
+            self._searchable = (fingerprint, instances, index)
+
+        return instances, index
+
+    def iter_instances(self):
+        """
+        Yields the instances of this source, streamed from the memory mapped
+        cache when there is one.
+        """
+        return iter(self.instance_view())
+
+    def iter_search(self, targets, partial=True, fuzzy=False, limit=None, predicate=None):
+        for score, instance in self.ranked_search(targets, partial, fuzzy, limit, predicate):
+            yield instance
+
+    def search(self, targets, partial=True, fuzzy=False, limit=None):
+        return list(self.iter_search(targets, partial, fuzzy, limit))
+
+    def ranked_search(self, targets, partial=True, fuzzy=False, limit=None, predicate=None):
+        """
+        Returns (score, instance) for the best matches, best first. Ties are
+        broken by the position of the instance in the source (cached
+        instances are sorted by name and address). Only the first limit
+        matches accepted by the predicate are returned.
+        """
+        allInstances, index = self.searchable()
+        scores = {}
 
         for host in targets:
-            for instance in allInstances:
-                names = [instance.name]
-                if instance.aliases != None:
-                    names += list(instance.aliases)
-                for name in names:
-                    if host.lower() == name.lower():
-                        matchedInstances.add((100, instance))
-                    elif partial and host.lower() in name.lower():
-                        matchedInstances.add((99, instance))
-
-                    if fuzzy:
-                        score = fuzz.partial_ratio(host.lower(), name.lower())
-                        if score > 85 or host.lower() in name.lower():
-                            matchedInstances.add((score, instance))
-
-        # it is possible for the same instance to be matched, if so, it should only
-        # appear on the return list once (still ordered by the most probable match)
-        return list(collections.OrderedDict([(v, None) for k, v in sorted(list(matchedInstances))]).keys())
+            term = host.lower()
+
+            for score, position in index.lookup(term, partial):
+                if score > scores.get(position, -1):
+                    scores[position] = score
+
+            if fuzzy:
+                for score, key_id in fuzzy_scorer().search(term, index):
+                    # partial_ratio scores names containing the term 100, only
+                    # exact matches may outrank (or stop the search at) those
+                    score = min(score, PARTIAL_SCORE)
+                    for position in index.owners[key_id]:
+                        if score > scores.get(position, -1):
+                            scores[position] = score
+
+        # only the matches that are returned are popped (and created)
+        heap = [(-score, position) for position, score in scores.items()]
+        heapq.heapify(heap)
+
+        ranked = []
+        seen = set()
+        while len(heap) > 0 and (limit == None or len(ranked) < limit):
+            negative_score, position = heapq.heappop(heap)
+            instance = allInstances[position]
+            # the same instance may be listed more than once by a source
+            if instance in seen or (predicate != None and not predicate(instance)):
+                continue
+            seen.add(instance)
+            ranked.append((-negative_score, instance))
+
+        return ranked
 
 
 class InventorySet(InventorySource):
@@ -152,25 +481,102 @@ class InventorySet(InventorySource):
     def name(self):
         return " + ".join([inventory.name for inventory in self.inventories])
 
-    def update(self, filter_sources=tuple()):
-        for inventory in self.inventories:
-            if len(filter_sources) == 0 or (len(filter_sources) > 0 and inventory.source in filter_sources):
-                inventory.update()
-
-    def instances(self, stub=True, filter_sources=tuple()):
-        instances = []
-
+    def update(self, filter_sources=tuple(), workers=DEFAULT_UPDATE_WORKERS, timeout=DEFAULT_UPDATE_TIMEOUT):
+        inventories = list(self.selected(filter_sources))
+
+        if len(inventories) == 0:
+            return []
+
+        # sources are refreshed concurrently, a slow or failing source only
+        # affects its own result (and keeps its previous cache)
+        started = {}
+        results = [None] * len(inventories)
+        # threads can not be killed, a source that runs past its deadline is
+        # cancelled instead so that it never publishes its cache
+        cancels = [threading.Event() for _ in inventories]
+        pool = ThreadPool(processes=max(1, min(workers, len(inventories))))
+        pending = [(idx, pool.apply_async(_update_source, (idx, inventory, started, cancels[idx])))
+                   for idx, inventory in enumerate(inventories)]
+
+        try:
+            while len(pending) > 0:
+                waiting = []
+                for idx, async_result in pending:
+                    inventory = inventories[idx]
+                    deadline = inventory.update_timeout or timeout
+                    if async_result.ready():
+                        results[idx] = async_result.get()
+                    elif idx in started and time.time() - started[idx] > deadline:
+                        cancels[idx].set()
+                        results[idx] = UpdateResult(inventory.name, UpdateStatus.TIMEOUT, time.time() - started[idx],
+                                                    "No response after %ss" % deadline)
+                    else:
+                        waiting.append((idx, async_result))
+                pending = waiting
+
+                if len(pending) > 0:
+                    time.sleep(UPDATE_POLL_INTERVAL)
+        except KeyboardInterrupt:
+            logger.error("Cancelled by user")
+        finally:
+            for idx, async_result in pending:
+                cancels[idx].set()
+            pool.terminate()
+
+        return [result for result in results if result != None]
+
+    def selected(self, filter_sources=tuple()):
         for inventory in self.inventories:
             if len(filter_sources) == 0 or (len(filter_sources) > 0 and inventory.source in filter_sources):
-                instances.extend(inventory.instances())
-
-        return instances
+                yield inventory
 
-    def search(self, targets, partial=True, fuzzy=False, filter_sources=tuple()):
-        instances = []
+    def iter_instances(self, filter_sources=tuple()):
+        for inventory in self.selected(filter_sources):
+            for instance in inventory.iter_instances():
+                yield instance
 
-        for inventory in self.inventories:
-            if len(filter_sources) == 0 or (len(filter_sources) > 0 and inventory.source in filter_sources):
-                instances.extend(inventory.search(targets, partial, fuzzy))
-
-        return instances
\ No newline at end of file
+    def instances(self, stub=True, filter_sources=tuple()):
+        return list(self.iter_instances(filter_sources))
+
+    def ranked_search(self, targets, partial=True, fuzzy=False, limit=None, predicate=None, filter_sources=tuple()):
+        # the best matches of every source merged by score, ties are broken by
+        # the order of the sources
+        ranked = []
+        best = 0
+        for source_idx, inventory in enumerate(self.selected(filter_sources)):
+            # later sources cannot outrank a limit already filled with exact matches
+            if limit != None and best >= limit:
+                break
+            matches = inventory.ranked_search(targets, partial, fuzzy, limit, predicate)
+            ranked.append([(-score, source_idx, rank, instance) for rank, (score, instance) in enumerate(matches)])
+            best += sum(1 for score, _ in matches if score >= BEST_SCORE)
+
+        merged = heapq.merge(*ranked)
+        return [(-negative_score, instance) for negative_score, _, _, instance in itertools.islice(merged, limit)]
+
+    def iter_search(self, targets, partial=True, fuzzy=False, filter_sources=tuple(), limit=None, predicate=None):
+        for score, instance in self.ranked_search(targets, partial, fuzzy, limit, predicate, filter_sources):
+            yield instance
+
+    def search(self, targets, partial=True, fuzzy=False, filter_sources=tuple(), limit=None):
+        return list(self.iter_search(targets, partial, fuzzy, filter_sources, limit))
+
+def _build_index(instances, meta):
+    # a memory mapped store can hand out names without creating instances
+    if hasattr(instances, 'names'):
+        index = SearchIndex.build_from_names(instances.names(), meta)
+    else:
+        index = SearchIndex.build(instances, meta)
+    # kept in memory, so without a list per key and gram
+    return index.pack()
+
+def _update_source(idx, inventory, started, cancel=None):
+    started[idx] = time.time()
+    inventory.update_cancel = cancel
+    try:
+        updated = inventory.shared_update()
+    except BaseException as ex:
+        return UpdateResult(inventory.name, UpdateStatus.FAILED, time.time() - started[idx], str(ex) or repr(ex))
+
+    status = UpdateStatus.OK if updated else UpdateStatus.SHARED
+    return UpdateResult(inventory.name, status, time.time() - started[idx], None)
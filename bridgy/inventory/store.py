@@ -0,0 +1,281 @@
+import sys
+import json
+import mmap
+import array
+import struct
+import threading
+import collections
+try:
+    from sys import intern
+except ImportError:
+    # a builtin on python 2
+    pass
+
+MAGIC = b'BRDYSTR1'
+STORE_VERSION = 1
+NONE = 0xFFFFFFFF
+ALIGNMENT = 8
+# alias strings kept around to share between instances, tag values repeated
+# across many instances stay in it while unique ones (instance ids) pass through
+ALIAS_CACHE_SIZE = 4096
+
+# (section name, array typecode)
+SECTIONS = (
+    ('string_offsets', 'I'),
+    ('string_data', 'B'),
+    ('name', 'I'),
+    ('address', 'I'),
+    ('container_id', 'I'),
+    ('source', 'B'),
+    ('type', 'B'),
+    ('alias_offsets', 'I'),
+    ('alias_ids', 'I'),
+)
+
+
+class _Enum(object):
+
+    def __init__(self):
+        self.values = []
+        self._ids = {}
+
+    def id(self, value):
+        if value not in self._ids:
+            if len(self.values) == 255:
+                raise ValueError("Too many distinct values to store as an enum")
+            self._ids[value] = len(self.values)
+            self.values.append(value)
+        return self._ids[value]
+
+
+def _intern(value):
+    # source and type values are shared by every store (and instance)
+    try:
+        return intern(value)
+    except TypeError:
+        return value
+
+
+def write_store(path, rows, meta=None):
+    """
+    Writes instance rows (name, address, aliases, source, container_id, type)
+    as a columnar store: every distinct string is stored once in a string
+    table, instances are columns of string ids (or enum ids for the source and
+    type) and aliases are ranges into a shared array of string ids.
+    """
+    string_ids = {}
+    string_data = bytearray()
+    columns = dict((name, array.array(typecode)) for name, typecode in SECTIONS)
+    columns['string_offsets'].append(0)
+    columns['alias_offsets'].append(0)
+    sources = _Enum()
+    types = _Enum()
+
+    def intern(value):
+        if value is None:
+            return NONE
+        string_id = string_ids.get(value)
+        if string_id is None:
+            string_id = string_ids[value] = len(string_ids)
+            string_data.extend(value.encode('utf-8'))
+            columns['string_offsets'].append(len(string_data))
+        return string_id
+
+    count = 0
+    for name, address, aliases, source, container_id, type in rows:
+        columns['name'].append(intern(name))
+        columns['address'].append(intern(address))
+        columns['container_id'].append(intern(container_id))
+        columns['source'].append(sources.id(source))
+        columns['type'].append(types.id(type))
+        for alias in aliases or ():
+            columns['alias_ids'].append(intern(alias))
+        columns['alias_offsets'].append(len(columns['alias_ids']))
+        count += 1
+
+    columns['string_data'] = array.array('B', bytes(string_data))
+
+    header = dict(meta or {})
+    header.update({'store_version': STORE_VERSION,
+                   'count': count,
+                   'sources': sources.values,
+                   'types': types.values})
+    write_sections(path, MAGIC, header, SECTIONS, columns)
+
+    return count
+
+
+def write_sections(path, magic, header, sections, columns):
+    """
+    Writes a json header followed by the given array columns, each aligned
+    so it can be read in place from a memory map (see MappedSections).
+    """
+    offsets = {}
+    payload = bytearray()
+    for name, _ in sections:
+        data = columns[name].tostring() if sys.version_info < (3, 0) else columns[name].tobytes()
+        offsets[name] = [len(payload), len(data)]
+        payload.extend(data)
+        payload.extend(b'\0' * (-len(payload) % ALIGNMENT))
+
+    header = dict(header)
+    header.update({'byteorder': sys.byteorder,
+                   'sections': offsets})
+    header_data = json.dumps(header).encode('utf-8')
+    header_data += b' ' * (-(len(magic) + 4 + len(header_data)) % ALIGNMENT)
+
+    with open(path, 'wb') as out_file:
+        out_file.write(magic)
+        out_file.write(struct.pack('<I', len(header_data)))
+        out_file.write(header_data)
+        out_file.write(payload)
+
+
+class _StructColumn(object):
+    # fallback for pythons without memoryview.cast
+
+    def __init__(self, buf, offset, length, typecode):
+        self.buf = buf
+        self.offset = offset
+        self.typecode = typecode
+        self.itemsize = struct.calcsize(typecode)
+        self.length = length // self.itemsize
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, _ = idx.indices(self.length)
+            return self.buf[self.offset + start * self.itemsize:self.offset + stop * self.itemsize]
+        return struct.unpack_from(self.typecode, self.buf, self.offset + idx * self.itemsize)[0]
+
+
+class MappedSections(object):
+    """
+    A read-only memory map of a file written by write_sections. Columns are
+    views into the map, nothing is read until it is accessed.
+    """
+
+    def __init__(self, path, magic):
+        with open(path, 'rb') as mapped_file:
+            self._mmap = mmap.mmap(mapped_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap[:len(magic)] != magic:
+            raise ValueError("Unexpected file format: %s" % path)
+
+        header_length = struct.unpack_from('<I', self._mmap, len(magic))[0]
+        header_start = len(magic) + 4
+        self.header = json.loads(self._mmap[header_start:header_start + header_length].decode('utf-8'))
+
+        if self.header.get('byteorder') != sys.byteorder:
+            raise ValueError("Unsupported byte order: %s" % path)
+
+        self._data_start = header_start + header_length
+        self._view = memoryview(self._mmap)
+
+    def column(self, name, typecode):
+        offset, length = self.header['sections'][name]
+        start = self._data_start + offset
+        if hasattr(self._view, 'cast'):
+            return self._view[start:start + length].cast(typecode)
+        return _StructColumn(self._mmap, start, length, typecode)
+
+
+class InstanceStore(object):
+    """
+    A read-only, memory mapped view of a columnar store. Columns are read in
+    place and Instance objects are only created for the rows that are asked for.
+    """
+
+    def __init__(self, path, source=None, factory=None):
+        if factory is None:
+            from bridgy.inventory.source import Instance
+            factory = Instance
+
+        self.path = path
+        self.factory = factory
+        self.source = source
+        # tag values (e.g. environment names) repeat across many instances,
+        # recently used alias strings are shared (least recently used first out)
+        self._alias_strings = collections.OrderedDict()
+        # stores are read by the daemon's request threads at once
+        self._alias_lock = threading.Lock()
+
+        self._mapped = MappedSections(path, MAGIC)
+        self.header = self._mapped.header
+
+        if self.header.get('store_version') != STORE_VERSION:
+            raise ValueError("Unsupported inventory store: %s" % path)
+
+        self._sources = [_intern(value) for value in self.header['sources']]
+        self._types = [_intern(value) for value in self.header['types']]
+
+        for name, typecode in SECTIONS:
+            setattr(self, '_' + name, self._mapped.column(name, typecode))
+
+    def __len__(self):
+        return self.header['count']
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self[position]
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[idx] for idx in range(*position.indices(len(self)))]
+
+        if position < 0:
+            position += len(self)
+        if position < 0 or position >= len(self):
+            raise IndexError("store index out of range")
+
+        aliases = self.aliases(position) or None
+        source = self.source or self._sources[self._source[position]]
+
+        return self.factory(self.string(self._name[position]),
+                            self.string(self._address[position]),
+                            aliases,
+                            source,
+                            self.string(self._container_id[position]),
+                            self._types[self._type[position]])
+
+    def string(self, string_id):
+        if string_id == NONE:
+            return None
+
+        start = self._string_offsets[string_id]
+        end = self._string_offsets[string_id + 1]
+        return bytes(self._string_data[start:end]).decode('utf-8')
+
+    def aliases(self, position):
+        start = self._alias_offsets[position]
+        end = self._alias_offsets[position + 1]
+        if start == end:
+            return ()
+
+        return tuple(self._alias_string(self._alias_ids[idx]) for idx in range(start, end))
+
+    def _alias_string(self, string_id):
+        with self._alias_lock:
+            value = self._alias_strings.pop(string_id, None)
+            if value is not None:
+                self._alias_strings[string_id] = value
+                return value
+
+        value = self.string(string_id)
+        with self._alias_lock:
+            # another thread may have read it in the meantime, share theirs
+            shared = self._alias_strings.pop(string_id, value)
+            self._alias_strings[string_id] = shared
+            while len(self._alias_strings) > ALIAS_CACHE_SIZE:
+                self._alias_strings.popitem(last=False)
+        return shared
+
+    def names(self):
+        """
+        Yields the searchable names (name + aliases) of each row without
+        creating Instance objects.
+        """
+        for position in range(len(self)):
+            yield (self.string(self._name[position]),) + self.aliases(position)
@@ -1,14 +1,20 @@
 import os
 import shlex
 import logging
+import threading
+import contextlib
 import subprocess
+import collections
+
+from bridgy.utils import which
 
 logger = logging.getLogger()
 
+# tmux redraws and synchronized input slow down past this many panes in one window
+MAX_PANES_PER_WINDOW = 30
+
 def is_installed():
-    if os.system('which tmux >/dev/null 2>&1') == 0:
-        return True
-    return False
+    return which('tmux') != None
 
 def run(config, commands, in_windows=False, layout=None, dry_run=False, sync=False):
     layout_cmds = None
@@ -17,14 +23,143 @@ def run(config, commands, in_windows=False, layout=None, dry_run=False, sync=Fal
         if not layout_cmds:
             raise RuntimeError("Config does not define layout: %s" % layout)
 
-    with TmuxSession(commands=commands, in_windows=in_windows, layout_cmds=layout_cmds, dry_run=dry_run, sync=sync) as tmux:
+    control_mode = bool(config.dig('tmux', 'control_mode'))
+    max_panes = config.dig('tmux', 'max_panes_per_window') or MAX_PANES_PER_WINDOW
+
+    with TmuxSession(commands=commands, in_windows=in_windows, layout_cmds=layout_cmds, dry_run=dry_run, sync=sync,
+                     control_mode=control_mode, max_panes=max_panes) as tmux:
         tmux.attach()
 
 
+def split_order(count):
+    """
+    Returns the (relative pane target, split direction) of each split that
+    grows a window from one to count panes by always halving one of the
+    largest panes (so the window never runs out of room before it is laid
+    out), together with the order the new panes are created in relative to
+    their final position.
+    """
+    splits = []
+    panes = [0]
+    level = 1
+    for step in range(1, count):
+        if step >= level * 2:
+            level *= 2
+        target = 2 * (step - level)
+        # alternate directions so panes stay roughly square
+        direction = '-h' if level.bit_length() % 2 == 1 else '-v'
+        splits.append((target, direction))
+        panes.insert(target + 1, step)
+
+    # position of the pane created by each step
+    positions = [0] * count
+    for position, step in enumerate(panes):
+        positions[step] = position
+    return splits, positions
+
+
+def quote(arg):
+    # quoting for the tmux command parser (not a shell), $ would expand environment variables
+    if arg and all(char.isalnum() or char in '-_./:@%,=+' for char in arg):
+        return arg
+    return '"%s"' % arg.replace('\\', '\\\\').replace('"', '\\"').replace('$', '\\$')
+
+
+def separator_escaped(arg):
+    # tmux reads '\;' at the end of an argument as a literal ';'
+    if arg.endswith(';'):
+        return arg[:-1] + '\\;'
+    return arg
+
+
+class ControlClient(object):
+    """
+    A tmux client in control mode (tmux -C) that stays attached while a
+    session is built. Commands are written to it one per line and tmux
+    answers each of them, in order, with a %begin ... %end (or %error) block.
+    Failed commands are reported to on_error with the label they were sent
+    with.
+    """
+
+    def __init__(self, args, label=None, on_error=None):
+        self.on_error = on_error
+        self._pending = collections.deque([(list(args), label)])
+        self._closed = False
+        self._lock = threading.Condition()
+
+        logger.debug(' '.join(['tmux', '-C'] + list(args)))
+        self._process = subprocess.Popen(['tmux', '-C'] + list(args), stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self._reader = threading.Thread(target=self._read)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def send(self, args, label=None):
+        line = ' '.join(quote(arg) for arg in args)
+        logger.debug('tmux -C: %s' % line)
+
+        with self._lock:
+            if self._closed:
+                return False
+            self._pending.append((list(args), label))
+
+        try:
+            self._process.stdin.write((line + '\n').encode('utf-8'))
+            self._process.stdin.flush()
+        except (IOError, OSError):
+            return False
+        return True
+
+    def wait(self):
+        """
+        Blocks until every command sent so far has been answered (or the
+        client exited).
+        """
+        with self._lock:
+            while len(self._pending) > 0 and not self._closed:
+                self._lock.wait(0.1)
+
+    def close(self):
+        # the client detaches on end of input, the session keeps running
+        try:
+            self._process.stdin.close()
+        except (IOError, OSError):
+            pass
+        self._process.wait()
+        self._reader.join()
+
+    def _read(self):
+        output = None
+        for raw_line in iter(self._process.stdout.readline, b''):
+            line = raw_line.decode('utf-8', 'replace').rstrip('\r\n')
+
+            if line.startswith('%begin '):
+                output = []
+            elif output != None and line.startswith(('%end ', '%error ')):
+                self._answered(output, line.startswith('%error '))
+                output = None
+            elif output != None:
+                output.append(line)
+            # anything else is a notification (%window-add, %output...)
+
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+
+    def _answered(self, output, failed):
+        with self._lock:
+            args, label = self._pending.popleft() if len(self._pending) > 0 else (None, None)
+            self._lock.notify_all()
+
+        if failed and self.on_error:
+            self.on_error(label, args, ', '.join(output))
+
+
 # adapted from https://github.com/spappier/tmuxssh/
 class TmuxSession(object):
 
-    def __init__(self, session_name=None, commands=tuple(), in_windows=False, layout_cmds=None, dry_run=False, sync=False):
+    def __init__(self, session_name=None, commands=tuple(), in_windows=False, layout_cmds=None, dry_run=False, sync=False,
+                 control_mode=False, max_panes=MAX_PANES_PER_WINDOW):
         self._session_name = session_name or 'tmux-{}'.format(os.getpid())
         self._commands = commands
         self._in_windows = in_windows
@@ -33,25 +168,66 @@ class TmuxSession(object):
         self._show_errors = True
         self._dry_run = dry_run
         self._sync = sync
+        self._max_panes = max_panes
+        self._windows = []
+        self._batch = None
+        self._control_mode = control_mode and not dry_run
+        self._control = None
+        self._builder = None
+        self._closing = False
+        # the host the tmux commands currently being issued are for
+        self._pane = None
 
     def __enter__(self):
         if len(self._commands) == 0:
             return self
 
+        if self._control_mode:
+            # the remaining panes are streamed to a control mode client while
+            # the session is already attached, so they appear as they are created
+            self._session_ready = threading.Event()
+            self._builder = threading.Thread(target=self._build_in_control_mode)
+            self._builder.daemon = True
+            self._builder.start()
+            self._session_ready.wait()
+            return self
+
+        # the whole session is created by a single tmux invocation
+        with self.batch():
+            self._build()
+
+        return self
+
+    def _build_in_control_mode(self):
+        try:
+            self._build()
+            if self._control != None:
+                self._control.wait()
+        finally:
+            self._session_ready.set()
+            if self._control != None:
+                self._control.close()
+                self._control = None
+
+    def _control_error(self, pane, args, message):
+        if self._closing or not self._show_errors:
+            return
+        if pane:
+            logger.error("Tmux failed to open %s (%s): %s" % (pane, message, " ".join(args)))
+        else:
+            logger.error("Tmux failed (%s): %s" % (message, " ".join(args or [])))
+
+    def _build(self):
         # open a set of windows and run some commands
         if self._layout_cmds:
-            for cmdIdx, (name, command) in enumerate(self._commands.items()):
-
-                if cmdIdx == 0:
-                    self.new_session(self._session_name, window_name=name, command=command)
-                else:
-                    # new window for all layout panes running the same cmd
-                    self.new_window(name, command)
+            for name, command in self._commands.items():
+                self._pane = name
+                self._open_window(name, command)
 
-                # create each pane
+                # create each pane in the current window (host names such as 'a.b' are not valid pane targets)
                 for idx, item in enumerate(self._layout_cmds):
 
-                    cmd = [item['cmd'], '-t', name, command]
+                    cmd = [item['cmd'], '-t', self.target(), command]
                     if 'run' in item:
                         cmd.append(item['run'])
 
@@ -61,31 +237,51 @@ class TmuxSession(object):
                     if idx == 0:
                         self.kill_pane(0)
 
-                    self.select_layout('tiled')
-
-        # open one window
-        else:
-            for cmdIdx, (name, command) in enumerate(self._commands.items()):
-                if self._in_windows:
-                    if cmdIdx == 0:
-                        self.new_session(self._session_name, window_name=name, command=command)
-                    else:
-                        # new window for all layout panes running the same cmd
-                        self.new_window(name, command)
-                else:
-                    if cmdIdx == 0:
-                        self.new_session(self._session_name, window_name='remote-session', command=command)
-                    else:
-                        self.split_window(command)
+                self.select_layout('tiled')
 
+        # open one window per command
+        elif self._in_windows:
+            for name, command in self._commands.items():
+                self._pane = name
+                self._open_window(name, command)
                 self.select_layout('tiled')
 
+        # open panes, spread over as many windows as needed
+        else:
+            commands = list(self._commands.items())
+            for page, first in enumerate(range(0, len(commands), self._max_panes)):
+                window = 'remote-session' if page == 0 else 'remote-session-%d' % (page + 1)
+                self._open_panes(window, commands[first:first + self._max_panes])
+
+        self._pane = None
         if self._sync:
-            self.set_window_option('synchronize-panes', 'on')
+            # tmux only synchronizes the panes within a window
+            self.broadcast('set-window-option', 'synchronize-panes', 'on')
 
-        return self
+    def _open_window(self, name, command):
+        if self._created_session:
+            self.new_window(name, command)
+        else:
+            self.new_session(self._session_name, window_name=name, command=command)
+        self._windows.append(name)
+
+    def _open_panes(self, window, commands):
+        # the window is only laid out once, after all of its panes exist
+        splits, positions = split_order(len(commands))
+
+        self._pane, command = commands[0]
+        self._open_window(window, command)
+
+        for step, (offset, direction) in enumerate(splits, 1):
+            self._pane, command = commands[positions[step]]
+            self.split_window(command, window=window, offset=offset, direction=direction)
+
+        self.select_layout('tiled', window)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._builder != None:
+            self._closing = True
+            self._builder.join()
         self.kill_session()
 
     def suppress_errors(func):
@@ -104,13 +300,50 @@ class TmuxSession(object):
                 return func(self, *args, **kwargs)
         return wrapper
 
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Queues the tmux commands issued within the block, then runs all of
+        them at once as a ';' separated command sequence.
+        """
+        self._batch = []
+        try:
+            yield
+            queued = self._batch
+        finally:
+            self._batch = None
+
+        args = []
+        for command in queued:
+            if len(args) > 0:
+                args.append(';')
+            # an argument ending in ';' (e.g. 'cd /app; bash') would end the command early
+            args.extend(separator_escaped(arg) for arg in shlex.split(' '.join(command)))
+
+        if len(args) > 0:
+            self._execute(['tmux'] + args)
+
     def tmux(self, *args):
-        cmd = ['tmux'] + list(args)
+        if self._batch != None:
+            self._batch.append(list(args))
+            return ''
+
+        if self._control != None:
+            if not self._closing:
+                self._control.send(shlex.split(' '.join(args)), self._pane)
+            return ''
+
+        return self._run(*args)
+
+    def _run(self, *args):
+        return self._execute(shlex.split(' '.join(['tmux'] + list(args))))
+
+    def _execute(self, cmd):
         logger.debug(' '.join(cmd))
         if self._dry_run:
             return ''
 
-        pipes = subprocess.Popen(shlex.split(' '.join(cmd)), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        pipes = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         std_out, std_err = pipes.communicate()
 
         if pipes.returncode != 0 and self._show_errors:
@@ -124,33 +357,63 @@ class TmuxSession(object):
         return std_out
 
     def new_session(self, session_name, window_name=None, command=None):
-        cmd = ['new-session', '-ds', session_name]
+        # a control mode client stays attached to the session it creates
+        cmd = ['new-session', '-s' if self._control_mode else '-ds', session_name]
         if window_name:
             cmd += ['-n', window_name]
         if command:
             cmd += [command]
 
+        if self._control_mode:
+            self._control = ControlClient(shlex.split(' '.join(cmd)), self._pane, on_error=self._control_error)
+            self._control.wait()
+            self._created_session = True
+            self._session_ready.set()
+            return
+
         self.tmux(*cmd)
         self._created_session = True
 
     @run_only_with_session
     def new_window(self, name, command):
         if command:
-            self.tmux('new-window', '-n', name, command)
+            self.tmux('new-window', '-t', self._session_name, '-n', name, command)
         else:
-            self.tmux('new-window', '-n', name)
+            self.tmux('new-window', '-t', self._session_name, '-n', name)
+
+    def target(self, window=None, offset=0):
+        target = self._session_name
+        if window:
+            target += ':' + window
+        if offset:
+            # relative to the active pane
+            target += ('.+%d' if window else ':.+%d') % offset
+        return target
+
+    @run_only_with_session
+    def split_window(self, command, window=None, offset=0, direction=None):
+        # -d keeps the active pane in place, which offsets are relative to
+        cmd = ['split-window', '-d']
+        if direction:
+            cmd.append(direction)
+        self.tmux(*(cmd + ['-t', self.target(window, offset), command]))
 
     @run_only_with_session
-    def split_window(self, command):
-        self.tmux('split-window', '-t', self._session_name, command)
+    def select_layout(self, layout, window=None):
+        self.tmux('select-layout', '-t', self.target(window), layout)
 
     @run_only_with_session
-    def select_layout(self, layout):
-        self.tmux('select-layout', '-t', self._session_name, layout)
+    def broadcast(self, command, *args):
+        """
+        Runs a window targeted tmux command against every window of the session.
+        """
+        for window in self._windows:
+            self.tmux(command, '-t', self.target(window), *args)
 
     @run_only_with_session
     def attach(self):
-        self.tmux('attach', '-t', self._session_name)
+        # the terminal is attached by its own client, even in control mode
+        self._run('attach', '-t', self._session_name)
 
     @run_only_with_session
     def set_window_option(self, option, value):
@@ -160,10 +423,6 @@ class TmuxSession(object):
     def kill_pane(self, n):
         self.tmux('kill-pane', '-t', str(n))
 
-    @run_only_with_session
-    def kill_pane(self, n):
-        self.tmux('kill-pane', '-t', str(n))
-
     @suppress_errors
     @run_only_with_session
     def kill_session(self):
@@ -50,8 +50,17 @@ def memoize(fun):
             ret = cache[key] = fun(*args, **kwargs)
         return ret
     cache = {}
+    wrapper.cache = cache
     return wrapper
 
+def which(program):
+    # look up executables without forking a shell to run 'which'
+    try:
+        from shutil import which as find_executable
+    except ImportError:
+        from distutils.spawn import find_executable
+    return find_executable(program)
+
 def shortUuid():
     return str(uuid.uuid4())[:8]
 
@@ -20,12 +20,17 @@ setuptools.setup(
                       'docopt',
                       'blessings',
                       'inquirer >= 2.2.0',
-                      'fuzzywuzzy',
                       'boto3',
                       'placebo',
                       'coloredlogs',
                       'tabulate',
                       'ansible',],
+    extras_require={
+        # compiled scorer used for fuzzy search when available
+        'fast': ['rapidfuzz'],
+        # zstd compressed csv inventories
+        'zstd': ['zstandard'],
+    },
     platforms='linux',
     keywords=['tmux', 'ssh', 'sshfs', 'aws', 'newrelic', 'inventory', 'cloud'],
     # latest from https://pypi.python.org/pypi?%3Aaction=list_classifiers
@@ -1,4 +1,5 @@
 import os
+import json
 import mock
 import pytest
 import shlex
@@ -7,6 +8,11 @@ from bridgy.inventory import Instance
 from bridgy.inventory.aws import AwsInventory
 
 
+def write_cache(inventory, instances):
+    with inventory.cache_writer() as cache:
+        cache.write_all(instances)
+
+
 def test_aws_instances(mocker):
     test_dir = os.path.dirname(os.path.abspath(__file__))
     cache_dir = os.path.join(test_dir, 'aws_stubs')
@@ -27,6 +33,7 @@ def test_aws_instances(mocker):
 
     assert set(instances) == set(expected_instances)
 
+
 def test_aws_instances_profile(mocker):
     test_dir = os.path.dirname(os.path.abspath(__file__))
     cache_dir = os.path.join(test_dir, 'aws_stubs')
@@ -48,4 +55,188 @@ def test_aws_instances_profile(mocker):
 
     from botocore.exceptions import ProfileNotFound
     with pytest.raises(ProfileNotFound):
-        aws_obj = AwsInventory(cache_dir=cache_dir, profile='some-unconfigured-profile', region='region', config_path=config_dir)
\ No newline at end of file
+        aws_obj = AwsInventory(cache_dir=cache_dir, profile='some-unconfigured-profile', region='region', config_path=config_dir)
+
+
+def test_aws_update_paginates(mocker, tmpdir):
+    test_dir = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(test_dir, 'aws_stubs', 'ec2.DescribeInstances_1.json')) as stub:
+        reservations = json.load(stub)['data']['Reservations']
+
+    cache_dir = str(tmpdir)
+    aws_obj = AwsInventory(cache_dir=cache_dir, access_key_id='access_key_id',
+                           secret_access_key='secret_access_key', session_token='session_token',
+                           region='region')
+
+    mock_paginator = mocker.patch.object(aws_obj.client, 'get_paginator')
+    mock_paginator.return_value.paginate.return_value = iter([
+        {'Reservations': reservations[:3], 'NextToken': 'token'},
+        {'Reservations': reservations[3:]},
+    ])
+
+    aws_obj.update()
+
+    mock_paginator.assert_called_once_with('describe_instances')
+    assert os.listdir(cache_dir) == ['cache']
+    assert len(aws_obj.generations().generations()) == 1
+
+    instances = aws_obj.instances()
+    assert len(instances) == 8
+    assert set(instance.aliases[-1] for instance in instances) == set(['i-e54cbaeb', 'i-f7d726f9', 'i-f4d726fa', 'i-f5d726fb',
+                                                                       'i-f2d726fc', 'i-f3d726fd', 'i-0f500447384e95942', 'i-0f500447384e95943'])
+
+
+def test_aws_update_failure_keeps_cache(mocker, tmpdir):
+    cache_dir = str(tmpdir)
+    aws_obj = AwsInventory(cache_dir=cache_dir, access_key_id='access_key_id',
+                           secret_access_key='secret_access_key', session_token='session_token',
+                           region='region')
+    write_cache(aws_obj, [Instance('somebox', '1.2.3.4', None, 'aws', None, 'VM')])
+    generation = aws_obj.cache_generation()
+
+    mock_paginator = mocker.patch.object(aws_obj.client, 'get_paginator')
+    mock_paginator.return_value.paginate.side_effect = RuntimeError("throttled")
+
+    with pytest.raises(RuntimeError):
+        aws_obj.update()
+
+    assert aws_obj.generations().generations() == [os.path.basename(generation)]
+    assert aws_obj.instances() == [Instance('somebox', '1.2.3.4', None, 'aws', None, 'VM')]
+
+
+def test_aws_update_fans_out_over_regions_and_accounts(mocker, tmpdir):
+    test_dir = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(test_dir, 'aws_stubs', 'ec2.DescribeInstances_1.json')) as stub:
+        reservations = json.load(stub)['data']['Reservations']
+
+    aws_obj = AwsInventory(cache_dir=str(tmpdir), access_key_id='access_key_id',
+                           secret_access_key='secret_access_key', session_token='session_token',
+                           regions=['us-west-2', 'us-east-1'], origin_aliases=True,
+                           assume_roles=['arn:aws:iam::111111111111:role/read', 'arn:aws:iam::222222222222:role/read'])
+
+    assert aws_obj.targets() == [('arn:aws:iam::111111111111:role/read', 'us-west-2'),
+                                 ('arn:aws:iam::111111111111:role/read', 'us-east-1'),
+                                 ('arn:aws:iam::222222222222:role/read', 'us-west-2'),
+                                 ('arn:aws:iam::222222222222:role/read', 'us-east-1')]
+
+    def target_client(role, region):
+        client = mock.Mock()
+        client.get_paginator.return_value.paginate.return_value = iter([{'Reservations': reservations[:1]}])
+        return client, role.split(':')[4]
+
+    mocker.patch.object(aws_obj, '_target_client', side_effect=target_client)
+
+    aws_obj.update()
+
+    instances = aws_obj.instances()
+    assert len(instances) == 4
+    assert set(instance.aliases[-2:] for instance in instances) == set([('us-west-2', '111111111111'),
+                                                                       ('us-east-1', '111111111111'),
+                                                                       ('us-west-2', '222222222222'),
+                                                                       ('us-east-1', '222222222222')])
+
+
+def test_aws_fan_out_origin_aliases_are_opt_in(mocker, tmpdir):
+    test_dir = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(test_dir, 'aws_stubs', 'ec2.DescribeInstances_1.json')) as stub:
+        reservations = json.load(stub)['data']['Reservations']
+
+    def fan_out(name, **kwargs):
+        aws_obj = AwsInventory(cache_dir=str(tmpdir.mkdir(name)), access_key_id='access_key_id',
+                               secret_access_key='secret_access_key', session_token='session_token',
+                               regions=['us-west-2', 'us-east-1', 'eu-west-1'], **kwargs)
+
+        session = mock.Mock()
+        session.client.return_value.get_caller_identity.return_value = {'Account': '333333333333'}
+        session.client.return_value.get_paginator.return_value.paginate.side_effect = lambda **kwargs: iter([{'Reservations': reservations[:1]}])
+        mocker.patch('boto3.Session', return_value=session)
+
+        aws_obj.update()
+        return aws_obj, session
+
+    aws_obj, session = fan_out('default')
+    assert [instance.aliases for instance in aws_obj.instances()][0][-1].startswith('i-')
+    assert session.client.return_value.get_caller_identity.call_count == 0
+
+    aws_obj, session = fan_out('origin', origin_aliases=True)
+    assert set(instance.aliases[-2:] for instance in aws_obj.instances()) == set([('us-west-2', '333333333333'),
+                                                                               ('us-east-1', '333333333333'),
+                                                                               ('eu-west-1', '333333333333')])
+    # the account is the same in every region
+    assert session.client.return_value.get_caller_identity.call_count == 1
+
+
+def test_aws_update_fan_out_failure_keeps_cache(mocker, tmpdir):
+    aws_obj = AwsInventory(cache_dir=str(tmpdir), access_key_id='access_key_id',
+                           secret_access_key='secret_access_key', session_token='session_token',
+                           regions=['us-west-2', 'us-east-1'])
+    write_cache(aws_obj, [Instance('somebox', '1.2.3.4', None, 'aws', None, 'VM')])
+
+    def target_client(role, region):
+        client = mock.Mock()
+        if region == 'us-east-1':
+            client.get_paginator.return_value.paginate.side_effect = RuntimeError("throttled")
+        else:
+            client.get_paginator.return_value.paginate.return_value = iter([])
+        return client, '111111111111'
+
+    mocker.patch.object(aws_obj, '_target_client', side_effect=target_client)
+
+    with pytest.raises(RuntimeError) as ex:
+        aws_obj.update()
+
+    assert 'us-east-1' in str(ex.value)
+    assert aws_obj.instances() == [Instance('somebox', '1.2.3.4', None, 'aws', None, 'VM')]
+
+
+def test_aws_ec2_filters_default(tmpdir):
+    aws_obj = AwsInventory(cache_dir=str(tmpdir), region='region')
+    assert aws_obj.ec2_filters() == [{'Name': 'instance-state-name', 'Values': ['running']}]
+
+
+def test_aws_ec2_filters(tmpdir):
+    aws_obj = AwsInventory(cache_dir=str(tmpdir), region='us-west-2', include_pattern='^prod-.*',
+                           filters={'instance_states': ['running', 'stopped'],
+                                    'tags': {'Team': ['core', 'web'], 'Environment': 'production'},
+                                    'vpc_ids': ['vpc-1234'],
+                                    'subnet_ids': ['subnet-1', 'subnet-2']})
+
+    assert aws_obj.ec2_filters() == [{'Name': 'instance-state-name', 'Values': ['running', 'stopped']},
+                                     {'Name': 'tag:Environment', 'Values': ['production']},
+                                     {'Name': 'tag:Team', 'Values': ['core', 'web']},
+                                     {'Name': 'vpc-id', 'Values': ['vpc-1234']},
+                                     {'Name': 'subnet-id', 'Values': ['subnet-1', 'subnet-2']},
+                                     {'Name': 'tag-value', 'Values': ['prod-*']}]
+
+    aws_obj = AwsInventory(cache_dir=str(tmpdir), region='us-west-2', filters={'instance_states': []})
+    assert aws_obj.ec2_filters() == []
+
+
+@pytest.mark.parametrize("pattern,prefix", [
+    ('^prod-.*', 'prod-'),
+    ('^prod', 'prod'),
+    ('prod.*', None),         # not anchored, may match anywhere
+    ('^prod|test', None),     # alternation
+    ('^i-0f5.*', None),       # could match the instance id
+    ('^ec.*', None),          # could match the public dns name
+    ('^10-.*', None),         # could match a private ip
+    ('^us-west.*', None),     # could match the region alias
+])
+
+
+def test_aws_include_pattern_pushdown(tmpdir, pattern, prefix):
+    aws_obj = AwsInventory(cache_dir=str(tmpdir), regions=['us-west-2'], include_pattern=pattern)
+    assert aws_obj.include_prefix() == prefix
+
+
+def test_aws_update_uses_server_side_filters(mocker, tmpdir):
+    aws_obj = AwsInventory(cache_dir=str(tmpdir), region='region', filters={'vpc_ids': ['vpc-1234']})
+
+    mock_paginator = mocker.patch.object(aws_obj.client, 'get_paginator')
+    mock_paginator.return_value.paginate.return_value = iter([])
+
+    aws_obj.update()
+
+    mock_paginator.return_value.paginate.assert_called_once_with(
+        Filters=[{'Name': 'instance-state-name', 'Values': ['running']}, {'Name': 'vpc-id', 'Values': ['vpc-1234']}],
+        PaginationConfig={'PageSize': 1000})
@@ -0,0 +1,250 @@
+import os
+import time
+import pytest
+
+from bridgy.inventory import Instance
+from bridgy.inventory.cache import InstanceCacheWriter, CacheGenerations, open_cache
+from bridgy.inventory.flatfile import CsvInventory
+
+CSV = """\
+testenv-pubsrv|1.2.3.4
+devenv-pubsrv|9.10.11.12
+testenv-pubsrv|1.2.3.4
+testenv-formsvc|17.18.19.20
+"""
+
+
+def test_cache_writer_sorts_and_filters(tmpdir):
+    path = str(tmpdir.join('instances.cache'))
+
+    with InstanceCacheWriter(path, meta={'include_pattern': None}, predicate=lambda x: x.name != 'skipped') as cache:
+        cache.write(Instance('zeta', '1.1.1.1', ('alias',), 'src', None, 'VM'))
+        cache.write(Instance('skipped', '2.2.2.2', None, 'src', None, 'VM'))
+        cache.write(Instance('alpha', None, None, 'src', 'abc123', 'ECS'))
+
+    store = open_cache(path)
+    assert store.header['include_pattern'] == None
+    assert store.header['count'] == 2
+    assert list(store) == [Instance('alpha', None, None, 'src', 'abc123', 'ECS'),
+                           Instance('zeta', '1.1.1.1', ('alias',), 'src', None, 'VM')]
+
+def test_cache_writer_failure_keeps_previous_cache(tmpdir):
+    path = str(tmpdir.join('instances.cache'))
+
+    with InstanceCacheWriter(path) as cache:
+        cache.write(Instance('alpha', '1.1.1.1', None, 'src', None, 'VM'))
+
+    with pytest.raises(RuntimeError):
+        with InstanceCacheWriter(path) as cache:
+            cache.write(Instance('beta', '2.2.2.2', None, 'src', None, 'VM'))
+            raise RuntimeError("lost connection")
+
+    assert os.listdir(str(tmpdir)) == ['instances.cache']
+    assert list(open_cache(path)) == [Instance('alpha', '1.1.1.1', None, 'src', None, 'VM')]
+
+def test_csv_update_writes_cache(tmpdir):
+    csv_file = tmpdir.join('hosts.csv')
+    csv_file.write(CSV)
+
+    csv_obj = CsvInventory(str(csv_file), 'name, address', '|', exclude_pattern='formsvc')
+    csv_obj.update()
+
+    assert csv_obj.cache_is_current()
+    assert csv_obj.instances() == [Instance('devenv-pubsrv', '9.10.11.12', None, 'csv', None, 'VM'),
+                                   Instance('testenv-pubsrv', '1.2.3.4', None, 'csv', None, 'VM')]
+
+def test_csv_edited_after_update(tmpdir):
+    csv_file = tmpdir.join('hosts.csv')
+    csv_file.write(CSV)
+
+    csv_obj = CsvInventory(str(csv_file), 'name, address', '|')
+    csv_obj.update()
+
+    csv_file.write(CSV + "newbox|5.5.5.5\n")
+    later = time.time() + 10
+    os.utime(str(csv_file), (later, later))
+
+    assert not csv_obj.cache_is_current()
+    assert Instance('newbox', '5.5.5.5', None, 'csv', None, 'VM') in csv_obj.instances()
+
+def test_csv_search_reads_cache(mocker, tmpdir):
+    csv_file = tmpdir.join('hosts.csv')
+    csv_file.write(CSV)
+
+    csv_obj = CsvInventory(str(csv_file), 'name, address', '|')
+    csv_obj.update()
+
+    mock_parse = mocker.patch.object(csv_obj, '_parse')
+    assert csv_obj.search(['formsvc']) == [Instance('testenv-formsvc', '17.18.19.20', None, 'csv', None, 'VM')]
+    assert not mock_parse.called
+
+def test_generations_publish_and_prune(tmpdir):
+    generations = CacheGenerations(str(tmpdir.join('cache')))
+    assert generations.current() == None
+
+    published = []
+    for _ in range(4):
+        # generations are ordered by their creation time (in ms)
+        time.sleep(0.002)
+        generation = generations.create()
+        generations.publish(generation)
+        published.append(os.path.basename(generation))
+        assert generations.current() == generation
+
+    # the current and the previous generation are kept
+    assert generations.generations() == published[-2:]
+
+def test_generations_prune_keeps_newer(tmpdir):
+    generations = CacheGenerations(str(tmpdir.join('cache')), keep=1)
+    first = generations.create()
+    time.sleep(0.002)
+    second = generations.create()
+
+    generations.publish(first)
+
+    # a generation that is still being written is never pruned
+    assert generations.generations() == [os.path.basename(first), os.path.basename(second)]
+
+def test_generations_prune_interrupted(tmpdir):
+    generations = CacheGenerations(str(tmpdir.join('cache')))
+    first = generations.create()
+    generations.publish(first)
+    time.sleep(0.002)
+    # the writer of this one was killed before publishing it
+    interrupted = generations.create()
+    time.sleep(0.002)
+    second = generations.create()
+
+    generations.publish(second)
+
+    # the previously published generation is kept, the interrupted one is swept up
+    assert generations.generations() == [os.path.basename(first), os.path.basename(second)]
+
+def test_csv_update_keeps_readers_on_their_generation(tmpdir):
+    csv_file = tmpdir.join('hosts.csv')
+    csv_file.write(CSV)
+
+    csv_obj = CsvInventory(str(csv_file), 'name, address', '|')
+    csv_obj.update()
+    reader = csv_obj.cached_instances()
+
+    csv_file.write("newbox|5.5.5.5\n")
+    csv_obj.update()
+
+    assert len(reader) == 3
+    assert csv_obj.instances() == [Instance('newbox', '5.5.5.5', None, 'csv', None, 'VM')]
+    assert os.path.exists(csv_obj.index_path)
+
+def test_failed_update_discards_generation(tmpdir):
+    csv_obj = CsvInventory(str(tmpdir.join('missing.csv')), 'name, address', '|')
+
+    with pytest.raises(IOError):
+        csv_obj.update()
+
+    assert csv_obj.generations().generations() == []
+    assert csv_obj.cache_generation() == None
+
+def test_csv_instances_cached_without_update(mocker, tmpdir):
+    csv_file = tmpdir.join('hosts.csv')
+    csv_file.write(CSV)
+
+    csv_obj = CsvInventory(str(csv_file), 'name, address', '|')
+    first = csv_obj.instances()
+
+    mock_parse = mocker.patch.object(csv_obj, '_parse')
+    assert csv_obj.cache_is_current()
+    assert csv_obj.instances() == sorted(first)
+    assert not mock_parse.called
+
+def test_csv_appends_are_parsed_incrementally(mocker, tmpdir):
+    csv_file = tmpdir.join('hosts.csv')
+    csv_file.write(CSV)
+
+    csv_obj = CsvInventory(str(csv_file), 'name, address', '|')
+    csv_obj.update()
+
+    csv_file.write("newbox|5.5.5.5\n", mode='a')
+    spy_parse = mocker.spy(csv_obj, '_parse')
+
+    instances = csv_obj.instances()
+    assert spy_parse.call_args == mocker.call(len(CSV))
+    assert len(instances) == 4
+    assert Instance('newbox', '5.5.5.5', None, 'csv', None, 'VM') in instances
+    assert csv_obj.cache_is_current()
+
+def test_csv_rewrites_are_parsed_again(mocker, tmpdir):
+    csv_file = tmpdir.join('hosts.csv')
+    csv_file.write(CSV)
+
+    csv_obj = CsvInventory(str(csv_file), 'name, address', '|')
+    csv_obj.update()
+
+    csv_file.write(CSV.replace('1.2.3.4', '4.3.2.1') + "newbox|5.5.5.5\n")
+    spy_parse = mocker.spy(csv_obj, '_parse')
+
+    instances = csv_obj.instances()
+    assert spy_parse.call_args == mocker.call()
+    assert Instance('testenv-pubsrv', '4.3.2.1', None, 'csv', None, 'VM') in instances
+    assert Instance('testenv-pubsrv', '1.2.3.4', None, 'csv', None, 'VM') not in instances
+
+def test_csv_edits_above_the_end_are_parsed_again(mocker, tmpdir):
+    csv_file = tmpdir.join('hosts.csv')
+    filler = ''.join('filler-%05d|10.0.%d.%d\n' % (idx, idx // 256, idx % 256) for idx in range(1000))
+    csv_file.write(CSV + filler)
+
+    csv_obj = CsvInventory(str(csv_file), 'name, address', '|')
+    csv_obj.update()
+
+    # rewritten in place (same inode and size) well before the end, then appended to
+    with open(str(csv_file), 'r+') as edited:
+        edited.write(CSV.replace('1.2.3.4', '4.3.2.1'))
+    csv_file.write("newbox|5.5.5.5\n", mode='a')
+    spy_parse = mocker.spy(csv_obj, '_parse')
+
+    instances = csv_obj.instances()
+    assert spy_parse.call_args == mocker.call()
+    assert Instance('testenv-pubsrv', '4.3.2.1', None, 'csv', None, 'VM') in instances
+    assert Instance('testenv-pubsrv', '1.2.3.4', None, 'csv', None, 'VM') not in instances
+    assert Instance('newbox', '5.5.5.5', None, 'csv', None, 'VM') in instances
+
+def test_csv_gzip_and_streaming_parser(mocker, tmpdir):
+    import gzip
+    from bridgy.inventory import flatfile
+
+    csv_path = str(tmpdir.join('hosts.csv.gz'))
+    with gzip.open(csv_path, 'wb') as csv_file:
+        csv_file.write(CSV.encode('utf-8'))
+
+    plain = CsvInventory(csv_path, 'name, address', '|').instances()
+
+    mocker.patch.object(flatfile, 'STREAM_PARSE_SIZE', 0)
+    tmpdir.join('.hosts.csv.gz.cache').remove()
+    streamed = CsvInventory(csv_path, 'name, address', '|').instances()
+
+    assert plain == streamed
+    assert len(plain) == 3
+
+def test_cache_writer_memory_is_bounded(tmpdir):
+    tracemalloc = pytest.importorskip('tracemalloc')
+    path = str(tmpdir.join('instances.cache'))
+    count = 50000
+
+    tracemalloc.start()
+    try:
+        with InstanceCacheWriter(path, spill_rows=1000) as cache:
+            for idx in range(count):
+                # written out of order, the cache still has to come out sorted
+                cache.write(Instance('host-%06d' % ((idx * 7919) % count), '10.0.%d.%d' % (idx // 256 % 256, idx % 256),
+                                     ('i-%08x' % idx,), 'src', None, 'VM'))
+            buffered = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    # holding every row would take well over 10MB, at most a chunk is held
+    assert buffered < 2 * 1024 * 1024
+
+    names = [row[0] for row in open_cache(path).names()]
+    assert len(names) == count
+    assert names[0] == 'host-000000'
+    assert names[-1] == 'host-%06d' % (count - 1)
+    assert all(names[idx] < names[idx + 1] for idx in range(len(names) - 1))
@@ -46,3 +46,24 @@ def test_csv_instances(mocker):
                           Instance(name='testenv-pubsrv', address='5.6.7.8', source='csv', container_id=None, type='VM'),
                           Instance(name='testenv-formsvc', address='17.18.19.20', source='csv', container_id=None, type='VM')]
     assert set(instances) == set(expected_instances)
+
+
+@pytest.mark.parametrize("streamed", [False, True])
+def test_csv_short_rows_are_skipped(mocker, tmpdir, streamed):
+    from bridgy.inventory import flatfile
+
+    if streamed:
+        mocker.patch.object(flatfile, 'STREAM_PARSE_SIZE', 0)
+    mock_warn = mocker.patch.object(flatfile.logger, 'warn')
+
+    csv_file = tmpdir.join('hosts.csv')
+    csv_file.write(DATA.replace('devenv-pubsrv|9.10.11.12|somethingrandom2', 'devenv-pubsrv') + "\n\n")
+
+    csv_obj = CsvInventory(str(csv_file), 'name, address, random', '|')
+    instances = csv_obj.instances()
+
+    # the same rows (and warning) no matter which parser read the file
+    assert len(instances) == 4
+    assert Instance('devenv-pubsrv', '13.14.15.16', None, 'csv', None, 'VM') in instances
+    assert mock_warn.call_count == 1
+    assert 'Skipped 1 rows' in mock_warn.call_args[0][0]
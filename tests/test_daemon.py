@@ -0,0 +1,112 @@
+import os
+import time
+import threading
+import pytest
+
+import bridgy.inventory as inventory
+from bridgy import daemon
+from bridgy.error import DaemonError
+from bridgy.inventory import Instance
+
+CONFIG = """
+config-schema: 2
+inventory:
+  source:
+    - type: csv
+      name: hosts
+      file: hosts.csv
+      fields: name, address
+      ssh:
+        user: csvuser
+"""
+
+
+@pytest.fixture
+def home(monkeypatch, tmpdir):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    monkeypatch.setattr(inventory, '_daemon', None)
+    tmpdir.join('.bridgy', 'config.yml').write(CONFIG, ensure=True)
+    tmpdir.join('.bridgy', 'inventory', 'csv', 'hosts.csv').write("devbox,1.2.3.4\nprodbox,5.6.7.8\n", ensure=True)
+    yield tmpdir
+    inventory.reset()
+
+@pytest.fixture
+def server(home):
+    server = daemon.InventoryDaemon().start()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+
+
+def test_daemon_search(server):
+    client = daemon.connect()
+    assert client.pid == os.getpid()
+
+    devbox = Instance('devbox', '1.2.3.4', None, 'hosts (csv)', None, 'VM')
+    assert client.search(['devbox']) == [devbox]
+    assert len(client.instances()) == 2
+    assert client.ssh_settings(devbox) == daemon.SshSettings(None, '', 'csvuser')
+
+    # warm lookups should be (much) faster than starting up bridgy
+    started = time.time()
+    for _ in range(10):
+        client.search(['prod'])
+    assert (time.time() - started) / 10 < 0.02
+
+def test_daemon_reloads_changed_inventory(home, server):
+    client = daemon.connect()
+    assert client.search(['newbox']) == []
+
+    csv_file = home.join('.bridgy', 'inventory', 'csv', 'hosts.csv')
+    csv_file.write("devbox,1.2.3.4\nnewbox,9.9.9.9\n")
+    later = time.time() + 10
+    os.utime(str(csv_file), (later, later))
+
+    assert client.search(['newbox']) == [Instance('newbox', '9.9.9.9', None, 'hosts (csv)', None, 'VM')]
+
+def test_daemon_not_running(home):
+    assert daemon.connect() == None
+
+def test_search_falls_back_without_daemon(home, server):
+    config = server.state.config
+    inventory.use_daemon(daemon.connect())
+    server.shutdown()
+    server.close()
+
+    assert inventory.search(config, ['devbox']) == [Instance('devbox', '1.2.3.4', None, 'hosts (csv)', None, 'VM')]
+    assert inventory._daemon == None
+
+def test_daemon_socket_never_world_accessible(home, mocker):
+    modes = []
+    bind = daemon._Server.server_bind
+
+    def server_bind(self):
+        bind(self)
+        modes.append(os.stat(self.server_address).st_mode & 0o777)
+
+    mocker.patch.object(daemon._Server, 'server_bind', server_bind)
+    server = daemon.InventoryDaemon().start()
+    try:
+        # already private right after the bind, before the chmod
+        assert len(modes) == 1
+        assert modes[0] & 0o077 == 0
+    finally:
+        server.close()
+
+def test_daemon_fingerprint_does_not_walk_inventory(home, server, mocker):
+    walk = mocker.patch('os.walk')
+    client = daemon.connect()
+    client.search(['devbox'])
+    client.search(['devbox'])
+    assert not walk.called
+
+def test_daemon_rejects_other_config(home, server):
+    config_path = str(home.join('.bridgy', 'config.yml'))
+    assert daemon.connect(config=config_path) != None
+    assert daemon.connect(config=str(home.join('other.yml'))) == None
+
+    client = daemon.DaemonClient(config=str(home.join('other.yml')))
+    with pytest.raises(DaemonError):
+        client.search(['devbox'])
@@ -0,0 +1,104 @@
+import random
+import string
+import pytest
+
+from bridgy.inventory import fuzzy
+from bridgy.inventory.fuzzy import FuzzyScorer, could_match, partial_ratio, _python_backend
+from bridgy.inventory.index import SearchIndex
+
+NAMES = ['devlab-forms', 'test-forms', 'test-pubsrv', 'devlab-pubsrv', 'prod-gamesvc',
+         'i-f7d726f9', 'ip-172-31-0-138.us-west-2.compute.internal', '', 'zzzzzz']
+
+
+def test_pruning_never_drops_a_match():
+    unpruned = _python_backend(pruned=False)
+    pruned = _python_backend(pruned=True)
+
+    for term in ['forms', 'pubsvr', 'tset-form', 'gamesvc', 'i-f7d726', 'xyz', 'de']:
+        assert sorted(pruned(term, NAMES, 85)) == sorted(unpruned(term, NAMES, 85))
+
+
+def test_could_match_bounds():
+    term = 'pubsrv'
+    term_chars = [(char, term.count(char)) for char in set(term)]
+
+    assert could_match(term, term_chars, 'test-pubsrv', 85)
+    assert not could_match(term, term_chars, 'zzzzzz', 85)
+    assert not could_match(term, term_chars, '', 85)
+
+
+@pytest.mark.parametrize("backend", ['python', 'rapidfuzz'])
+def test_scorer_extract(backend):
+    if backend == 'rapidfuzz':
+        pytest.importorskip('rapidfuzz')
+
+    scorer = FuzzyScorer(backend=backend)
+    matched = [NAMES[idx] for _, idx in scorer.extract('pubsrv', NAMES)]
+
+    assert sorted(matched) == ['devlab-pubsrv', 'test-pubsrv']
+    assert scorer.extract('', NAMES) == []
+
+
+def test_scorer_unsupported_backend():
+    with pytest.raises(RuntimeError):
+        FuzzyScorer(backend='bogus')
+
+
+def test_scorer_large_inventory(mocker):
+    rand = random.Random(42)
+    names = ['-'.join(''.join(rand.choice(string.ascii_lowercase) for _ in range(6)) for _ in range(3))
+             for _ in range(50000)]
+    names[25000] = 'prod-awesome-svc'
+    index = SearchIndex.build_from_names([name] for name in names)
+
+    scored = mocker.spy(fuzzy, 'partial_ratio')
+    scorer = FuzzyScorer(backend='python')
+
+    # too short for the index, only the candidates could_match lets through are scored
+    assert (100, 25000) in scorer.search('awesome', index)
+    assert scored.call_count < len(names) // 10
+
+    # only the names sharing enough grams with the term reach the (slow) scorer
+    scored.reset_mock()
+    assert (93, 25000) in scorer.search('prod-awsome-svc', index)
+    assert scored.call_count < len(names) // 1000
+
+
+CORPUS = ['api-staging-01', 'api-stagng-01', 'api-stging-01', 'api-staging-02', 'api-prod-01', 'staging-api-01',
+          'web-staging-01', 'api-stagingx-01', 'apistaging01', 'ap-staging-1', 'api', '01', 'stag',
+          'db-staging-01', 'api-01', 'xapi-stagng-01x', 'api-stagn', 'ipa-gnigats-10']
+CORPUS += ['%s-%s-%02d' % (service, stage, number) for service in ('api', 'web', 'db', 'auth')
+           for stage in ('prod', 'staging', 'dev') for number in range(0, 30, 7)]
+
+
+def available_backends():
+    backends = ['python']
+    for backend, module in (('rapidfuzz', 'rapidfuzz'), ('levenshtein', 'Levenshtein')):
+        try:
+            __import__(module)
+            backends.append(backend)
+        except ImportError:
+            pass
+    return backends
+
+
+@pytest.mark.parametrize("backend", available_backends())
+def test_backends_match_the_same_names(backend):
+    index = SearchIndex.build_from_names([name] for name in CORPUS)
+    expected = FuzzyScorer(backend='python')
+
+    for term in ['api-stagng-01', 'api-staging', 'staging-01', 'stagng', 'web-prd-07', 'ap', 'db-dev-21']:
+        # every name is scored (the reference) vs. only those that share enough grams
+        reference = sorted((score, CORPUS[idx]) for score, idx in expected.extract(term, CORPUS))
+        matched = sorted((score, index.keys[key_id]) for score, key_id in FuzzyScorer(backend=backend).search(term, index))
+        assert matched == reference
+
+
+def test_partial_ratio_matches_rapidfuzz():
+    rapidfuzz = pytest.importorskip('rapidfuzz')
+
+    rand = random.Random(42)
+    for _ in range(2000):
+        first = ''.join(rand.choice('abc-01') for _ in range(rand.randint(1, 12)))
+        second = ''.join(rand.choice('abc-01') for _ in range(rand.randint(1, 20)))
+        assert partial_ratio(first, second) == pytest.approx(rapidfuzz.fuzz.partial_ratio(first, second))
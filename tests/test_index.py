@@ -0,0 +1,109 @@
+import os
+import pytest
+
+from bridgy.inventory import Instance
+from bridgy.inventory.index import SearchIndex, ngrams, load_index
+from bridgy.inventory.aws import AwsInventory
+
+INSTANCES = [Instance(name='devlab-forms', address='1.2.3.4', aliases=('devlab', 'i-f7d726f9'), source='aws'),
+             Instance(name='test-forms', address='5.6.7.8', aliases=('test', 'i-e54cbaeb'), source='aws'),
+             Instance(name='test-pubsrv', address='9.10.11.12', aliases=None, source='aws'),
+             Instance(name='Devbox', address='13.14.15.16', aliases=('devbox',), source='aws')]
+
+
+def test_ngrams():
+    assert ngrams('abcd') == set(['abc', 'bcd'])
+    assert ngrams('ab') == set()
+
+
+def test_index_lookup_exact_and_partial():
+    index = SearchIndex.build(INSTANCES)
+
+    assert sorted(index.lookup('test-forms')) == [(100, 1)]
+    assert sorted(index.lookup('forms')) == [(99, 0), (99, 1)]
+    assert sorted(index.lookup('forms', partial=False)) == []
+    # both the name and the alias lowercase to the same key
+    assert sorted(index.lookup('devbox')) == [(100, 3)]
+    assert sorted(index.lookup('nothing')) == []
+
+
+def test_index_lookup_short_terms_scan_all_keys():
+    index = SearchIndex.build(INSTANCES)
+
+    assert sorted(set(position for _, position in index.lookup('te'))) == [1, 2]
+
+
+def test_index_persistence(tmpdir):
+    path = str(tmpdir.join('search.index'))
+    SearchIndex.build(INSTANCES, meta={'count': 4}).save(path)
+
+    assert list(load_index(path, {'count': 4}).keys) == SearchIndex.build(INSTANCES).keys
+    assert load_index(path, {'count': 5}) is None
+    assert load_index(str(tmpdir.join('missing.index')), {'count': 4}) is None
+
+
+def test_index_pack():
+    built = SearchIndex.build(INSTANCES)
+    packed = built.pack()
+
+    assert not isinstance(packed.postings, dict)
+    assert list(packed.keys) == built.keys
+    assert [list(owners) for owners in packed.owners] == built.owners
+    for term in ('test-forms', 'forms', 'devbox', 'te', 'nothing'):
+        assert sorted(packed.lookup(term)) == sorted(built.lookup(term))
+
+
+def test_source_search_uses_index():
+    test_dir = os.path.dirname(os.path.abspath(__file__))
+    cache_dir = os.path.join(test_dir, 'aws_stubs')
+
+    aws_obj = AwsInventory(cache_dir=cache_dir, access_key_id='access_key_id',
+                           secret_access_key='secret_access_key', session_token='session_token',
+                           region='region')
+
+    matched = aws_obj.search(['pubsrv'])
+    assert set(instance.aliases[-1] for instance in matched) == set(['i-f5d726fb', 'i-0f500447384e95942', 'i-0f500447384e95943'])
+
+    matched = aws_obj.search(['i-e54cbaeb'])
+    assert [instance.aliases[-1] for instance in matched] == ['i-e54cbaeb']
+
+
+class RecordingColumn(object):
+    # counts the items read from a memory mapped column, slicing reads nothing
+
+    def __init__(self, column, reads):
+        self.column = column
+        self.reads = reads
+
+    def __len__(self):
+        return len(self.column)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return RecordingColumn(self.column[idx], self.reads)
+        self.reads.append(1)
+        return self.column[idx]
+
+    def __iter__(self):
+        for value in self.column:
+            self.reads.append(1)
+            yield value
+
+
+def test_index_lookup_reads_only_query_grams(tmpdir):
+    path = str(tmpdir.join('search.index'))
+    names = [('web-%06d.example.com' % idx, 'i-%017x' % idx) for idx in range(20000)]
+    SearchIndex.build_from_names(names, meta={'count': 20000}).save(path)
+
+    index = load_index(path, {'count': 20000})
+    reads = []
+    total = 0
+    for ranges in (index.keys, index.owners, index.postings.grams, index.postings.postings):
+        total += len(ranges.offsets) + len(ranges.values)
+        ranges.offsets = RecordingColumn(ranges.offsets, reads)
+        ranges.values = RecordingColumn(ranges.values, reads)
+
+    assert list(index.lookup('web-012345.example.com')) == [(100, 12345)]
+    assert sorted(position for _, position in index.lookup('i-000000000000000ff')) == [255]
+    # binary searches of the gram table and the query's posting lists, not the whole file
+    assert 0 < sum(reads) < total // 100
@@ -21,6 +21,7 @@ def test_set_inventory_bastion(mocker):
     assert aws_obj.bastion.destination == 'someuser@someaddr'
     assert aws_obj.bastion.options == 'someoptions'
 
+
 def test_inclusion_filtering(mocker):
     test_dir = os.path.dirname(os.path.abspath(__file__))
     cache_dir = os.path.join(test_dir, 'aws_stubs')
@@ -50,6 +51,7 @@ def test_inclusion_filtering(mocker):
 
     assert set(all_instances) == set(expected_instances)
 
+
 def test_exclusion_filtering(mocker):
     test_dir = os.path.dirname(os.path.abspath(__file__))
     cache_dir = os.path.join(test_dir, 'aws_stubs')
@@ -75,4 +77,35 @@ def test_exclusion_filtering(mocker):
                           Instance(name='devlab-pubsrv', address='devbox', aliases=('devbox', 'ip-172-31-0-142.us-west-2.compute.internal', 'i-f5d726fb'), source='aws', container_id=None, type='VM'),
                           Instance(name='devlab-game-svc', address='devbox', aliases=('devbox', 'ip-172-31-0-140.us-west-2.compute.internal', 'i-f2d726fc'), source='aws', container_id=None, type='VM')]
 
-    assert set(all_instances) == set(expected_instances)
\ No newline at end of file
+    assert set(all_instances) == set(expected_instances)
+
+
+def test_instance_filter_merges_patterns():
+    from bridgy.inventory import InstanceFilter
+
+    instance_filter = InstanceFilter([('^prod', None), (None, 'db'), (None, None)])
+    assert instance_filter.patterns == (('^prod', None), (None, 'db'))
+    assert instance_filter(Instance('prod-web', '1.1.1.1', ('web',), 'aws', None, 'VM'))
+    assert not instance_filter(Instance('prod-db', '1.1.1.2', None, 'aws', None, 'VM'))
+    assert not instance_filter(Instance('dev-web', '1.1.1.3', ('web',), 'aws', None, 'VM'))
+    # aliases are matched too and containers may not have an address
+    assert instance_filter(Instance('web', None, ('prod-web',), 'newrelic', 'abc123', 'ECS'))
+    assert not InstanceFilter()
+
+
+def test_inventory_patterns_applied_when_building_cache(mocker, tmpdir):
+    tmpdir.join('csv').mkdir()
+    tmpdir.join('csv', 'hosts.csv').write("prod-web|1.1.1.1\nprod-db|1.1.1.2\ndev-web|1.1.1.3\n")
+    config = Config({'inventory': {'exclude_pattern': 'db',
+                                   'source': [{'type': 'csv', 'name': 'hosts', 'file': 'hosts.csv',
+                                               'fields': 'name, address', 'delimiter': '|',
+                                               'include_pattern': '^prod'}]}})
+    mocker.patch.object(config, 'inventoryDir', side_effect=lambda *parts: str(tmpdir.join(*parts)))
+    bridgy.inventory.reset()
+
+    inventorySet = inventory(config)
+    inventorySet.update()
+
+    source = inventorySet.inventories[0]
+    assert [instance.name for instance in source.cached_instances()] == ['prod-web']
+    assert [instance.name for instance in instances(config)] == ['prod-web']
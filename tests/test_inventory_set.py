@@ -1,10 +1,15 @@
 import os
+import time
 import mock
+import threading
 import pytest
+from multiprocessing.pool import ThreadPool
 
 import bridgy.inventory
-from bridgy.inventory import InventorySet, Instance
+from bridgy.inventory import InventorySet, Instance, UpdateStatus, CacheState
+from bridgy.inventory.source import InventorySource
 from bridgy.inventory.aws import AwsInventory
+from bridgy.inventory.flatfile import CsvInventory
 from bridgy.config import Config
 
 def get_aws_inventory(name):
@@ -83,4 +88,338 @@ def test_inventory_set_filter_sources(mocker):
 
 
     all_instances = inventorySet.instances(filter_sources='bogus')
-    assert len(all_instances) == 0
\ No newline at end of file
+    assert len(all_instances) == 0
+
+class FakeInventory(InventorySource):
+
+    name = 'fake'
+
+    def __init__(self, delay=0, error=None, **kwargs):
+        super(FakeInventory, self).__init__(**kwargs)
+        self.delay = delay
+        self.error = error
+        self.updated = False
+
+    def update(self):
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        self.updated = True
+
+    def instances(self):
+        return []
+
+class ConcurrentInventory(FakeInventory):
+    # every update waits (up to a point) until all of them are running at once
+
+    def __init__(self, running, expected, **kwargs):
+        super(ConcurrentInventory, self).__init__(**kwargs)
+        self.running = running
+        self.expected = expected
+
+    def update(self):
+        with self.running:
+            self.running.count += 1
+            self.running.notify_all()
+            deadline = time.time() + 5
+            while self.running.count < self.expected and time.time() < deadline:
+                self.running.wait(0.05)
+            self.running.peak = max(self.running.peak, self.running.count)
+        self.updated = True
+
+def test_inventory_set_update_concurrently(mocker):
+    running = threading.Condition()
+    running.count = running.peak = 0
+
+    inventorySet = InventorySet()
+    for idx in range(4):
+        inventorySet.add(ConcurrentInventory(running, 4, name='fake%d' % idx))
+
+    results = inventorySet.update(workers=4)
+
+    assert running.peak == 4
+    assert [result.status for result in results] == [UpdateStatus.OK] * 4
+    assert [result.source for result in results] == ['fake%d (fake)' % idx for idx in range(4)]
+
+def test_inventory_set_update_isolates_failures(mocker):
+    slow = FakeInventory(delay=5, name='slow', update_timeout=0.2)
+    broken = FakeInventory(error=RuntimeError('bad credentials'), name='broken')
+    fine = FakeInventory(name='fine')
+
+    inventorySet = InventorySet([slow, broken, fine])
+
+    results = inventorySet.update()
+
+    assert [result.status for result in results] == [UpdateStatus.TIMEOUT, UpdateStatus.FAILED, UpdateStatus.OK]
+    assert results[1].error == 'bad credentials'
+    assert fine.updated
+
+class LateInventory(FakeInventory):
+    # writes its cache only after the caller gave up waiting for it
+
+    def __init__(self, **kwargs):
+        super(LateInventory, self).__init__(**kwargs)
+        self.release = threading.Event()
+        self.finished = threading.Event()
+
+    def update(self):
+        self.release.wait(5)
+        try:
+            with self.cache_writer() as cache:
+                cache.write(Instance('late', 'late.com', source=self.name))
+        finally:
+            self.finished.set()
+
+def test_timed_out_update_is_not_published(tmpdir):
+    late = LateInventory(name='late', update_timeout=0.1)
+    late.cache_root = str(tmpdir.join('late.cache'))
+
+    results = InventorySet([late]).update()
+    assert [result.status for result in results] == [UpdateStatus.TIMEOUT]
+
+    late.release.set()
+    assert late.finished.wait(5)
+    assert late.cache_generation() == None
+    assert late.generations().generations() == []
+
+class PagedInventory(FakeInventory):
+    # keeps fetching pages of its inventory for much longer than it may take
+
+    def __init__(self, **kwargs):
+        super(PagedInventory, self).__init__(**kwargs)
+        self.fetched = 0
+        self.finished = threading.Event()
+
+    def update(self):
+        try:
+            with self.cache_writer() as cache:
+                for page in range(1000):
+                    time.sleep(0.01)
+                    self.fetched += 1
+                    cache.write(Instance('page-%d' % page, 'page.com', source=self.name))
+        finally:
+            self.finished.set()
+
+def test_timed_out_update_stops_writing(tmpdir):
+    paged = PagedInventory(name='paged', update_timeout=0.1)
+    paged.cache_root = str(tmpdir.join('paged.cache'))
+
+    results = InventorySet([paged]).update()
+    assert [result.status for result in results] == [UpdateStatus.TIMEOUT]
+
+    # the next write after the timeout ends the update
+    assert paged.finished.wait(5)
+    assert paged.fetched < 100
+    assert paged.cache_generation() == None
+    assert paged.generations().generations() == []
+
+def test_inventory_set_update_filter_sources(mocker):
+    inventorySet = InventorySet([FakeInventory(name='one'), FakeInventory(name='two')])
+
+    results = inventorySet.update(filter_sources=('two',))
+
+    assert [result.source for result in results] == ['two (fake)']
+    assert not inventorySet.inventories[0].updated
+
+def fake_cached_inventory(tmpdir, name, age, **kwargs):
+    inv = FakeInventory(name=name, **kwargs)
+    inv.cache_root = str(tmpdir.join(name + '.cache'))
+    if age != None:
+        with inv.cache_writer():
+            pass
+        past = time.time() - age
+        os.utime(inv.cache_path, (past, past))
+    return inv
+
+def test_cache_state(tmpdir):
+    assert fake_cached_inventory(tmpdir, 'nottl', 1000).cache_state() == CacheState.FRESH
+    assert fake_cached_inventory(tmpdir, 'fresh', 10, cache_ttl=60, cache_max_age=600).cache_state() == CacheState.FRESH
+    assert fake_cached_inventory(tmpdir, 'stale', 100, cache_ttl=60, cache_max_age=600).cache_state() == CacheState.STALE
+    assert fake_cached_inventory(tmpdir, 'old', 1000, cache_ttl=60, cache_max_age=600).cache_state() == CacheState.EXPIRED
+    assert fake_cached_inventory(tmpdir, 'missing', None, cache_ttl=60).cache_state() == CacheState.EXPIRED
+
+def test_refresh_stale_in_background_expired_in_foreground(mocker, tmpdir):
+    fresh = fake_cached_inventory(tmpdir, 'fresh', 10)
+    stale = fake_cached_inventory(tmpdir, 'stale', 100)
+    expired = fake_cached_inventory(tmpdir, 'expired', 1000)
+    config = Config({'inventory': {'source': [], 'cache_ttl': 60, 'cache_max_age': 600}})
+    inventorySet = InventorySet([fresh, stale, expired])
+    for inv in inventorySet.inventories:
+        inv.cache_ttl, inv.cache_max_age = 60, 600
+    mocker.patch.object(bridgy.inventory, 'inventory', return_value=inventorySet)
+    mock_background = mocker.patch.object(bridgy.inventory, 'update_in_background')
+
+    results = bridgy.inventory.refresh(config)
+
+    assert [result.source for result in results] == ['expired (fake)']
+    assert expired.updated and not stale.updated and not fresh.updated
+    mock_background.assert_called_once_with(config, [stale])
+
+def test_update_in_background(mocker, tmpdir):
+    stale = fake_cached_inventory(tmpdir, 'stale', 100, cache_ttl=60)
+    config = Config({'inventory': {'source': []}})
+    config.path = str(tmpdir.join('config.yml'))
+    mock_popen = mocker.patch('subprocess.Popen')
+
+    bridgy.inventory.update_in_background(config, [stale])
+
+    assert mock_popen.call_args[0][0][-4:] == ['bridgy', 'update', '-i', 'stale']
+    assert tmpdir.join('update.log').check()
+
+    # the log is rotated once it grows past UPDATE_LOG_SIZE
+    tmpdir.join('update.log').write('x' * (bridgy.inventory.UPDATE_LOG_SIZE + 1))
+    bridgy.inventory.update_in_background(config, [stale])
+    assert tmpdir.join('update.log.1').size() == bridgy.inventory.UPDATE_LOG_SIZE + 1
+    assert tmpdir.join('update.log').size() == 0
+
+    # the refresh that is already running is not started again
+    mocker.patch.object(bridgy.inventory, 'inventory', return_value=InventorySet([stale]))
+    mock_background = mocker.patch.object(bridgy.inventory, 'update_in_background')
+    assert bridgy.inventory.refresh(config) == []
+    assert not mock_background.called
+
+class PublishingInventory(FakeInventory):
+
+    def __init__(self, calls, **kwargs):
+        super(PublishingInventory, self).__init__(**kwargs)
+        self.calls = calls
+
+    def update(self):
+        self.calls.append(self.name)
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        with self.cache_writer():
+            pass
+
+def test_concurrent_updates_are_coalesced(tmpdir):
+    calls = []
+    root = str(tmpdir.join('shared.cache'))
+    first = PublishingInventory(calls, name='shared', delay=0.3)
+    second = PublishingInventory(calls, name='shared')
+    first.cache_root = second.cache_root = root
+
+    pool = ThreadPool(2)
+    leader = pool.apply_async(InventorySet([first]).update)
+    time.sleep(0.1)
+    follower = pool.apply_async(InventorySet([second]).update)
+
+    statuses = [leader.get()[0].status, follower.get()[0].status]
+    pool.close()
+
+    assert len(calls) == 1
+    assert statuses == [UpdateStatus.OK, UpdateStatus.SHARED]
+    assert second.cache_generation() == first.cache_generation()
+
+def test_waiting_update_retries_after_failure(tmpdir):
+    calls = []
+    root = str(tmpdir.join('shared.cache'))
+    first = PublishingInventory(calls, name='shared', delay=0.3, error=IOError("lost connection"))
+    second = PublishingInventory(calls, name='shared')
+    first.cache_root = second.cache_root = root
+
+    pool = ThreadPool(2)
+    leader = pool.apply_async(InventorySet([first]).update)
+    time.sleep(0.1)
+    follower = pool.apply_async(InventorySet([second]).update)
+
+    statuses = [leader.get()[0].status, follower.get()[0].status]
+    pool.close()
+
+    assert len(calls) == 2
+    assert statuses == [UpdateStatus.FAILED, UpdateStatus.OK]
+    assert second.cache_generation() != None
+
+class ListedInventory(FakeInventory):
+
+    def __init__(self, names, **kwargs):
+        super(ListedInventory, self).__init__(**kwargs)
+        self.listed = [Instance(name, None, None, self.name, None, type) for name, type in names]
+
+    def instances(self):
+        return self.listed
+
+def test_search_ranks_best_matches_first(mocker):
+    first = ListedInventory([('web-2', 'VM'), ('web', 'ECS'), ('web-1', 'VM'), ('db', 'VM')], name='first')
+    second = ListedInventory([('webby', 'VM'), ('web', 'VM')], name='second')
+    config = Config({'inventory': {'source': []}})
+    mocker.patch.object(bridgy.inventory, 'inventory', return_value=InventorySet([first, second]))
+
+    def names(matched):
+        return [(instance.name, instance.source) for instance in matched]
+
+    # exact matches first, then ordered by source and position
+    assert names(bridgy.inventory.search(config, ['web'])) == [
+        ('web', 'first (fake)'), ('web', 'second (fake)'),
+        ('web-2', 'first (fake)'), ('web-1', 'first (fake)'), ('webby', 'second (fake)')]
+
+    assert names(bridgy.inventory.search(config, ['web'], limit=3)) == [
+        ('web', 'first (fake)'), ('web', 'second (fake)'), ('web-2', 'first (fake)')]
+
+    # the type is checked before the limit is applied
+    assert names(bridgy.inventory.search(config, ['web'], type='VM', limit=2)) == [
+        ('web', 'second (fake)'), ('web-2', 'first (fake)')]
+
+def test_fuzzy_search_ranks_exact_matches_first():
+    first = ListedInventory([('a-web-1', 'VM'), ('b-web-1-x', 'VM'), ('web-1', 'VM')], name='first')
+
+    # the exact match sorts after both names containing the term
+    ranked = InventorySet([first]).ranked_search(['web-1'], fuzzy=True, limit=1)
+    assert [(score, instance.name) for score, instance in ranked] == [(100, 'web-1')]
+
+    # names containing the term do not stop the search before the exact match of a later source
+    first = ListedInventory([('a-web-1', 'VM'), ('b-web-1-x', 'VM')], name='first')
+    second = ListedInventory([('web-1', 'VM')], name='second')
+    ranked = InventorySet([first, second]).ranked_search(['web-1'], fuzzy=True, limit=2)
+    assert [(instance.name, instance.source) for _, instance in ranked] == [
+        ('web-1', 'second (fake)'), ('a-web-1', 'first (fake)')]
+
+def test_search_only_creates_returned_instances(tmpdir):
+    csv_file = tmpdir.join('hosts.csv')
+    csv_file.write("".join("web-%03d|10.0.0.%d\n" % (idx, idx) for idx in range(200)))
+    csv_obj = CsvInventory(str(csv_file), 'name, address', '|')
+    csv_obj.update()
+
+    created = []
+    store = csv_obj.cached_instances()
+    store.factory = lambda *fields: created.append(fields) or Instance(*fields)
+    csv_obj._searchable = (csv_obj.cache_fingerprint(), store, csv_obj.search_index(store))
+
+    matched = csv_obj.search(['web-0'], limit=5)
+
+    assert [instance.name for instance in matched] == ['web-000', 'web-001', 'web-002', 'web-003', 'web-004']
+    assert len(created) == 5
+
+def test_search_stops_at_limit(mocker, tmpdir):
+    created = {}
+    inventories = []
+    for name, hosts in [('first', "web|10.0.0.1\nweb|10.0.0.2\nweb-1|10.0.0.3\n"), ('second', "web|10.0.1.1\n")]:
+        csv_file = tmpdir.join('%s.csv' % name)
+        csv_file.write(hosts)
+        csv_obj = CsvInventory(str(csv_file), 'name, address', '|', name=name)
+        csv_obj.update()
+
+        store = csv_obj.cached_instances()
+        store.factory = lambda *fields: created.setdefault(fields[3], []).append(fields) or Instance(*fields)
+        csv_obj._searchable = (csv_obj.cache_fingerprint(), store, csv_obj.search_index(store))
+        inventories.append(csv_obj)
+
+    config = Config({'inventory': {'source': []}})
+    mocker.patch.object(bridgy.inventory, 'inventory', return_value=InventorySet(inventories))
+    spy_second = mocker.spy(inventories[1], 'ranked_search')
+
+    # the first source already has two exact matches, the second is never searched
+    matched = bridgy.inventory.search(config, ['web'], limit=2)
+    assert [(instance.name, instance.address) for instance in matched] == [('web', '10.0.0.1'), ('web', '10.0.0.2')]
+    assert not spy_second.called
+    assert len(created['first (csv)']) == 2
+    assert 'second (csv)' not in created
+
+    # an exact match of the second source outranks the partial match of the first
+    matched = bridgy.inventory.search(config, ['web'], limit=3)
+    assert [(instance.name, instance.address) for instance in matched] == [
+        ('web', '10.0.0.1'), ('web', '10.0.0.2'), ('web', '10.0.1.1')]
+    assert spy_second.called
+    # no source creates more than limit instances
+    assert len(created['first (csv)']) == 2 + 3
+    assert len(created['second (csv)']) == 1
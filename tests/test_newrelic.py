@@ -10,6 +10,7 @@ try:
 except ImportError:
     import mock
 
+import os
 import pytest
 import shlex
 
@@ -126,3 +127,167 @@ def test_newrelic_instances():
         Instance(name=u'i-04267e627f88362ed-DEV-self-formsvc', address=u'172.16.221.211', aliases=None, source='acct:account_number (newrelic)', container_id=None, type='VM')
     ]
     assert set(instances) == set(expected_instances)
+
+def facets(events, fields):
+    # the insights response to a "FACET field, ..." query for these events
+    names, seen = [], set()
+    for event in events:
+        name = [event.get(field) for field in fields]
+        if tuple(name) not in seen:
+            seen.add(tuple(name))
+            names.append(name)
+    return {'facets': [{'name': name, 'results': [{'count': 1}]} for name in names]}
+
+def test_newrelic_update_writes_cache(mocker, tmpdir):
+    import json
+    data = json.loads(DATA)
+
+    def get(url, **kwargs):
+        response = mock.Mock()
+        if 'NetworkSample' in url:
+            response.text = json.dumps(facets(data['VM']['results'][0]['events'], ['hostname', 'ipV4Address']))
+        else:
+            response.text = json.dumps(facets(data['ECS']['results'][0]['events'], ['containerName', 'containerId', 'hostname']))
+        return response
+
+    mocker.patch('requests.Session.get', side_effect=get)
+
+    newrelic_obj = NewRelicInventory('account_number', 'api_key', str(tmpdir))
+    newrelic_obj.update()
+
+    assert os.listdir(str(tmpdir)) == ['account_number.cache']
+
+    instances = newrelic_obj.instances()
+    assert len(instances) == 6
+    assert instances == sorted(instances, key=lambda x: (x.name, x.address or ''))
+    assert Instance(name=u'coolcucumber', address=None, aliases=None, source='acct:account_number (newrelic)', container_id=u'cc3456789098765432', type='ECS') in instances
+
+
+def query_mock(events):
+    import re
+    import json
+    from bridgy.inventory import newrelic
+    try:
+        from urllib.parse import unquote_plus
+    except ImportError:
+        from urllib import unquote_plus
+
+    pages = []
+
+    def get(url, **kwargs):
+        nrql = unquote_plus(url)
+        since, until = [int(x) for x in re.search(r'SINCE (\d+) UNTIL (\d+)', nrql).groups()]
+        bounds = re.findall(r"hostname (<=|<|>=|>) '([^']*)'", nrql)
+        pages.append((since, until, bounds))
+
+        def in_range(hostname):
+            if hostname == None:
+                return not any(op.startswith('>') for op, _ in bounds)
+            return all(newrelic.COMPARE[op](hostname, name) for op, name in bounds)
+
+        found = []
+        if 'NetworkSample' in nrql:
+            found = [event for event in events if since <= event['timestamp'] < until and in_range(event['hostname'])]
+        result = facets(found, ['hostname', 'ipV4Address'])
+        result['facets'] = result['facets'][:newrelic.QUERY_LIMIT]
+        response = mock.Mock()
+        response.text = json.dumps(result)
+        return response
+
+    return get, pages
+
+def test_newrelic_update_one_row_per_host(mocker, tmpdir):
+    from bridgy.inventory import newrelic
+
+    now = 1501814899090
+    mocker.patch('time.time', return_value=now / 1000.0)
+    window = newrelic.QUERY_WINDOW * 1000
+    # 1500 hosts reporting every few seconds, many more samples than hosts
+    events = [{'timestamp': now - window + idx * window // 30000,
+               'hostname': 'host-%d' % (idx % 1500),
+               'ipV4Address': '10.0.%d.%d/24' % (idx % 1500 // 256, idx % 1500 % 256)} for idx in range(30000)]
+    get, pages = query_mock(events)
+    mocker.patch('requests.Session.get', side_effect=get)
+
+    newrelic_obj = NewRelicInventory('account_number', 'api_key', str(tmpdir))
+    newrelic_obj.update()
+
+    instances = newrelic_obj.instances()
+    assert len(instances) == 1500
+    # a single query each for vms and containers
+    assert pages == [(now - window, now, [])] * 2
+
+def test_newrelic_update_splits_truncated_pages(mocker, tmpdir):
+    from bridgy.inventory import newrelic
+
+    now = 1501814899090
+    mocker.patch('time.time', return_value=now / 1000.0)
+    window = newrelic.QUERY_WINDOW * 1000
+    # a steady fleet with more hosts than a single query returns, every host
+    # reports every few seconds so any time window holds all of them
+    events = [{'timestamp': now - window + idx * 10000,
+               'hostname': 'host-%d' % host,
+               'ipV4Address': '10.%d.%d.1/24' % (host // 256, host % 256)} for host in range(12000) for idx in range(3)]
+    events += [{'timestamp': now - 500, 'hostname': None, 'ipV4Address': '192.168.0.%d/24' % idx} for idx in range(3)]
+    get, pages = query_mock(events)
+    mocker.patch('requests.Session.get', side_effect=get)
+    warn = mocker.patch.object(newrelic.logger, 'warn')
+
+    newrelic_obj = NewRelicInventory('account_number', 'api_key', str(tmpdir))
+    newrelic_obj.update()
+
+    instances = newrelic_obj.instances()
+    assert len(instances) == 12003
+    assert Instance('192.168.0.1', '192.168.0.1', None, 'acct:account_number (newrelic)', None, 'VM') in instances
+    # the hostnames were split until no page was truncated, never the window
+    assert len(pages) > 3
+    assert all((since, until) == (now - window, now) for since, until, _ in pages)
+    assert not warn.called
+
+def test_newrelic_update_pages_always_full(mocker, tmpdir):
+    import json
+    from bridgy.inventory import newrelic
+
+    # an api that ignores the hostname ranges and always returns a full page
+    rows = facets([{'hostname': 'host-%04d' % idx, 'ipV4Address': '10.%d.%d.1/24' % (idx // 256, idx % 256)}
+                   for idx in range(newrelic.QUERY_LIMIT)], ['hostname', 'ipV4Address'])
+    urls = []
+
+    def get(url, **kwargs):
+        urls.append(url)
+        response = mock.Mock()
+        response.text = json.dumps(rows if 'NetworkSample' in url else {'facets': []})
+        return response
+
+    mocker.patch('requests.Session.get', side_effect=get)
+    warn = mocker.patch.object(newrelic.logger, 'warn')
+
+    newrelic_obj = NewRelicInventory('account_number', 'api_key', str(tmpdir))
+    newrelic_obj.update()
+
+    # rows outside of each half are dropped, so splitting stops after one round
+    assert len(newrelic_obj.instances()) == newrelic.QUERY_LIMIT
+    assert len(urls) == 4
+    assert not warn.called
+
+def test_newrelic_update_warns_when_names_cannot_be_split(mocker, tmpdir):
+    from bridgy.inventory import newrelic
+
+    now = 1501814899090
+    mocker.patch('time.time', return_value=now / 1000.0)
+    # every address reported under the same hostname
+    events = [{'timestamp': now - 500,
+               'hostname': 'host',
+               'ipV4Address': '10.%d.%d.1/24' % (idx // 256, idx % 256)} for idx in range(newrelic.QUERY_LIMIT + 10)]
+    events.append({'timestamp': now - 500, 'hostname': 'other', 'ipV4Address': '10.255.255.1/24'})
+    get, pages = query_mock(events)
+    mocker.patch('requests.Session.get', side_effect=get)
+    warn = mocker.patch.object(newrelic.logger, 'warn')
+
+    newrelic_obj = NewRelicInventory('account_number', 'api_key', str(tmpdir))
+    newrelic_obj.update()
+
+    # the other host is still found, only the host itself is truncated
+    assert len(newrelic_obj.instances()) == newrelic.QUERY_LIMIT + 1
+    assert warn.call_count == 1
+    assert 'some instances may be missing' in warn.call_args[0][0]
@@ -4,6 +4,7 @@ import re
 import os
 
 from bridgy.command import Ssh
+from bridgy.command.ssh import control_path
 from bridgy.inventory import InventorySet, Instance, inventory
 from bridgy.inventory.aws import AwsInventory
 from bridgy.error import BadInstanceError, BadConfigError, MissingBastionHost
@@ -13,6 +14,11 @@ instance = Instance('name', 'address.com')
 
 whitespace_pattern = re.compile(r'\W+')
 
+def socket_destination(path):
+    # the (possibly truncated) destination a control socket is named after
+    match = re.match(r'^(.+)-[0-9a-f]{12}$', os.path.basename(path))
+    return match.group(1)
+
 def assert_command_results(result1, result2):
     result1 = shlex.split(result1)
     result2 = shlex.split(result2)
@@ -102,3 +108,270 @@ def test_ssh_command_null_config():
     with pytest.raises(BadConfigError):
         sshObj = Ssh(None, instance)
         sshObj.command
+
+def test_ssh_command_custom_command():
+    config = Config({})
+    sshObj = Ssh(config, instance, command='sudo -i docker exec -ti abc bash')
+    assert_command_results(sshObj.command, 'ssh -t address.com sudo -i docker exec -ti abc bash')
+
+def test_ssh_command_multiplex(tmpdir):
+    config = Config({
+        'ssh': {
+            'user': 'username',
+            'multiplex': True
+        }
+    })
+    config.sockets = str(tmpdir.join('sockets'))
+    sshObj = Ssh(config, instance)
+
+    path = sshObj.control_path
+    assert os.path.dirname(path) == config.sockets
+    assert 'username@address.com'.startswith(socket_destination(path))
+    assert_command_results(sshObj.command, 'ssh -o ControlMaster=auto -o ControlPath=%s -o ControlPersist=10m -t username@address.com' % path)
+    assert oct(os.stat(config.sockets).st_mode & 0o777) == oct(0o700)
+
+def test_ssh_command_multiplex_long_path(tmpdir):
+    config = Config({
+        'ssh': {
+            'multiplex': True,
+            'control_persist': '1h'
+        }
+    })
+    config.sockets = str(tmpdir)
+    sshObj = Ssh(config, Instance('name', 'ec2-54-000-000-000.compute-1.amazonaws.com' * 2))
+
+    # the socket path must fit in a unix socket address
+    path = shlex.split(sshObj.command)[4].split('=', 1)[1]
+    assert len(path) < 104 - 17
+    assert sshObj.command.count('ControlPersist=1h') == 1
+
+def test_ssh_control_path_identity(tmpdir):
+    config = Config({
+        'ssh': {
+            'user': 'username',
+            'multiplex': True
+        }
+    })
+    config.sockets = str(tmpdir)
+    bastion_config = Config({
+        'ssh': {
+            'user': 'username',
+            'multiplex': True
+        },
+        'bastion': {
+            'address': 'bastion.com'
+        }
+    })
+    bastion_config.sockets = str(tmpdir)
+
+    path = Ssh(config, instance).control_path
+    # the same destination through a bastion, on another port or with other options is another master
+    assert Ssh(bastion_config, instance).control_path != path
+    assert control_path(config, 'username@address.com', '-p 2222') != control_path(config, 'username@address.com')
+    assert control_path(config, 'username@address.com', '-p 2222') != control_path(config, 'username@address.com', '-p 2223')
+    assert control_path(config, 'username@address.com', ' -p  2222 ') == control_path(config, 'username@address.com', '-p 2222')
+    assert path == control_path(config, 'username@address.com')
+    assert 'username@address.com'.startswith(socket_destination(path))
+
+def test_ssh_connections(tmpdir, mocker):
+    import socket
+    import subprocess
+
+    for name in ('user@alive', 'user@dead'):
+        sock = socket.socket(socket.AF_UNIX)
+        sock.bind(str(tmpdir.join(name)))
+        sock.close()
+    tmpdir.join('not-a-socket').write('')
+
+    def check(cmd, stdout, stderr):
+        proc = mocker.Mock()
+        if cmd[-2].endswith('alive'):
+            proc.returncode, message = 0, b'Master running (pid=1234)\n'
+        else:
+            proc.returncode, message = 255, b'Control socket connect: Connection refused\n'
+        proc.communicate.return_value = (b'', message)
+        return proc
+
+    mocker.patch.object(subprocess, 'Popen', side_effect=check)
+
+    connections = Ssh.connections(str(tmpdir))
+
+    assert [(connection.name, connection.pid) for connection in connections] == [('user@alive', 1234)]
+    # sockets of masters that exited are removed
+    assert sorted(os.listdir(str(tmpdir))) == ['not-a-socket', 'user@alive']
+
+def test_connections_filter_matches_truncated_names(tmpdir, mocker):
+    import bridgy.inventory
+    from bridgy import __main__ as main
+    from bridgy.command.ssh import Connection
+
+    config = Config({
+        'ssh': {
+            'multiplex': True
+        },
+        'bastion': {
+            'address': 'bastion.com'
+        }
+    })
+    config.sockets = str(tmpdir)
+    long_instance = Instance('web', 'ec2-54-000-000-000.compute-1.amazonaws.com' * 2)
+    long_path = Ssh(config, long_instance).control_path
+    bastion_path = control_path(config, 'bastion.com')
+    other_path = control_path(config, 'other.com')
+    assert 'web' not in os.path.basename(long_path)
+
+    connections = [Connection(os.path.basename(path), path, 1234) for path in (bastion_path, long_path, other_path)]
+    mocker.patch.object(Ssh, 'connections', return_value=connections)
+    mock_search = mocker.patch.object(bridgy.inventory, 'search', return_value=[long_instance])
+    mock_info = mocker.patch.object(main.logger, 'info')
+
+    main.connections_handler({'-d': False, '--close': False, '<host>': ['web']}, config)
+
+    listed = mock_info.call_args[0][0]
+    assert os.path.basename(long_path) in listed
+    assert os.path.basename(bastion_path) in listed
+    assert os.path.basename(other_path) not in listed
+    mock_search.assert_called_once_with(config, ['web'])
+
+def test_ssh_command_multiplex_bastion(tmpdir):
+    config = Config({
+        'ssh': {
+            'multiplex': True
+        },
+        'bastion': {
+            'address': 'bastion.com',
+            'options': '-C'
+        }
+    })
+    config.sockets = str(tmpdir)
+    sshObj = Ssh(config, instance)
+
+    # the hop runs over the bastion master connection
+    bastion_path = control_path(config, 'bastion.com', '-C')
+    proxy = "ssh -C -o ControlMaster=auto -o ControlPath=\"%s\" -o ControlPersist=10m -W %%h:%%p bastion.com" % bastion_path
+    assert shlex.split(sshObj.command)[2] == 'ProxyCommand=' + proxy
+    assert shlex.split(proxy)[5] == 'ControlPath=' + bastion_path
+
+def test_ssh_open_bastions(tmpdir, mocker):
+    import subprocess
+
+    config = Config({
+        'ssh': {
+            'multiplex': True
+        },
+        'bastion': {
+            'address': 'bastion.com',
+            'user': 'bastionuser'
+        }
+    })
+    config.sockets = str(tmpdir)
+    mock_call = mocker.patch.object(subprocess, 'call', return_value=0)
+    mocker.patch.object(Ssh, 'check_connection', return_value=None)
+
+    Ssh.open_bastions(config, [Instance('name-%d' % idx, 'address-%d.com' % idx) for idx in range(10)])
+
+    # one master for all of the instances behind the bastion
+    path = control_path(config, 'bastionuser@bastion.com')
+    mock_call.assert_called_once_with(['ssh', '-fNM', '-o', 'ControlPath=' + path, '-o', 'ControlPersist=10m', 'bastionuser@bastion.com'])
+
+def test_ssh_connect_all(tmpdir, mocker):
+    import subprocess
+
+    config = Config({
+        'ssh': {
+            'multiplex': True
+        }
+    })
+    config.sockets = str(tmpdir)
+    mocker.patch.object(Ssh, 'check_connection', return_value=None)
+
+    def connect(cmd, stdin, stdout, stderr):
+        proc = mocker.Mock()
+        host = cmd[-1]
+        # good.com authenticates, bad.com fails and slow.com never answers
+        proc.poll.return_value = {'good.com': 0, 'bad.com': 255, 'slow.com': None}[host]
+        proc.returncode = proc.poll.return_value
+        if host == 'bad.com':
+            stderr.write(b'Permission denied (publickey).\n')
+        return proc
+
+    mock_popen = mocker.patch.object(subprocess, 'Popen', side_effect=connect)
+
+    ssh_objs = [Ssh(config, Instance(host, host)) for host in ('good.com', 'bad.com', 'slow.com')]
+    results = Ssh.connect_all(ssh_objs, workers=3, timeout=0.2)
+
+    assert [(result.instance.name, result.ok) for result in results] == [('good.com', True), ('bad.com', False), ('slow.com', False)]
+    assert results[1].error == 'Permission denied (publickey).'
+    assert results[2].error == 'No response after 0.2s'
+
+    # masters never prompt, they are opened side by side
+    for call in mock_popen.call_args_list:
+        assert call[0][0][:2] == ['ssh', '-fNM']
+        assert 'BatchMode=yes' in call[0][0]
+        assert '-t' not in call[0][0]
+
+def preconnect_results(mocker, config):
+    from bridgy.command.ssh import ConnectResult
+
+    config.sockets = '/tmp'
+    errors = [None,
+              'ssh: connect to host down.com port 22: Connection timed out',
+              'Permission denied (publickey,keyboard-interactive).',
+              'Host key verification failed.',
+              'No response after 15s']
+    ssh_objs = [Ssh(config, Instance('host-%d' % idx, 'host-%d.com' % idx)) for idx in range(len(errors))]
+    results = [ConnectResult(ssh_obj.instance, error == None, 1.0, error) for ssh_obj, error in zip(ssh_objs, errors)]
+    mocker.patch.object(Ssh, 'open_bastions')
+    mocker.patch.object(Ssh, 'connect_all', return_value=results)
+    return ssh_objs
+
+def test_preconnect_reports_failures_by_default(mocker):
+    from bridgy import __main__ as main
+
+    config = Config({'ssh': {'multiplex': True}})
+    ssh_objs = preconnect_results(mocker, config)
+    mock_error = mocker.patch.object(main.logger, 'error')
+
+    # nothing is left out unless asked to
+    assert main.preconnect({'-d': False}, config, ssh_objs) == ssh_objs
+    assert 'Connection timed out' in mock_error.call_args_list[0][0][0]
+
+def test_preconnect_drops_only_unreachable(mocker):
+    from bridgy import __main__ as main
+
+    config = Config({'ssh': {'multiplex': True, 'drop_unreachable': True}})
+    ssh_objs = preconnect_results(mocker, config)
+
+    kept = main.preconnect({'-d': False}, config, ssh_objs)
+
+    # authentication and host key failures are answered in the session itself
+    assert [ssh_obj.instance.name for ssh_obj in kept] == ['host-0', 'host-2', 'host-3']
+
+def test_preconnect_nothing_reachable(mocker):
+    from bridgy import __main__ as main
+    from bridgy.command.ssh import ConnectResult
+
+    config = Config({'ssh': {'multiplex': True, 'drop_unreachable': True}})
+    config.sockets = '/tmp'
+    ssh_obj = Ssh(config, instance)
+    mocker.patch.object(Ssh, 'open_bastions')
+    mocker.patch.object(Ssh, 'connect_all', return_value=[ConnectResult(instance, False, 1.0, 'Connection refused')])
+
+    with pytest.raises(SystemExit):
+        main.preconnect({'-d': False}, config, [ssh_obj])
+
+def test_needs_interaction():
+    from bridgy.command.ssh import ConnectResult, needs_interaction
+
+    def result(error):
+        return ConnectResult(instance, False, 1.0, error)
+
+    assert needs_interaction(result('Permission denied (publickey).'))
+    assert needs_interaction(result('Host key verification failed.'))
+    assert needs_interaction(result('Permission denied (keyboard-interactive).'))
+    assert needs_interaction(result('@ WARNING: REMOTE HOST IDENTIFICATION HAS CHANGED! @'))
+    assert not needs_interaction(result('ssh: connect to host a.com port 22: Connection refused'))
+    assert not needs_interaction(result('ssh: Could not resolve hostname a.com: Name or service not known'))
+    assert not needs_interaction(result('No response after 15s'))
+    assert not needs_interaction(result(None))
+    assert not needs_interaction(ConnectResult(instance, True, 1.0, None))
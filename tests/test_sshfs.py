@@ -20,7 +20,7 @@ import shlex
 import re
 import os
 
-from bridgy.command import Sshfs
+from bridgy.command import Ssh, Sshfs
 from bridgy.inventory import Instance
 from bridgy.error import BadInstanceError, BadConfigError, MissingBastionHost, BadRemoteDir
 from bridgy.config import Config
@@ -214,6 +214,21 @@ def test_sshfs_command_no_user():
     mount_arg = '%s/%s@%s'%(config.mount_root_dir, instance.name, instance.address)
     assert_command_results(sshObj.command, 'sshfs -C -o ServerAliveInterval=255 address.com:/tmp %s' % mount_arg)
 
+def test_sshfs_command_multiplex(tmpdir):
+    config = Config({
+        'ssh': {
+            'user': 'username',
+            'multiplex': True
+        }
+    })
+    config.sockets = str(tmpdir)
+    remotedir = '/tmp'
+    sshObj = Sshfs(config, instance, remotedir)
+    mount_arg = '%s/%s@%s'%(config.mount_root_dir, instance.name, instance.address)
+    # mounts share the master connection of ssh sessions to the same destination
+    control_path = Ssh(config, instance).control_path
+    assert_command_results(sshObj.command, 'sshfs -o ControlMaster=auto -o ControlPath=%s -o ControlPersist=10m username@address.com:/tmp %s' % (control_path, mount_arg))
+
 def test_sshfs_command_bastion_options():
     config = Config({
         'bastion': {
@@ -0,0 +1,72 @@
+import os
+import sys
+import json
+import time
+import subprocess
+
+# generous enough for a slow CI box, a heavy import (boto3 alone takes
+# ~150ms) or a shell-out on every run should still stand out
+STARTUP_BUDGET = 1.0
+
+HEAVY_MODULES = ['boto3', 'botocore', 'placebo', 'requests', 'fuzzywuzzy', 'rapidfuzz',
+                 'inquirer', 'tabulate']
+
+RUNNER = """
+import os
+import sys
+import json
+
+# main() refuses to run as root, which CI containers usually are
+os.geteuid = lambda: 1000
+heavy_modules = json.loads(sys.argv[2])
+sys.argv = ['bridgy'] + json.loads(sys.argv[1])
+
+from bridgy.__main__ import main
+try:
+    main()
+except SystemExit:
+    pass
+
+sys.stderr.write(json.dumps([name for name in heavy_modules if name in sys.modules]))
+"""
+
+CONFIG = """
+config-schema: 2
+inventory:
+  source:
+    - type: csv
+      name: hosts
+      file: hosts.csv
+      fields: name, address
+"""
+
+
+def run_bridgy(home, *args):
+    env = dict(os.environ, HOME=str(home))
+    started = time.time()
+    process = subprocess.Popen([sys.executable, '-c', RUNNER, json.dumps(list(args)), json.dumps(HEAVY_MODULES)],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    stdout, stderr = process.communicate()
+    elapsed = time.time() - started
+    output = stdout.decode('utf-8') + stderr.decode('utf-8')
+    loaded = json.loads(output.strip().splitlines()[-1])
+    return output, elapsed, loaded
+
+def test_version_startup(tmpdir):
+    output, elapsed, loaded = run_bridgy(tmpdir, '--version')
+
+    assert 'bridgy' in output
+    assert loaded == []
+    assert elapsed < STARTUP_BUDGET
+
+def test_cached_ssh_lookup_startup(tmpdir):
+    tmpdir.join('.bridgy', 'config.yml').write(CONFIG, ensure=True)
+    tmpdir.join('.bridgy', 'inventory', 'csv', 'hosts.csv').write("devbox,1.2.3.4\nprodbox,5.6.7.8\n", ensure=True)
+    run_bridgy(tmpdir, 'update')
+    assert tmpdir.join('.bridgy', 'inventory', 'csv', '.hosts.csv.cache').check()
+
+    output, elapsed, loaded = run_bridgy(tmpdir, 'ssh', '-d', 'devbox')
+
+    assert '1.2.3.4' in output
+    assert loaded == []
+    assert elapsed < STARTUP_BUDGET
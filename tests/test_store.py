@@ -0,0 +1,158 @@
+import pytest
+
+from bridgy.inventory import Instance
+from bridgy.inventory.index import SearchIndex, load_index
+from bridgy.inventory.store import write_store, InstanceStore
+
+ROWS = [
+    ('alpha', '1.1.1.1', ('web', 'us-west-2'), 'aws', None, 'VM'),
+    ('beta', '2.2.2.2', None, 'aws', None, 'VM'),
+    ('gamma', None, ('us-west-2',), 'newrelic', 'abc123', 'ECS'),
+]
+
+
+def test_store_round_trip(tmpdir):
+    path = str(tmpdir.join('instances.cache'))
+    assert write_store(path, ROWS, {'include_pattern': 'web'}) == 3
+
+    store = InstanceStore(path)
+    assert store.header['include_pattern'] == 'web'
+    assert len(store) == 3
+    assert list(store) == [Instance(*row) for row in ROWS]
+    assert store[-1] == Instance(*ROWS[2])
+    assert store[1:] == [Instance(*row) for row in ROWS[1:]]
+    with pytest.raises(IndexError):
+        store[3]
+
+def test_store_interns_strings(tmpdir):
+    path = str(tmpdir.join('instances.cache'))
+    write_store(path, ROWS)
+
+    store = InstanceStore(path)
+    # 'us-west-2' is shared by two instances but only stored once
+    assert len(store._string_offsets) - 1 == len(['alpha', '1.1.1.1', 'web', 'us-west-2', 'beta', '2.2.2.2', 'gamma', 'abc123'])
+    assert store[0].aliases[1] is store[2].aliases[0]
+
+def test_store_names_and_source_override(tmpdir):
+    path = str(tmpdir.join('instances.cache'))
+    write_store(path, ROWS)
+
+    store = InstanceStore(path, source='renamed')
+    assert list(store.names()) == [('alpha', 'web', 'us-west-2'), ('beta',), ('gamma', 'us-west-2')]
+    assert set(instance.source for instance in store) == set(['renamed'])
+
+def test_store_empty(tmpdir):
+    path = str(tmpdir.join('instances.cache'))
+    write_store(path, [])
+
+    assert list(InstanceStore(path)) == []
+
+def test_store_rejects_other_files(tmpdir):
+    path = tmpdir.join('instances.cache')
+    path.write('{"version": 1}\n')
+
+    with pytest.raises(ValueError):
+        InstanceStore(str(path))
+
+def test_store_memory(tmpdir):
+    import json
+    tracemalloc = pytest.importorskip('tracemalloc')
+
+    count = 20000
+    envs = ['production', 'staging', 'dev', 'qa']
+    rows = [('web-%06d.example.com' % idx, '10.0.%d.%d' % (idx // 256, idx % 256),
+             ('env:' + envs[idx % 4], 'team:core'), 'aws (aws)', None, 'VM') for idx in range(count)]
+    path = str(tmpdir.join('instances.cache'))
+    write_store(path, rows)
+    # instances as they were loaded before there was a store: every field a separate string
+    data = json.dumps([[name, address, list(aliases), source, container_id, type]
+                       for name, address, aliases, source, container_id, type in rows])
+
+    def allocated(func):
+        tracemalloc.start()
+        try:
+            result = func()
+            return tracemalloc.get_traced_memory()[0], result
+        finally:
+            tracemalloc.stop()
+
+    decoded, _ = allocated(lambda: [Instance(name, address, tuple(aliases), source, container_id, type)
+                                    for name, address, aliases, source, container_id, type in json.loads(data)])
+    opened, store = allocated(lambda: InstanceStore(path))
+    materialized, instances = allocated(lambda: list(store))
+
+    assert instances[0] == Instance(*rows[0])
+    # searching only needs the memory mapped store, listing shares the repeated fields
+    assert opened * 50 < decoded
+    assert materialized * 3 < decoded * 2
+    assert instances[0].aliases[1] is instances[1].aliases[1]
+    assert instances[0].aliases[0] is instances[4].aliases[0]
+    assert instances[0].type is instances[1].type
+
+    # the search index is memory mapped as well, a search only reads (and
+    # allocates) what it needs for the query's grams and matches
+    index_path = str(tmpdir.join('search.index'))
+    built = SearchIndex.build_from_names(store.names())
+    built.save(index_path)
+    index_data = json.dumps({'keys': built.keys, 'owners': built.owners, 'postings': built.postings})
+    del built
+
+    parsed, _ = allocated(lambda: json.loads(index_data))
+    loaded, index = allocated(lambda: load_index(index_path, {}))
+    searched, matched = allocated(lambda: [store[position] for _, position in index.lookup('web-012345.example.com')])
+
+    assert matched == [Instance(*rows[12345])]
+    assert loaded * 50 < parsed
+    assert searched * 200 < parsed
+
+
+def test_store_alias_cache_is_bounded(tmpdir):
+    import sys
+    from bridgy.inventory import store
+
+    count = 200000
+    envs = ['production', 'staging', 'dev', 'qa']
+    regions = ['us-east-1', 'us-west-2', 'eu-west-1']
+    # aws shaped aliases: a tag, the instance id, the private dns name, the region and account
+    rows = [('web-%06d' % idx, '10.%d.%d.%d' % (idx // 65536, idx // 256 % 256, idx % 256),
+             (envs[idx % 4], 'i-%017x' % idx, 'ip-10-%d-%d-%d.ec2.internal' % (idx // 65536, idx // 256 % 256, idx % 256),
+              regions[idx % 3], '1234567890%02d' % (idx % 2)),
+             'aws (aws)', None, 'VM') for idx in range(count)]
+    path = str(tmpdir.join('instances.cache'))
+    write_store(path, rows)
+    del rows
+
+    instance_store = InstanceStore(path)
+    for names in instance_store.names():
+        pass
+
+    # only a bounded number of alias strings are kept after reading every row
+    cached = instance_store._alias_strings
+    assert len(cached) <= store.ALIAS_CACHE_SIZE
+    assert sum(sys.getsizeof(value) for value in cached.values()) < 1024 * 1024
+    # the repeated values are still shared
+    first, second = instance_store[0], instance_store[12]
+    assert first.aliases[0] is second.aliases[0]
+    assert first.aliases[3] is second.aliases[3]
+    assert first.aliases[4] is second.aliases[4]
+    assert first.aliases[1] == 'i-%017x' % 0
+
+def test_store_alias_cache_threads(tmpdir, mocker):
+    from multiprocessing.pool import ThreadPool
+    from bridgy.inventory import store
+
+    mocker.patch.object(store, 'ALIAS_CACHE_SIZE', 16)
+    rows = [('web-%04d' % idx, None, ('env-%d' % (idx % 40), 'i-%04d' % idx), 'src', None, 'VM') for idx in range(2000)]
+    path = str(tmpdir.join('instances.cache'))
+    write_store(path, rows)
+    instance_store = InstanceStore(path)
+
+    # threads reading (and evicting) aliases at once
+    pool = ThreadPool(8)
+    try:
+        read = pool.map(lambda position: instance_store.aliases(position), list(range(2000)) * 4)
+    finally:
+        pool.terminate()
+
+    assert read == [row[2] for row in rows] * 4
+    assert len(instance_store._alias_strings) <= 16
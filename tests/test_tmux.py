@@ -7,9 +7,19 @@ import collections
 import subprocess
 import pytest
 import shlex
+import time
 import os
 
-from bridgy.tmux import TmuxSession
+from bridgy.tmux import TmuxSession, split_order
+
+def batched(*commands):
+    # the session is created by a single tmux call running a ';' separated command sequence
+    args = ['tmux']
+    for command in commands:
+        if len(args) > 1:
+            args.append(';')
+        args.extend(command)
+    return mock.call(args, stderr=-1, stdout=-1)
 
 def test_tmux_multiple_splits(mocker):
     mock_proc = mocker.patch.object(subprocess, 'Popen')
@@ -28,10 +38,9 @@ def test_tmux_multiple_splits(mocker):
     with TmuxSession(session_name=session_name, commands=commands) as tmux:
         pass
 
-    calls = [mock.call(['tmux', 'new-session', '-ds', 'tmux-15578', '-n', 'remote-session', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox1'], stderr=-1, stdout=-1),
-             mock.call(['tmux', 'select-layout', '-t', 'tmux-15578', 'tiled'], stderr=-1, stdout=-1),
-             mock.call(['tmux', 'split-window', '-t', 'tmux-15578', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox2'], stderr=-1, stdout=-1),
-             mock.call(['tmux', 'select-layout', '-t', 'tmux-15578', 'tiled'], stderr=-1, stdout=-1),
+    calls = [batched(['new-session', '-ds', 'tmux-15578', '-n', 'remote-session', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox1'],
+                     ['split-window', '-d', '-h', '-t', 'tmux-15578:remote-session', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox2'],
+                     ['select-layout', '-t', 'tmux-15578:remote-session', 'tiled']),
              mock.call(['tmux', 'kill-session', '-t', 'tmux-15578'], stderr=-1, stdout=-1)]
 
     # be sure that all calls were positivly called, and that no other calls were made
@@ -56,11 +65,10 @@ def test_tmux_sync_multiple_splits(mocker):
     with TmuxSession(session_name=session_name, commands=commands, sync=True) as tmux:
         pass
 
-    calls = [mock.call(['tmux', 'new-session', '-ds', 'tmux-15578', '-n', 'remote-session', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox1'], stderr=-1, stdout=-1),
-             mock.call(['tmux', 'select-layout', '-t', 'tmux-15578', 'tiled'], stderr=-1, stdout=-1),
-             mock.call(['tmux', 'split-window', '-t', 'tmux-15578', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox2'], stderr=-1, stdout=-1),
-             mock.call(['tmux', 'select-layout', '-t', 'tmux-15578', 'tiled'], stderr=-1, stdout=-1),
-             mock.call(['tmux', 'set-window-option', '-t', 'tmux-15578', 'synchronize-panes', 'on'], stderr=-1, stdout=-1),
+    calls = [batched(['new-session', '-ds', 'tmux-15578', '-n', 'remote-session', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox1'],
+                     ['split-window', '-d', '-h', '-t', 'tmux-15578:remote-session', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox2'],
+                     ['select-layout', '-t', 'tmux-15578:remote-session', 'tiled'],
+                     ['set-window-option', '-t', 'tmux-15578:remote-session', 'synchronize-panes', 'on']),
              mock.call(['tmux', 'kill-session', '-t', 'tmux-15578'], stderr=-1, stdout=-1)]
 
     # be sure that all calls were positivly called, and that no other calls were made
@@ -86,10 +94,10 @@ def test_tmux_multiple_windows(mocker):
     with TmuxSession(session_name=session_name, commands=commands, in_windows=True) as tmux:
         pass
 
-    calls = [mock.call(['tmux', 'new-session', '-ds', 'tmux-15578', '-n', 'somebox-0', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox1'], stderr=-1, stdout=-1),
-             mock.call(['tmux', 'select-layout', '-t', 'tmux-15578', 'tiled'], stderr=-1, stdout=-1),
-             mock.call(['tmux', 'new-window', '-n', 'somebox-1', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox2'], stderr=-1, stdout=-1),
-             mock.call(['tmux', 'select-layout', '-t', 'tmux-15578', 'tiled'], stderr=-1, stdout=-1),
+    calls = [batched(['new-session', '-ds', 'tmux-15578', '-n', 'somebox-0', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox1'],
+                     ['select-layout', '-t', 'tmux-15578', 'tiled'],
+                     ['new-window', '-t', 'tmux-15578', '-n', 'somebox-1', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox2'],
+                     ['select-layout', '-t', 'tmux-15578', 'tiled']),
              mock.call(['tmux', 'kill-session', '-t', 'tmux-15578'], stderr=-1, stdout=-1)]
 
     # be sure that all calls were positivly called, and that no other calls were made
@@ -115,25 +123,192 @@ def test_tmux_layout(mocker):
     with TmuxSession(session_name=session_name, commands=commands, in_windows=True, layout_cmds=layout_cmds) as tmux:
         pass
 
-    calls = [mock.call(['tmux', 'new-session', '-ds', 'tmux-15578', '-n', 'somebox-0', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox1'], stderr=-1, stdout=-1),
-             mock.call(['tmux', 'split-window', '-h', '-t', 'somebox-0', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox1', 'echo', 'first split', '&&', 'bash'], stderr=-1, stdout=-1),
-             mock.call(['tmux', 'kill-pane', '-t', '0'], stderr=-1, stdout=-1),
-             mock.call(['tmux', 'select-layout', '-t', 'tmux-15578', 'tiled'], stderr=-1, stdout=-1),
-             mock.call(['tmux', 'split-window', '-h', '-t', 'somebox-0', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox1', 'echo', 'second split', '&&', 'bash'], stderr=-1, stdout=-1),
-             mock.call(['tmux', 'select-layout', '-t', 'tmux-15578', 'tiled'], stderr=-1, stdout=-1),
-             mock.call(['tmux', 'split-window', '-v', '-t', 'somebox-0', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox1', 'echo', 'third split', '&&', 'bash'], stderr=-1, stdout=-1),
-             mock.call(['tmux', 'select-layout', '-t', 'tmux-15578', 'tiled'], stderr=-1, stdout=-1),
-             mock.call(['tmux', 'new-window', '-n', 'somebox-1', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox2'], stderr=-1, stdout=-1),
-             mock.call(['tmux', 'split-window', '-h', '-t', 'somebox-1', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox2', 'echo', 'first split', '&&', 'bash'], stderr=-1, stdout=-1),
-             mock.call(['tmux', 'kill-pane', '-t', '0'], stderr=-1, stdout=-1),
-             mock.call(['tmux', 'select-layout', '-t', 'tmux-15578', 'tiled'], stderr=-1, stdout=-1),
-             mock.call(['tmux', 'split-window', '-h', '-t', 'somebox-1', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox2', 'echo', 'second split', '&&', 'bash'], stderr=-1, stdout=-1),
-             mock.call(['tmux', 'select-layout', '-t', 'tmux-15578', 'tiled'], stderr=-1, stdout=-1),
-             mock.call(['tmux', 'split-window', '-v', '-t', 'somebox-1', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox2', 'echo', 'third split', '&&', 'bash'], stderr=-1, stdout=-1),
-             mock.call(['tmux', 'select-layout', '-t', 'tmux-15578', 'tiled'], stderr=-1, stdout=-1),
+    calls = [batched(['new-session', '-ds', 'tmux-15578', '-n', 'somebox-0', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox1'],
+                     ['split-window', '-h', '-t', 'tmux-15578', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox1', 'echo', 'first split', '&&', 'bash'],
+                     ['kill-pane', '-t', '0'],
+                     ['split-window', '-h', '-t', 'tmux-15578', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox1', 'echo', 'second split', '&&', 'bash'],
+                     ['split-window', '-v', '-t', 'tmux-15578', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox1', 'echo', 'third split', '&&', 'bash'],
+                     ['select-layout', '-t', 'tmux-15578', 'tiled'],
+                     ['new-window', '-t', 'tmux-15578', '-n', 'somebox-1', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox2'],
+                     ['split-window', '-h', '-t', 'tmux-15578', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox2', 'echo', 'first split', '&&', 'bash'],
+                     ['kill-pane', '-t', '0'],
+                     ['split-window', '-h', '-t', 'tmux-15578', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox2', 'echo', 'second split', '&&', 'bash'],
+                     ['split-window', '-v', '-t', 'tmux-15578', 'ssh', '-o', 'ProxyCommand=ssh  -W %h:%p ubuntu@zest', 'ubuntu@devbox2', 'echo', 'third split', '&&', 'bash'],
+                     ['select-layout', '-t', 'tmux-15578', 'tiled']),
              mock.call(['tmux', 'kill-session', '-t', 'tmux-15578'], stderr=-1, stdout=-1)]
 
     # be sure that all calls were positivly called, and that no other calls were made
     assert len(calls) == mock_proc.call_count
     for call in calls:
         mock_proc.assert_has_calls([call])
+
+
+def test_tmux_paginated_windows(mocker):
+    mock_proc = mocker.patch.object(subprocess, 'Popen')
+
+    proc_obj = lambda: None
+    proc_obj.returncode = 0
+    proc_obj.communicate = lambda: ('', '')
+    mock_proc.return_value = proc_obj
+
+    commands = collections.OrderedDict([('somebox-%d' % idx, 'ssh ubuntu@devbox%d' % idx) for idx in range(5)])
+
+    with TmuxSession(session_name='tmux-15578', commands=commands, sync=True, max_panes=3) as tmux:
+        pass
+
+    calls = [batched(['new-session', '-ds', 'tmux-15578', '-n', 'remote-session', 'ssh', 'ubuntu@devbox0'],
+                     ['split-window', '-d', '-h', '-t', 'tmux-15578:remote-session', 'ssh', 'ubuntu@devbox2'],
+                     ['split-window', '-d', '-v', '-t', 'tmux-15578:remote-session', 'ssh', 'ubuntu@devbox1'],
+                     ['select-layout', '-t', 'tmux-15578:remote-session', 'tiled'],
+                     ['new-window', '-t', 'tmux-15578', '-n', 'remote-session-2', 'ssh', 'ubuntu@devbox3'],
+                     ['split-window', '-d', '-h', '-t', 'tmux-15578:remote-session-2', 'ssh', 'ubuntu@devbox4'],
+                     ['select-layout', '-t', 'tmux-15578:remote-session-2', 'tiled'],
+                     ['set-window-option', '-t', 'tmux-15578:remote-session', 'synchronize-panes', 'on'],
+                     ['set-window-option', '-t', 'tmux-15578:remote-session-2', 'synchronize-panes', 'on']),
+             mock.call(['tmux', 'kill-session', '-t', 'tmux-15578'], stderr=-1, stdout=-1)]
+
+    assert mock_proc.call_args_list == calls
+
+
+def test_split_order():
+    for count in range(1, 70):
+        splits, positions = split_order(count)
+
+        # replay the splits: each new pane is placed right after the pane that was split
+        panes = [0]
+        for step, (offset, direction) in enumerate(splits, 1):
+            assert direction in ('-h', '-v')
+            panes.insert(offset + 1, positions[step])
+
+        assert panes == list(range(count))
+
+    # the largest pane is split each time
+    assert split_order(5)[0] == [(0, '-h'), (0, '-v'), (2, '-v'), (0, '-h')]
+
+
+class FakeControlClient(object):
+    # answers every command written to it, in order, like tmux -C does
+    def __init__(self, failing=tuple()):
+        self.lines = []
+        self._failing = failing
+        self._output = collections.deque([b'%begin 1 1 0\n', b'%end 1 1 0\n'])
+        self.returncode = 0
+
+    def write(self, data):
+        line = data.decode('utf-8').strip()
+        self.lines.append(line)
+        status = '%error' if line.split(' ')[0] in self._failing else '%end'
+        self._output.extend([b'%begin 1 2 1\n', b'%window-add @1\n', b'%end 1 2 1\n'.replace(b'%end', status.encode('utf-8'))])
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self._output.append(b'%exit\n')
+        self._output.append(b'')
+
+    def readline(self):
+        while len(self._output) == 0:
+            time.sleep(0.001)
+        return self._output.popleft()
+
+    def wait(self):
+        return 0
+
+    @property
+    def stdin(self):
+        return self
+
+    @property
+    def stdout(self):
+        return self
+
+    def communicate(self):
+        return ('', '')
+
+
+def test_tmux_control_mode(mocker):
+    client = FakeControlClient(failing=('new-window',))
+    mock_proc = mocker.patch.object(subprocess, 'Popen', return_value=client)
+    mock_logger = mocker.patch('bridgy.tmux.logger')
+
+    commands = [('somebox-0', "ssh ubuntu@devbox1"),
+                ('somebox-1', "ssh -o ProxyCommand='ssh  -W %h:%p ubuntu@zest'  ubuntu@devbox2"),
+                ('somebox-2', "ssh ubuntu@devbox3")]
+    commands = collections.OrderedDict(commands)
+
+    with TmuxSession(session_name='tmux-15578', commands=commands, in_windows=True, control_mode=True) as tmux:
+        tmux._builder.join()
+
+    # the session is created by a control mode client which then receives every other command
+    assert mock_proc.call_args_list[0] == mock.call(['tmux', '-C', 'new-session', '-s', 'tmux-15578', '-n', 'somebox-0', 'ssh', 'ubuntu@devbox1'],
+                                                    stdin=-1, stdout=-1, stderr=-1)
+    assert client.lines == ['select-layout -t tmux-15578 tiled',
+                            'new-window -t tmux-15578 -n somebox-1 ssh -o "ProxyCommand=ssh  -W %h:%p ubuntu@zest" ubuntu@devbox2',
+                            'select-layout -t tmux-15578 tiled',
+                            'new-window -t tmux-15578 -n somebox-2 ssh ubuntu@devbox3',
+                            'select-layout -t tmux-15578 tiled']
+    assert mock_proc.call_args_list[1:] == [mock.call(['tmux', 'kill-session', '-t', 'tmux-15578'], stderr=-1, stdout=-1)]
+
+    # failures are reported against the pane that caused them
+    errors = [call[0][0] for call in mock_logger.error.call_args_list]
+    assert len(errors) == 2
+    assert errors[0].startswith('Tmux failed to open somebox-1')
+    assert errors[1].startswith('Tmux failed to open somebox-2')
+
+
+def test_tmux_control_mode_dry_run(mocker):
+    mock_proc = mocker.patch.object(subprocess, 'Popen')
+
+    commands = collections.OrderedDict([('somebox-0', "ssh ubuntu@devbox1"), ('somebox-1', "ssh ubuntu@devbox2")])
+
+    with TmuxSession(session_name='tmux-15578', commands=commands, dry_run=True, control_mode=True) as tmux:
+        pass
+
+    assert mock_proc.call_count == 0
+
+
+def test_tmux_batch_escapes_separators(mocker):
+    mock_proc = mocker.patch.object(subprocess, 'Popen')
+
+    proc_obj = lambda: None
+    proc_obj.returncode = 0
+    proc_obj.communicate = lambda: ('', '')
+    mock_proc.return_value = proc_obj
+
+    commands = collections.OrderedDict([('somebox-0', "ssh -t ubuntu@devbox1 cd /app; bash"),
+                                        ('somebox-1', "ssh -t ubuntu@devbox2 'cd /app;'")])
+
+    with TmuxSession(session_name='tmux-15578', commands=commands) as tmux:
+        pass
+
+    # only the separators between commands are left as a bare ';'
+    args = mock_proc.call_args_list[0][0][0]
+    assert args.count(';') == 2
+    assert '/app\\;' in args
+    assert 'cd /app\\;' in args
+
+
+@pytest.mark.skipif(not os.path.exists('/usr/bin/tmux') and not os.path.exists('/usr/local/bin/tmux'), reason='tmux is not installed')
+def test_tmux_batch_separators_in_tmux(monkeypatch):
+    import shutil
+    import tempfile
+
+    # a server of its own, the socket path has to be short
+    socket_dir = tempfile.mkdtemp(dir='/tmp')
+    monkeypatch.setenv('TMUX_TMPDIR', socket_dir)
+    monkeypatch.delenv('TMUX', raising=False)
+
+    session = TmuxSession(session_name='bridgy-test-%d' % os.getpid())
+    try:
+        with session.batch():
+            # unescaped, tmux would end the command at 'sleep 30;' and fail to run 'bridgy' as a command
+            session.tmux('new-session', '-ds', session._session_name, '-n', 'first', "sh -c 'sleep 30;' bridgy")
+            session.tmux('new-window', '-t', session._session_name, '-n', 'second', 'sleep 30')
+        panes = session._run('list-panes', '-s', '-t', session._session_name, '-F', '#{pane_start_command}')
+    finally:
+        session._run('kill-server')
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
+    # the whole sequence failing would have left no windows
+    assert len(panes.decode('utf-8').strip().splitlines()) == 2